@@ -18,123 +18,291 @@ bse_status : 'Active/Suspended'
 bse_id : 'BSE ID'
 bse_group : 'BSE Group'
 
-Periodically we run this to update the table.
+Periodically we run this to update the table. Only the securities that are
+new, changed or delisted since the last run are written.
 """
 
 from __future__ import print_function
 import os
-from datetime import datetime as dt
+import json
+import time
+import hashlib
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import bindparam
 
 from tickerplot.nse.nse_utils import nse_get_all_stocks_list
 from tickerplot.bse.bse_utils import bse_get_all_stocks_list
 from tickerplot.sql.sqlalchemy_wrapper import create_or_get_all_scrips_table
-from tickerplot.sql.sqlalchemy_wrapper import execute_many_insert
 from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+from tickerplot.sql.sqlalchemy_wrapper import select_expr
+
+from bulk_writer import bulk_insert
+from date_parser import parse_date
+import symbol_resolver
 
 from tickerplot.utils.logger import get_logger
 module_logger = get_logger(os.path.basename(__file__))
 
-def get_nse_stocks_dict():
+# Columns of all_scrips_info written from the NSE and BSE lists (besides the
+# ISIN). Changes to any of these are detected by comparing hashes.
+_COLUMNS = ('company_name', 'nse_traded', 'nse_start_date', 'nse_symbol',
+            'bse_traded', 'bse_start_date', 'bse_id', 'bse_symbol',
+            'bse_group')
+
+# ISINs (sorted lists) to be inserted into, changed and delisted in the
+# all_scrips_info table.
+ScripsDelta = namedtuple('ScripsDelta', ['inserted', 'changed', 'delisted'])
+
+# Lists of stocks downloaded from NSE and BSE are cached for these many seconds.
+CACHE_TTL = 12 * 60 * 60
+
+_DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                  'tickdownload')
+
+def _load_cached_list(path, ttl):
+    """Returns the list of stocks cached at `path` if it's younger than `ttl`
+    seconds, else None."""
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, IOError, ValueError):
+        return None
+    stock_info = namedtuple(cached['type'], cached['fields'])
+    return [stock_info(*row) for row in cached['rows']]
+
+
+def _save_cached_list(path, stocks):
+    if not stocks:
+        return
+    dirname = os.path.dirname(path)
+    tmp_path = None
+    try:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'type': type(stocks[0]).__name__,
+                       'fields': list(stocks[0]._fields),
+                       'rows': [list(s) for s in stocks]}, f)
+        os.rename(tmp_path, path)
+    except (OSError, IOError, TypeError, ValueError) as e:
+        # Caching is best effort, eg. a value not serializable to JSON
+        # shouldn't fail the sync.
+        module_logger.warning("Unable to cache %s: %s", path, e)
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def _get_stocks_list(name, get_list, cache_dir=None, ttl=CACHE_TTL):
+    """Returns the list of stocks from `get_list`, using the list cached in
+    `cache_dir` (if given) if it's younger than `ttl` seconds."""
+    if cache_dir is None:
+        return get_list()
+
+    path = os.path.join(cache_dir, '%s_stocks.json' % name)
+    stocks = _load_cached_list(path, ttl)
+    if stocks is not None:
+        module_logger.info("Using cached %s list %s", name, path)
+        return stocks
+    stocks = get_list()
+    _save_cached_list(path, stocks)
+    return stocks
+
+
+def get_nse_stocks_dict(cache_dir=None, ttl=CACHE_TTL):
     nse_stocks_dict = {} # dictionary of nse stocks key = isin
-    for nse_stock in nse_get_all_stocks_list():
+    for nse_stock in _get_stocks_list('nse', nse_get_all_stocks_list,
+                                      cache_dir, ttl):
         nse_stocks_dict[nse_stock.isin] = nse_stock
 
     module_logger.info("Found %d Stocks in NSE.", len(nse_stocks_dict))
     return nse_stocks_dict
 
-def get_bse_stocks_dict():
+def get_bse_stocks_dict(cache_dir=None, ttl=CACHE_TTL):
     bse_stocks_dict = {} # dictionary of bse stocks key = isin
-    for bse_stock in bse_get_all_stocks_list():
+    for bse_stock in _get_stocks_list('bse', bse_get_all_stocks_list,
+                                      cache_dir, ttl):
         bse_stocks_dict[bse_stock.isin] = bse_stock
 
     module_logger.info("Found %d Stocks in BSE.", len(bse_stocks_dict))
     return bse_stocks_dict
 
-def populate_all_scrips_table(db_metadata):
+def get_stocks_dicts(cache_dir=None, ttl=CACHE_TTL):
+    """Returns a tuple of (NSE stocks dict, BSE stocks dict), both lists are
+    downloaded concurrently."""
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        nse_future = executor.submit(get_nse_stocks_dict, cache_dir, ttl)
+        bse_future = executor.submit(get_bse_stocks_dict, cache_dir, ttl)
+        return nse_future.result(), bse_future.result()
+
+
+def _nse_start_date(nstock):
+    return parse_date(nstock.listing_date)
+
+
+def get_scrip_rows(nse_stocks_dict, bse_stocks_dict):
     """
-    Populates the all_scrips_info table.
+    Returns a dictionary of isin -> row (dictionary with all the `_COLUMNS`)
+    for the all_scrips_info table.
     """
-    nse_stocks_dict = get_nse_stocks_dict()
     nse_isins = nse_stocks_dict.keys()
-
-    bse_stocks_dict = get_bse_stocks_dict()
     bse_isins = bse_stocks_dict.keys()
 
     common_isins = set(nse_isins) & set(bse_isins)
     bse_only_isins = set(bse_isins) - common_isins
     nse_only_isins = set(nse_isins) - common_isins
 
-    table = create_or_get_all_scrips_table(metadata=db_metadata)
-
-    count = 0
-    insert_statements = []
+    rows = {}
     for isin in common_isins:
         nstock = nse_stocks_dict[isin]
         bstock = bse_stocks_dict[isin]
 
-        nstart_datetime = dt.strptime(nstock.listing_date,
-                                      '%d-%b-%Y')
-        nstart_date = dt.date(nstart_datetime)
-
-        ins = table.insert().values(security_isin=nstock.isin,
-                                    company_name=nstock.name,
-                                    nse_traded=True,
-                                    nse_start_date=nstart_date,
-                                    nse_symbol=nstock.symbol,
-                                    #nse_suspended default is False,
-                                    bse_traded=True,
-                                    bse_start_date=nstart_date,
-                                    bse_id=bstock.bseid,
-                                    bse_symbol=bstock.symbol,
-                                    bse_group=bstock.group)
-        module_logger.debug(ins.compile().params)
-
-        insert_statements.append(ins)
-        count += 1
-
-    common_count = count
-    module_logger.info("common securities count: %d", common_count)
+        nstart_date = _nse_start_date(nstock)
+
+        rows[isin] = {'company_name': nstock.name,
+                      'nse_traded': True,
+                      'nse_start_date': nstart_date,
+                      'nse_symbol': nstock.symbol,
+                      #nse_suspended default is False,
+                      'bse_traded': True,
+                      'bse_start_date': nstart_date,
+                      'bse_id': bstock.bseid,
+                      'bse_symbol': bstock.symbol,
+                      'bse_group': bstock.group}
+
+    module_logger.info("common securities count: %d", len(common_isins))
 
     for isin in bse_only_isins:
         bstock = bse_stocks_dict[isin]
 
-        ins = table.insert().values(security_isin=bstock.isin,
-                                    company_name=bstock.name,
-                                    bse_traded=True,
-                                    bse_id=bstock.bseid,
-                                    bse_symbol=bstock.symbol,
-                                    bse_group=bstock.group)
-        module_logger.debug(ins.compile().params)
-
-        insert_statements.append(ins)
-        count += 1
+        rows[isin] = {'company_name': bstock.name,
+                      'bse_traded': True,
+                      'bse_id': bstock.bseid,
+                      'bse_symbol': bstock.symbol,
+                      'bse_group': bstock.group}
 
-    bse_only_count = count - common_count
-    module_logger.info("bse_only securities count: %d", bse_only_count)
+    module_logger.info("bse_only securities count: %d", len(bse_only_isins))
 
     for isin in nse_only_isins:
         nstock = nse_stocks_dict[isin]
 
-        nstart_datetime = dt.strptime(nstock.listing_date,
-                                      '%d-%b-%Y')
-        nstart_date = dt.date(nstart_datetime)
+        rows[isin] = {'company_name': nstock.name,
+                      'nse_traded': True,
+                      'nse_start_date': _nse_start_date(nstock),
+                      'nse_symbol': nstock.symbol
+                      #nse_suspended default is False,
+                     }
+
+    module_logger.info("nse_only securities count: %d", len(nse_only_isins))
+
+    for isin, row in rows.items():
+        row['security_isin'] = isin
+        for col in _COLUMNS:
+            row.setdefault(col, None)
+    return rows
+
+
+def _row_hash(row):
+    """Returns a hash of the contents (`_COLUMNS`) of the row."""
+    contents = repr(tuple(row[col] for col in _COLUMNS))
+    return hashlib.sha1(contents.encode('utf-8')).hexdigest()
+
+
+def _current_hashes(table, conn):
+    """Returns dictionaries of isin -> hash of the row and isin -> whether
+    the security is traded on either exchange, for the rows in the table."""
+
+    sel = select_expr([table.c.security_isin] +
+                      [table.c[col] for col in _COLUMNS])
+    hashes = {}
+    traded = {}
+    for r in conn.execute(sel):
+        row = dict(zip(_COLUMNS, tuple(r)[1:]))
+        hashes[r[0]] = _row_hash(row)
+        traded[r[0]] = bool(row['nse_traded'] or row['bse_traded'])
+    return hashes, traded
+
+
+def diff_scrip_rows(rows, current_hashes, current_traded):
+    """Returns a `ScripsDelta` of isins to be inserted, changed and delisted
+    for the new `rows` (as returned by `get_scrip_rows`) given the hashes of
+    the rows in the table. Securities already delisted are not delisted
+    again."""
+
+    new_isins = set(rows.keys())
+    old_isins = set(current_hashes.keys())
+
+    inserted = new_isins - old_isins
+    changed = set(isin for isin in new_isins & old_isins
+                  if _row_hash(rows[isin]) != current_hashes[isin])
+    delisted = set(isin for isin in old_isins - new_isins
+                   if current_traded[isin])
+    return ScripsDelta(sorted(inserted), sorted(changed), sorted(delisted))
+
+
+def _apply_delta(conn, table, rows, delta):
+    if delta.inserted:
+        bulk_insert(table, [rows[isin] for isin in delta.inserted],
+                    conn=conn)
+    if delta.changed:
+        upd = table.update().\
+            where(table.c.security_isin == bindparam('_isin')).\
+            values(dict((col, bindparam(col)) for col in _COLUMNS))
+        conn.execute(upd, [dict([(col, rows[isin][col]) for col in _COLUMNS],
+                                _isin=isin)
+                           for isin in delta.changed])
+    if delta.delisted:
+        upd = table.update().\
+            where(table.c.security_isin == bindparam('_isin')).\
+            values(nse_traded=False, bse_traded=False)
+        conn.execute(upd, [{'_isin': isin} for isin in delta.delisted])
+
+
+def sync_all_scrips_table(db_metadata, nse_stocks_dict=None,
+                          bse_stocks_dict=None, dry_run=False,
+                          cache_dir=None, ttl=CACHE_TTL):
+    """
+    Brings the all_scrips_info table up to date with the lists of stocks from
+    NSE and BSE (downloaded if not given, see `get_stocks_dicts`). Only the
+    securities that are new, changed or delisted (no longer in either list,
+    these are marked as not traded) are written, all in one transaction.
+    Returns a `ScripsDelta`.
+    """
+    if nse_stocks_dict is None or bse_stocks_dict is None:
+        nse_stocks_dict, bse_stocks_dict = get_stocks_dicts(cache_dir, ttl)
+
+    rows = get_scrip_rows(nse_stocks_dict, bse_stocks_dict)
 
-        ins = table.insert().values(security_isin=nstock.isin,
-                                    company_name=nstock.name,
-                                    nse_traded=True,
-                                    nse_start_date=nstart_date,
-                                    nse_symbol=nstock.symbol
-                                    #nse_suspended default is False,
-                                   )
-        module_logger.debug(ins.compile().params)
+    table = create_or_get_all_scrips_table(metadata=db_metadata)
 
-        insert_statements.append(ins)
-        count += 1
+    with db_metadata.bind.begin() as conn:
+        current_hashes, current_traded = _current_hashes(table, conn)
+        delta = diff_scrip_rows(rows, current_hashes, current_traded)
+        if not dry_run:
+            _apply_delta(conn, table, rows, delta)
+    if not dry_run:
+        if delta.inserted:
+            symbol_resolver.assign_security_ids(db_metadata,
+                                                isins=delta.inserted)
+        symbol_resolver.invalidate(db_metadata)
 
-    nse_only_count = count - bse_only_count - common_count
-    module_logger.info("nse_only securities count: %d", nse_only_count)
+    module_logger.info("%d securities inserted, %d changed, %d delisted.",
+                       len(delta.inserted), len(delta.changed),
+                       len(delta.delisted))
+    return delta
 
-    return insert_statements
+
+def populate_all_scrips_table(db_metadata, cache_dir=None, ttl=CACHE_TTL):
+    """
+    Populates the all_scrips_info table. Returns number of rows written.
+    """
+    delta = sync_all_scrips_table(db_metadata, cache_dir=cache_dir, ttl=ttl)
+    return len(delta.inserted) + len(delta.changed) + len(delta.delisted)
 
 def main(args):
 
@@ -146,6 +314,33 @@ def main(args):
                         help="Database URL to be used.",
                         dest="dbpath")
 
+    # --cache-dir option
+    parser.add_argument("--cache-dir",
+                        help="Directory where the downloaded lists are "
+                        "cached. Default is %s." % _DEFAULT_CACHE_DIR,
+                        dest="cache_dir",
+                        default=_DEFAULT_CACHE_DIR)
+
+    # --no-cache option
+    parser.add_argument("--no-cache",
+                        help="Always download the lists.",
+                        dest="no_cache",
+                        action="store_true")
+
+    # --cache-ttl option
+    parser.add_argument("--cache-ttl",
+                        help="Hours for which the cached lists are used. "
+                        "Default is %d." % (CACHE_TTL // 3600),
+                        dest="cache_ttl",
+                        type=float,
+                        default=CACHE_TTL / 3600.0)
+
+    # --dry-run option
+    parser.add_argument("--dry-run",
+                        help="Only report the changes, don't write them.",
+                        dest="dry_run",
+                        action="store_true")
+
     args = parser.parse_args()
 
     # Make sure we can access the DB path if specified or else exit right here.
@@ -158,9 +353,9 @@ def main(args):
                 args.dbpath, e))
             return -1
 
-    insert_statements = populate_all_scrips_table(db_metadata)
-    results = execute_many_insert(insert_statements, engine=db_metadata.bind)
-    _ = [r.close() for r in results]
+    sync_all_scrips_table(db_metadata, dry_run=args.dry_run,
+                          cache_dir=None if args.no_cache else args.cache_dir,
+                          ttl=args.cache_ttl * 3600)
 
     return 0
 
@@ -0,0 +1,148 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+#pylint: disable-msg=broad-except
+"""
+An asyncio based download scheduler shared by all the downloaders.
+
+Downloaders submit `Job`s, each of which belongs to an 'endpoint' (eg. NSE
+bhavcopy, NSE indices). Every endpoint has it's own rate limit (requests per
+second) and concurrency, so jobs for different endpoints are overlapped while
+each endpoint is still accessed within polite limits.
+
+Job functions are the usual blocking download functions, they are run in a
+thread pool. The `on_done` handler of a job (typically a DB write) is called
+in the scheduler's thread, so the DB connection is never shared across
+threads.
+"""
+
+import os
+import time
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limit import TokenBucket
+
+from tickerplot.utils.logger import get_logger
+module_logger = get_logger(os.path.basename(__file__))
+
+# rate is in requests per second, concurrency is max jobs running at a time.
+Endpoint = namedtuple('Endpoint', ['rate', 'concurrency'])
+
+# func(*args) is run in a thread, on_done(JobResult) is called in the
+# scheduler thread if func is successful. tokens is number of requests made
+# by the job.
+Job = namedtuple('Job', ['name', 'endpoint', 'func', 'args', 'on_done',
+                         'tokens'])
+Job.__new__.__defaults__ = (None, 1)
+
+JobResult = namedtuple('JobResult', ['job', 'ok', 'result', 'error',
+                                     'elapsed'])
+
+
+class DownloadScheduler(object):
+    """Runs jobs for multiple endpoints concurrently, within each endpoint's
+    rate limit and concurrency."""
+
+    def __init__(self, endpoints, workers=8):
+        self.endpoints = endpoints
+        self.workers = workers
+        self._loop = None
+        self._tasks = []
+
+    async def _acquire(self, bucket, tokens):
+        if tokens > bucket.capacity:
+            raise ValueError("Cannot acquire more tokens than capacity.")
+        while True:
+            wait = bucket.try_acquire(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def _run_job(self, job, limits, executor):
+        bucket, sem = limits[job.endpoint]
+        async with sem:
+            try:
+                await self._acquire(bucket, job.tokens)
+            except ValueError as e:
+                module_logger.error("Job %s failed: %s", job.name, e)
+                return JobResult(job, False, None, e, 0.0)
+            then = time.time()
+            try:
+                result = await self._loop.run_in_executor(executor, job.func,
+                                                          *job.args)
+            except Exception as e:
+                module_logger.error("Job %s failed: %s", job.name, e)
+                return JobResult(job, False, None, e, time.time() - then)
+            return JobResult(job, True, result, None, time.time() - then)
+
+    async def _run(self, jobs, executor):
+        limits = {}
+        for name, endpoint in self.endpoints.items():
+            limits[name] = (TokenBucket(endpoint.rate,
+                                        capacity=max(endpoint.rate, 2)),
+                            asyncio.Semaphore(endpoint.concurrency))
+
+        self._tasks = [asyncio.ensure_future(self._run_job(job, limits,
+                                                           executor))
+                       for job in jobs]
+        results = []
+        try:
+            for fut in asyncio.as_completed(self._tasks):
+                try:
+                    result = await fut
+                except asyncio.CancelledError:
+                    module_logger.info("Download cancelled.")
+                    break
+                if result.ok and result.job.on_done is not None:
+                    try:
+                        result.job.on_done(result)
+                    except Exception as e:
+                        module_logger.exception(e)
+                        result = result._replace(ok=False, error=e)
+                results.append(result)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        return results
+
+    def run(self, jobs):
+        """Runs all the jobs and returns a list of `JobResult` in the order the
+        jobs completed. Stops early if `cancel` is called."""
+
+        unknown = set(job.endpoint for job in jobs) - set(self.endpoints)
+        if unknown:
+            raise ValueError("Unknown endpoints: %s" % ", ".join(unknown))
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._loop = asyncio.new_event_loop()
+        main_task = self._loop.create_task(self._run(jobs, executor))
+        try:
+            results = self._loop.run_until_complete(main_task)
+        except KeyboardInterrupt:
+            # Let the pending jobs be cancelled before giving up.
+            main_task.cancel()
+            self._loop.run_until_complete(
+                asyncio.gather(main_task, return_exceptions=True))
+            raise
+        finally:
+            self._loop.close()
+            self._loop = None
+            executor.shutdown(wait=False)
+
+        failed = sum(1 for r in results if not r.ok)
+        module_logger.info("%d jobs: %d done, %d failed, %d cancelled.",
+                           len(jobs), len(results) - failed, failed,
+                           len(jobs) - len(results))
+        return results
+
+    def cancel(self):
+        """Cancels all the pending jobs. Can be called from any thread or from
+        a job's `on_done`."""
+        loop = self._loop
+        if loop is None:
+            return
+        for task in self._tasks:
+            loop.call_soon_threadsafe(task.cancel)
@@ -0,0 +1,607 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+#pylint: disable-msg=broad-except
+"""
+Benchmark suite for the data paths that matter for the daily runs - loading
+historical data from the DB, parsing bhavcopies, adjusting for corporate
+actions and running screens.
+
+All the data is synthetic and generated from a seed, so no downloaded data
+is needed and runs are reproducible. Every case is run for a sweep of
+(symbols x rows) sizes, with warmup runs followed by timed repeats, and the
+results (min, median, percentiles, max) are written as JSON, which can be
+compared with an earlier run (say from a previous commit) using `--compare`.
+
+Example -
+
+    python benchmarks.py --symbols 100,1000 --rows 20,250 -o after.json \\
+            --compare before.json
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import pstats
+import cProfile
+import platform
+import tempfile
+import subprocess
+from zipfile import ZipFile
+from datetime import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+from tickerplot.sql.sqlalchemy_wrapper import create_or_get_all_scrips_table
+from tickerplot.sql.sqlalchemy_wrapper import create_or_get_nse_equities_hist_data
+
+from bhavcopy_parser import parse_bhavcopy
+from bulk_writer import bulk_insert
+from columnar_store import ColumnarStore, pq
+from corp_actions_nse import CorpAction
+from corp_adjust import actions_frame, adjustment_factors, apply_factors
+from get_indices_nse import parse_index_rows, _table_data_rows
+from get_indices_nse import _parse_index_page_bs4
+from html_table import table_rows
+from ohlcvd_array import OHLCVDArray
+from process_pd_panel_bench import panel_bench_lc, panel_bench_vector
+from purpose_classifier import classify, clear_memo
+from read_sql_data import get_hist_data_as_dataframe
+
+FIELDS = list(OHLCVDArray.FIELDS)
+
+# Last day of the synthetic data, fixed so that runs are reproducible.
+_END_DATE = '2019-12-31'
+
+_PERCENTILES = (90, 99)
+
+
+class Timer(object):
+    """Context manager measuring wall clock time of the block in
+    `elapsed` (seconds)."""
+
+    def __init__(self):
+        self.start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        return False
+
+
+class Profiler(object):
+    """Context manager running the block under `cProfile`. Formatted stats
+    are available in `stats` after the block."""
+
+    def __init__(self, sort_by='cumulative', limit=20):
+        self.sort_by = sort_by
+        self.limit = limit
+        self.stats = ''
+        self._profile = None
+
+    def __enter__(self):
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self._profile.disable()
+        s = io.StringIO()
+        ps = pstats.Stats(self._profile, stream=s).sort_stats(self.sort_by)
+        ps.print_stats(self.limit)
+        self.stats = s.getvalue()
+        return False
+
+
+def measure(func, warmup=1, repeat=5):
+    """Calls `func` `warmup` times and then `repeat` times, returns a list of
+    timings (seconds) of the repeated calls."""
+
+    for _ in range(warmup):
+        func()
+
+    timings = []
+    for _ in range(repeat):
+        with Timer() as t:
+            func()
+        timings.append(t.elapsed)
+    return timings
+
+
+def summarize(timings):
+    """Returns a dictionary of summary statistics for `timings`."""
+    a = np.asarray(timings)
+    summary = {'repeat': len(a),
+               'min': float(a.min()),
+               'median': float(np.median(a)),
+               'mean': float(a.mean()),
+               'max': float(a.max())}
+    for p in _PERCENTILES:
+        summary['p%d' % p] = float(np.percentile(a, p))
+    return summary
+
+
+def synthetic_ohlcvd(symbols, rows, seed=0):
+    """Returns a 'long' DataFrame (symbol, date, OHLCVD) like
+    `read_sql_data.get_hist_data_as_dataframe`, with `rows` business days of
+    random walk data for each of the `symbols` symbols."""
+
+    rng = np.random.RandomState(seed)
+    names = np.array(['SYM%05d' % i for i in range(symbols)], dtype=object)
+    dates = pd.bdate_range(end=_END_DATE, periods=rows)
+
+    shape = (symbols, rows)
+    start = rng.uniform(10.0, 2000.0, size=(symbols, 1))
+    close = start * np.exp(np.cumsum(rng.normal(0.0, 0.02, size=shape),
+                                     axis=1))
+    open_ = close * (1.0 + rng.normal(0.0, 0.01, size=shape))
+    high = np.maximum(open_, close) * (1.0 + np.abs(rng.normal(0.0, 0.01,
+                                                               size=shape)))
+    low = np.minimum(open_, close) * (1.0 - np.abs(rng.normal(0.0, 0.01,
+                                                              size=shape)))
+    volume = rng.randint(1000, 1000000, size=shape)
+    delivery = (volume * rng.uniform(0.1, 0.9, size=shape)).astype(np.int64)
+
+    df = pd.DataFrame({'symbol': np.repeat(names, rows),
+                       'date': np.tile(dates.values, symbols),
+                       'open': open_.ravel().round(2),
+                       'high': high.ravel().round(2),
+                       'low': low.ravel().round(2),
+                       'close': close.ravel().round(2),
+                       'volume': volume.ravel(),
+                       'delivery': delivery.ravel()})
+    return df[['symbol', 'date'] + FIELDS]
+
+
+def synthetic_bhavcopy(symbols, seed=0):
+    """Returns (bhavcopy zip, MTO delivery DAT) contents (bytes) for a day
+    with `symbols` symbols."""
+
+    rng = np.random.RandomState(seed)
+    series = np.array(['EQ', 'BE', 'BZ'])[rng.randint(0, 3, size=symbols)]
+    close = rng.uniform(10.0, 2000.0, size=symbols).round(2)
+    volume = rng.randint(1000, 1000000, size=symbols)
+    delivery = (volume * rng.uniform(0.1, 0.9, size=symbols)).astype(int)
+
+    bhav = ['SYMBOL,SERIES,OPEN,HIGH,LOW,CLOSE,LAST,PREVCLOSE,TOTTRDQTY,'
+            'TOTTRDVAL,TIMESTAMP,TOTALTRADES,ISIN,']
+    deliv = ['Security Wise Delivery Position - Compulsory Rolling Settlement',
+             '10,MTO,31122019,123456789,0000000',
+             'Trade Date <31-DEC-2019>,Settlement Type <N>',
+             'Record Type,Sr No,Name of Security,Type,Quantity Traded,'
+             'Deliverable Quantity(gross across client level),'
+             '% of Deliverable Quantity to Traded Quantity']
+    for i in range(symbols):
+        sym = 'SYM%05d' % i
+        c = close[i]
+        bhav.append('%s,%s,%.2f,%.2f,%.2f,%.2f,%.2f,%.2f,%d,%.2f,'
+                    '31-DEC-2019,%d,INE%09d,' % (
+                        sym, series[i], c, c * 1.02, c * 0.98, c, c, c,
+                        volume[i], volume[i] * c, i + 1, i))
+        deliv.append('20,%d,%s,%s,%d,%d,%.2f' % (
+            i + 1, sym, series[i], volume[i], delivery[i],
+            100.0 * delivery[i] / volume[i]))
+
+    zip_buf = io.BytesIO()
+    with ZipFile(zip_buf, 'w') as z:
+        z.writestr('cm31DEC2019bhav.csv', '\n'.join(bhav) + '\n')
+
+    return zip_buf.getvalue(), ('\n'.join(deliv) + '\n').encode()
+
+
+def synthetic_index_page(rows, seed=0):
+    """Returns a historical indices page (HTML) with `rows` days of data, like
+    the one parsed by `get_indices_nse._do_get_index`."""
+
+    rng = np.random.RandomState(seed)
+    dates = pd.bdate_range(end=_END_DATE, periods=rows)
+    close = 8000.0 * np.exp(np.cumsum(rng.normal(0.0, 0.01, size=rows)))
+
+    lines = ['<html><head><title>Historical Indices</title></head><body>',
+             '<div id="csvContentDiv">:</div>',
+             '<table>',
+             '<tr><th colspan="7">NIFTY 50</th></tr>',
+             '<tr><th>Date</th><th>Open</th><th>High</th><th>Low</th>'
+             '<th>Close</th><th>Shares Traded</th><th>Turnover (Rs. Cr)</th>'
+             '</tr>',
+             '<tr><th colspan="7"></th></tr>']
+    for d, c in zip(dates, close):
+        lines.append('<tr>\n<td class="date">%s</td>\n'
+                     '<td class="number">%.2f</td>\n'
+                     '<td class="number">%.2f</td>\n'
+                     '<td class="number">%.2f</td>\n'
+                     '<td class="number">%.2f</td>\n'
+                     '<td class="number">%d</td>\n'
+                     '<td class="number">%.2f</td>\n</tr>' % (
+                         d.strftime('%d-%b-%Y'), c * 0.995, c * 1.01,
+                         c * 0.99, c, rng.randint(1e6, 1e8),
+                         rng.uniform(1e3, 1e4)))
+    lines.append('<tr><td colspan="7"><a href="/content/x.csv">Download file '
+                 'in csv format</a></td></tr>')
+    lines.append('</table>')
+    # Rest of the page, which shouldn't need parsing.
+    lines.extend('<div class="footer"><p>%d</p></div>' % i
+                 for i in range(rows))
+    lines.append('</body></html>')
+    return '\n'.join(lines)
+
+
+def parse_index_page(text):
+    """Parses a historical indices page the way `get_indices_nse` does."""
+    return parse_index_rows(_table_data_rows(table_rows(text)))
+
+
+def synthetic_corp_actions(df, per_symbol=2, seed=0):
+    """Returns a list of `CorpAction`s (bonus, split and dividend) with ex
+    dates within the data in `df` for every symbol."""
+
+    rng = np.random.RandomState(seed)
+    dates = np.unique(df['date'].values)
+    actions = []
+    for sym in np.unique(df['symbol'].values):
+        for ex_date in rng.choice(dates, size=per_symbol):
+            ex_date = pd.Timestamp(ex_date).date()
+            kind = rng.randint(0, 3)
+            if kind == 0:
+                actions.append(CorpAction(sym, ex_date, 'B', 0.5, 0.0,
+                                          'bonus 1:1'))
+            elif kind == 1:
+                actions.append(CorpAction(sym, ex_date, 'S', 0.2, 0.0,
+                                          'fv split rs 10 to rs 2'))
+            else:
+                amount = rng.randint(1, 20)
+                actions.append(CorpAction(sym, ex_date, 'D', 1.0,
+                                          float(amount),
+                                          'dividend rs %d' % amount))
+    return actions
+
+
+def synthetic_purposes(count, seed=0):
+    """Returns a list of `count` corp action purpose texts sampled from the
+    golden corpus."""
+
+    corpus = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'misc',
+                          'purpose_golden.jsonl')
+    with open(corpus) as f:
+        purposes = [json.loads(line)['purpose'] for line in f if line.strip()]
+    rng = np.random.RandomState(seed)
+    return [purposes[i] for i in rng.randint(0, len(purposes), size=count)]
+
+
+def classify_purposes(purposes):
+    """Classifies all the `purposes` starting with an empty memo."""
+    clear_memo()
+    return [classify(p) for p in purposes]
+
+
+def adjust_frames_loop(frames, actions):
+    """Adjusts every frame in `frames` (symbol -> DataFrame) for bonus and
+    split `actions` one action at a time (as done in `scrip_to_hd5`).
+    Returns a new dictionary."""
+
+    by_symbol = {}
+    for act in actions:
+        by_symbol.setdefault(act.sym, []).append(act)
+
+    adjusted = {}
+    for sym, frame in frames.items():
+        frame = frame.copy()
+        for act in by_symbol.get(sym, []):
+            if act.action in ('B', 'S'):
+                before = frame.index < pd.Timestamp(act.ex_date)
+                frame.loc[before, ['open', 'high', 'low', 'close']] *= \
+                    act.ratio
+                frame.loc[before, ['volume', 'delivery']] /= act.ratio
+        adjusted[sym] = frame
+    return adjusted
+
+
+class SyntheticData(object):
+    """Synthetic data for one (symbols, rows) size. Every representation is
+    built on first use, outside of the timed runs."""
+
+    def __init__(self, symbols, rows, seed=0):
+        self.symbols = symbols
+        self.rows = rows
+        self.seed = seed
+        self._cache = {}
+        self._tmpdir = None
+
+    def _get(self, name, build):
+        if name not in self._cache:
+            self._cache[name] = build()
+        return self._cache[name]
+
+    @property
+    def long(self):
+        return self._get('long', lambda: synthetic_ohlcvd(
+            self.symbols, self.rows, seed=self.seed))
+
+    @property
+    def frames(self):
+        """symbol -> DataFrame (float, latest first) like
+        `read_sql_data.get_hist_data_as_dataframes_dict`."""
+        def _build():
+            df = self.long.set_index('date')
+            return dict((sym, g[FIELDS].astype(np.float64).iloc[::-1])
+                        for sym, g in df.groupby('symbol'))
+        return self._get('frames', _build)
+
+    @property
+    def array(self):
+        return self._get('array', lambda: OHLCVDArray.from_dataframe(
+            self.long))
+
+    @property
+    def actions(self):
+        return self._get('actions', lambda: synthetic_corp_actions(
+            self.long, seed=self.seed))
+
+    @property
+    def bhavcopy(self):
+        return self._get('bhavcopy', lambda: synthetic_bhavcopy(
+            self.symbols, seed=self.seed))
+
+    def _mkdtemp(self):
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='tickdownload-bench-')
+        return self._tmpdir
+
+    @property
+    def metadata(self):
+        """Metadata of a temporary SQLite DB populated with the data."""
+        def _build():
+            metadata = get_metadata('sqlite:///%s/bench.sqlite3' %
+                                    self._mkdtemp())
+            scrips = create_or_get_all_scrips_table(metadata=metadata)
+            hist_data = create_or_get_nse_equities_hist_data(
+                metadata=metadata)
+            syms = np.unique(self.long['symbol'].values)
+            bulk_insert(scrips, [{'security_isin': 'INE%09d' % i,
+                                  'company_name': sym,
+                                  'nse_traded': True,
+                                  'nse_symbol': sym,
+                                  'bse_traded': False}
+                                 for i, sym in enumerate(syms)],
+                        engine=metadata.bind)
+            rows = self.long.copy()
+            rows['date'] = rows['date'].dt.date
+            bulk_insert(hist_data, rows.to_dict('records'),
+                        engine=metadata.bind)
+            return metadata
+        return self._get('metadata', _build)
+
+    @property
+    def columnar(self):
+        """A `ColumnarStore` in a temporary directory with the data."""
+        def _build():
+            store = ColumnarStore(os.path.join(self._mkdtemp(), 'columnar'))
+            store.append(self.long)
+            store.flush()
+            return store
+        return self._get('columnar', _build)
+
+    @property
+    def index_page(self):
+        return self._get('index_page', lambda: synthetic_index_page(
+            self.rows, seed=self.seed))
+
+    @property
+    def purposes(self):
+        """Purpose texts, 10 per symbol."""
+        return self._get('purposes', lambda: synthetic_purposes(
+            self.symbols * 10, seed=self.seed))
+
+    def cleanup(self):
+        if 'metadata' in self._cache:
+            self._cache.pop('metadata').bind.dispose()
+        if self._tmpdir:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+
+# Every case takes a `SyntheticData` and returns the function to be timed.
+CASES = {
+    'db_load': lambda d: (
+        lambda m=d.metadata: get_hist_data_as_dataframe(metadata=m)),
+    'columnar_load': lambda d: (
+        lambda s=d.columnar: s.read()),
+    'bhavcopy_parse': lambda d: (
+        lambda b=d.bhavcopy: parse_bhavcopy(io.BytesIO(b[0]),
+                                            io.BytesIO(b[1]))),
+    'array_build': lambda d: (
+        lambda df=d.long: OHLCVDArray.from_dataframe(df)),
+    'corp_adjust_loop': lambda d: (
+        lambda f=d.frames, a=d.actions: adjust_frames_loop(f, a)),
+    'corp_adjust_vector': lambda d: (
+        lambda arr=d.array, a=actions_frame(d.actions): apply_factors(
+            arr, adjustment_factors(a, arr.symbols, arr.dates))),
+    'index_parse': lambda d: (
+        lambda t=d.index_page: parse_index_page(t)),
+    'index_parse_bs4': lambda d: (
+        lambda t=d.index_page: _parse_index_page_bs4(t)),
+    'purpose_classify': lambda d: (
+        lambda p=d.purposes: classify_purposes(p)),
+    'screen_lc': lambda d: (
+        lambda f=d.frames: panel_bench_lc(f)),
+    'screen_vector': lambda d: (
+        lambda a=d.array: panel_bench_vector(a)),
+}
+
+if pq is None:
+    # pyarrow is optional.
+    del CASES['columnar_load']
+
+
+def run_suite(cases, symbols_sweep, rows_sweep, warmup=1, repeat=5, seed=0,
+              profile=False):
+    """Runs `cases` for every (symbols, rows) size and returns a list of
+    result dictionaries."""
+
+    results = []
+    for symbols in symbols_sweep:
+        for rows in rows_sweep:
+            data = SyntheticData(symbols, rows, seed=seed)
+            try:
+                for case in cases:
+                    func = CASES[case](data)
+                    summary = summarize(measure(func, warmup=warmup,
+                                                repeat=repeat))
+                    summary.update({'case': case, 'symbols': symbols,
+                                    'rows': rows})
+                    results.append(summary)
+                    print("%-18s %6d x %-6d median %10.6fs  p90 %10.6fs" % (
+                        case, symbols, rows, summary['median'],
+                        summary['p90']))
+                    if profile:
+                        with Profiler() as p:
+                            func()
+                        print(p.stats)
+            finally:
+                data.cleanup()
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except Exception:
+        return None
+
+
+def environment():
+    """Returns a dictionary describing where the benchmarks were run."""
+    return {'commit': _git_commit(),
+            'timestamp': dt.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__}
+
+
+def compare(results, baseline, threshold=1.2):
+    """Prints median timing ratios of `results` against `baseline` (both
+    lists of result dictionaries). Returns number of regressions - results
+    slower than `threshold` times the baseline."""
+
+    def _key(r):
+        return (r['case'], r['symbols'], r['rows'])
+
+    base = dict((_key(r), r) for r in baseline)
+    regressions = 0
+    for r in results:
+        b = base.get(_key(r))
+        if b is None or not b['median']:
+            continue
+        ratio = r['median'] / b['median']
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print("%-18s %6d x %-6d %10.6fs -> %10.6fs  x%.2f%s" % (
+            r['case'], r['symbols'], r['rows'], b['median'], r['median'],
+            ratio, flag))
+    return regressions
+
+
+def _int_list(s):
+    return [int(x) for x in s.split(',') if x]
+
+
+def main(args):
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Runs benchmarks on "
+                                     "synthetic data.")
+
+    parser.add_argument("--cases",
+                        help="Comma separated cases to run. One or more of "
+                        "%s. Default is all." % ", ".join(sorted(CASES)),
+                        default=",".join(sorted(CASES)))
+
+    parser.add_argument("--symbols",
+                        help="Comma separated number of symbols to sweep.",
+                        type=_int_list,
+                        default=[100, 1000])
+
+    parser.add_argument("--rows",
+                        help="Comma separated number of rows (days) per "
+                        "symbol to sweep.",
+                        type=_int_list,
+                        default=[20, 250])
+
+    parser.add_argument("--warmup",
+                        help="Number of untimed runs before timing.",
+                        type=int,
+                        default=1)
+
+    parser.add_argument("--repeat",
+                        help="Number of timed runs.",
+                        type=int,
+                        default=5)
+
+    parser.add_argument("--seed",
+                        help="Seed for the synthetic data.",
+                        type=int,
+                        default=0)
+
+    parser.add_argument("--profile",
+                        help="Print cProfile stats for every case.",
+                        action="store_true")
+
+    parser.add_argument("--output", "-o",
+                        help="Write results as JSON to this file.")
+
+    parser.add_argument("--compare",
+                        help="Compare results with this JSON file.")
+
+    parser.add_argument("--threshold",
+                        help="Ratio of medians above which a result is a "
+                        "regression. Default 1.2.",
+                        type=float,
+                        default=1.2)
+
+    args = parser.parse_args(args)
+
+    cases = [c for c in args.cases.split(',') if c]
+    unknown = set(cases) - set(CASES)
+    if unknown or args.repeat < 1 or args.warmup < 0:
+        print(parser.format_usage())
+        return -1
+
+    results = run_suite(cases, args.symbols, args.rows, warmup=args.warmup,
+                        repeat=args.repeat, seed=args.seed,
+                        profile=args.profile)
+
+    report = {'environment': environment(),
+              'config': {'seed': args.seed, 'warmup': args.warmup,
+                         'repeat': args.repeat},
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+
+    sys.exit(main(sys.argv[1:]))
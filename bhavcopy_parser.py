@@ -0,0 +1,162 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+"""
+Parser for NSE bhavcopy (zip) and MTO delivery (DAT) files.
+
+Both the files are streamed line by line as bytes (no decoding or splitting
+of fields we don't need) and the output is a columnar `BhavcopyBatch` of NumPy
+arrays, which can be directly written to the DB or any other store.
+
+Bhavcopy CSV columns are -
+SYMBOL,SERIES,OPEN,HIGH,LOW,CLOSE,LAST,PREVCLOSE,TOTTRDQTY,TOTTRDVAL,...
+
+MTO DAT records we are interested in start with record type '20' and are
+either 4 fields (older files) or 7 fields (with series) long.
+"""
+
+from array import array
+from collections import namedtuple
+from zipfile import ZipFile
+
+import numpy as np
+
+# Series for which we store the data.
+SERIES = frozenset([b'EQ', b'BE', b'BZ'])
+
+_OHLC_FIELDS = 4
+
+
+class BhavcopyBatch(namedtuple('BhavcopyBatch', ['symbols', 'codes', 'ohlc',
+                                                 'volume', 'delivery'])):
+    """Columnar data for all the scrips traded on a given day.
+
+    symbols : object array of symbol names
+    codes : int32 array of symbol codes (index in a symbol table)
+    ohlc : float64 array of shape (n, 4) for open, high, low and close
+    volume, delivery : int64 arrays
+    """
+    __slots__ = ()
+
+    @property
+    def count(self):
+        return len(self.symbols)
+
+    def to_rows(self, date):
+        """Returns a list of dictionaries suitable for a bulk insert into the
+        `nse_equities_hist_data` table for `date`."""
+        o, h, l, c = self.ohlc.T.tolist()
+        return [{'symbol': s, 'date': date,
+                 'open': o_, 'high': h_, 'low': l_, 'close': c_,
+                 'volume': v_, 'delivery': d_}
+                for s, o_, h_, l_, c_, v_, d_ in zip(self.symbols.tolist(),
+                                                     o, h, l, c,
+                                                     self.volume.tolist(),
+                                                     self.delivery.tolist())]
+
+
+def _parse_bhav_lines(lines):
+    """Parses bhavcopy CSV lines (bytes). Returns (symbols list, symbol ->
+    index dict, ohlc array('d'), volume array('q'))."""
+
+    symbols = []
+    index = {}
+    ohlc = array('d')
+    volume = array('q')
+
+    lines = iter(lines)
+    next(lines, None)  # header
+    for line in lines:
+        fields = line.split(b',', 9)
+        if len(fields) < 9 or fields[1] not in SERIES:
+            continue
+        sym = fields[0].decode()
+        values = (float(fields[2]), float(fields[3]),
+                  float(fields[4]), float(fields[5]))
+        vol = int(fields[8])
+        i = index.get(sym)
+        if i is None:
+            index[sym] = len(symbols)
+            symbols.append(sym)
+            ohlc.extend(values)
+            volume.append(vol)
+        else:
+            # Same symbol again (different series), last one wins.
+            ohlc[i * _OHLC_FIELDS:(i + 1) * _OHLC_FIELDS] = array('d', values)
+            volume[i] = vol
+
+    return symbols, index, ohlc, volume
+
+
+def _parse_delivery_lines(lines, index, delivery, logger=None):
+    """Fills `delivery` for symbols in `index` from MTO DAT lines (bytes)."""
+
+    for line in lines:
+        if not line.startswith(b'20'):
+            continue
+        fields = line.split(b',')
+        if len(fields) == 4:
+            sym, d = fields[1], fields[3]
+        elif len(fields) == 7:
+            if fields[3].strip() not in SERIES:
+                continue
+            sym, d = fields[2], fields[5]
+        else:
+            continue
+        sym = sym.strip().decode()
+        i = index.get(sym)
+        if i is None:
+            if logger:
+                logger.error("For Symbol: %s Delivery Data found but no "
+                             "Bhavcopy Data", sym)
+            continue
+        delivery[i] = int(d)
+
+
+def _to_ndarray(arr, dtype):
+    """Returns a NumPy array sharing memory with an `array.array`."""
+    if not arr:
+        return np.empty(0, dtype=dtype)
+    return np.frombuffer(arr, dtype=dtype)
+
+
+def _bhav_member_lines(bhav_file):
+    """Yields lines of the CSV member inside a bhavcopy zip file object."""
+    bhavs = ZipFile(bhav_file)
+    names = bhavs.namelist()
+    with bhavs.open(names[-1]) as bhav:
+        for line in bhav:
+            yield line
+
+
+def parse_bhavcopy(bhav_file, deliv_file, symbol_table=None, logger=None):
+    """Parses a bhavcopy zip and a delivery DAT file objects (opened in binary
+    mode) and returns a `BhavcopyBatch`.
+
+    If `symbol_table` (a dictionary of symbol -> code) is given, codes are
+    looked up in it and new symbols are added to it, else codes are just the
+    row numbers. Delivery is 0 for symbols not found in the delivery file."""
+
+    symbols, index, ohlc, volume = _parse_bhav_lines(
+        _bhav_member_lines(bhav_file))
+
+    count = len(symbols)
+    delivery = np.zeros(count, dtype=np.int64)
+    _parse_delivery_lines(deliv_file, index, delivery, logger=logger)
+
+    if symbol_table is None:
+        codes = np.arange(count, dtype=np.int32)
+    else:
+        codes = np.empty(count, dtype=np.int32)
+        for i, sym in enumerate(symbols):
+            codes[i] = symbol_table.setdefault(sym, len(symbol_table))
+
+    symbols_arr = np.empty(count, dtype=object)
+    symbols_arr[:] = symbols
+
+    return BhavcopyBatch(symbols=symbols_arr,
+                         codes=codes,
+                         ohlc=_to_ndarray(ohlc, np.float64).reshape(
+                             count, _OHLC_FIELDS),
+                         volume=_to_ndarray(volume, np.int64),
+                         delivery=delivery)
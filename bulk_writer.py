@@ -0,0 +1,206 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+"""
+Bulk writes for all the downloaders.
+
+Instead of building (and compiling) one insert statement per row, rows are
+passed as a list of dictionaries and written using a single parameterized
+`executemany` per batch. On PostgreSQL (psycopg2) `COPY` is used instead, which
+is the fastest way of getting rows into the DB.
+
+`bulk_upsert` uses the DB's 'insert or update' on a unique index, so writing
+the same rows again doesn't create duplicates.
+"""
+
+import os
+import csv
+import time
+import logging
+from io import StringIO as sio
+
+from sqlalchemy import and_, bindparam
+
+from tickerplot.utils.logger import get_logger
+module_logger = get_logger(os.path.basename(__file__))
+
+# Rows written in a single executemany/COPY
+BATCH_SIZE = 5000
+
+_COPY_NULL = r'\N'
+
+
+def _batches(rows, batch_size):
+    """Splits rows into batches of at-most `batch_size` rows, where all rows
+    in a batch have the same keys. (executemany requires the same parameters
+    for every row and we don't want to override column defaults with None)"""
+
+    batch = []
+    keys = None
+    for row in rows:
+        row_keys = sorted(row.keys())
+        if batch and (row_keys != keys or len(batch) >= batch_size):
+            yield keys, batch
+            batch = []
+        keys = row_keys
+        batch.append(row)
+    if batch:
+        yield keys, batch
+
+
+def _copy_defaults(table, keys):
+    """Returns a dictionary of column name -> default value for the columns of
+    `table` not in `keys` having a Python side scalar default (which `insert`
+    would fill in, but COPY can't). None if any of them has some other Python
+    side default (eg. a callable or a sequence), COPY can't be used then."""
+
+    defaults = {}
+    for col in table.columns:
+        if col.key in keys or col.default is None:
+            continue
+        if not getattr(col.default, 'is_scalar', False):
+            return None
+        defaults[col.name] = col.default.arg
+    return defaults
+
+
+def _copy_statement(dialect, table, columns):
+    """Returns the COPY statement for the `columns` of `table`, with the table
+    (and schema) name and the column names quoted as required."""
+
+    preparer = dialect.identifier_preparer
+    return "COPY %s (%s) FROM STDIN WITH (FORMAT csv, NULL '%s')" % (
+        preparer.format_table(table),
+        ", ".join(preparer.quote(c) for c in columns), _COPY_NULL)
+
+
+def _copy_batch(conn, table, keys, batch, defaults):
+    """Writes the batch using PostgreSQL COPY. `defaults` (see
+    `_copy_defaults`) are written for the columns missing in the rows."""
+
+    default_columns = sorted(defaults)
+    default_values = [_COPY_NULL if defaults[c] is None else defaults[c]
+                      for c in default_columns]
+
+    buf = sio()
+    writer = csv.writer(buf)
+    for row in batch:
+        writer.writerow([_COPY_NULL if row[k] is None else row[k]
+                         for k in keys] + default_values)
+    buf.seek(0)
+
+    copy_st = _copy_statement(conn.dialect, table,
+                              [table.c[k].name for k in keys] +
+                              default_columns)
+
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(copy_st, buf)
+    finally:
+        cursor.close()
+
+
+def _use_copy(conn):
+    return conn.dialect.name == 'postgresql' and \
+        conn.dialect.driver == 'psycopg2'
+
+
+def _do_bulk_insert(conn, table, rows, batch_size):
+    use_copy = _use_copy(conn)
+    count = 0
+    for keys, batch in _batches(rows, batch_size):
+        if module_logger.isEnabledFor(logging.DEBUG):
+            for row in batch:
+                module_logger.debug("%s: %s", table.name, row)
+        defaults = _copy_defaults(table, keys) if use_copy else None
+        if defaults is not None:
+            _copy_batch(conn, table, keys, batch, defaults)
+        else:
+            conn.execute(table.insert(), batch)
+        count += len(batch)
+    return count
+
+
+def bulk_insert(table, rows, engine=None, conn=None, batch_size=BATCH_SIZE):
+    """Inserts `rows` (a list of dictionaries keyed by column names) into
+    `table`. If `conn` is given, rows are written as a part of the transaction
+    on that connection, else a new transaction is used on the `engine`.
+    Returns number of rows written."""
+
+    if not rows:
+        return 0
+
+    then = time.time()
+    if conn is not None:
+        count = _do_bulk_insert(conn, table, rows, batch_size)
+    else:
+        with engine.begin() as conn:
+            count = _do_bulk_insert(conn, table, rows, batch_size)
+    elapsed = time.time() - then
+
+    module_logger.info("Inserted %d rows into %s in %.3fs (%.0f rows/s)",
+                       count, table.name, elapsed,
+                       count / elapsed if elapsed else float(count))
+    return count
+
+
+def _upsert_statement(conn, table, keys, columns):
+    """Returns an insert statement that updates the row on a conflict on the
+    unique `keys`, None if the DB doesn't support one."""
+
+    name = conn.dialect.name
+    if name == 'sqlite':
+        # Conflicting row is deleted and the new one inserted.
+        return table.insert().prefix_with('OR REPLACE')
+    if name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        st = insert(table)
+        return st.on_conflict_do_update(
+            index_elements=keys,
+            set_=dict((c, st.excluded[c]) for c in columns if c not in keys))
+    if name == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        st = insert(table)
+        return st.on_duplicate_key_update(
+            **dict((c, st.inserted[c]) for c in columns if c not in keys))
+    return None
+
+
+def _do_bulk_upsert(conn, table, rows, keys, batch_size):
+    count = 0
+    for columns, batch in _batches(rows, batch_size):
+        st = _upsert_statement(conn, table, keys, columns)
+        if st is None:
+            # Delete and insert, in the same transaction.
+            delete_st = table.delete().where(and_(
+                *[table.c[k] == bindparam('_' + k) for k in keys]))
+            conn.execute(delete_st, [dict(('_' + k, row[k]) for k in keys)
+                                     for row in batch])
+            st = table.insert()
+        conn.execute(st, batch)
+        count += len(batch)
+    return count
+
+
+def bulk_upsert(table, rows, keys, engine=None, conn=None,
+                batch_size=BATCH_SIZE):
+    """Inserts or updates `rows` (a list of dictionaries keyed by column
+    names) into `table`, where `keys` are the columns of a unique index.
+    Rows must be unique on `keys`. `engine` and `conn` are as for
+    `bulk_insert`. Returns number of rows written."""
+
+    if not rows:
+        return 0
+
+    then = time.time()
+    if conn is not None:
+        count = _do_bulk_upsert(conn, table, rows, keys, batch_size)
+    else:
+        with engine.begin() as conn:
+            count = _do_bulk_upsert(conn, table, rows, keys, batch_size)
+    elapsed = time.time() - then
+
+    module_logger.info("Upserted %d rows into %s in %.3fs (%.0f rows/s)",
+                       count, table.name, elapsed,
+                       count / elapsed if elapsed else float(count))
+    return count
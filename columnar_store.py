@@ -0,0 +1,283 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+#pylint: disable-msg=broad-except
+"""
+A columnar on-disk store (Parquet) for the NSE equities historical data, as an
+alternative to reading rows out of the `nse_equities_hist_data` table.
+
+Data is partitioned by symbol and year (hive style, so any Parquet reader can
+discover the partitions) -
+
+    <root>/symbol=<SYMBOL>/year=<YYYY>/data.parquet
+
+Every partition file has date and OHLCVD columns sorted by date. New data
+(eg. a day's bhavcopy) is queued using `append_batch` and merged into the
+partitions on `flush`, rows for an existing date are replaced.
+
+Reads support column projection and date range predicates, which are pushed
+down to the partitions (years outside the range are never opened) and to the
+row groups.
+
+Requires `pyarrow`.
+"""
+
+import os
+import sys
+import tempfile
+from datetime import date as ddate
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from tickerplot.utils.logger import get_logger
+module_logger = get_logger(os.path.basename(__file__))
+
+FIELDS = ['open', 'high', 'low', 'close', 'volume', 'delivery']
+
+_PART_FILE = 'data.parquet'
+
+
+def _schema():
+    return pa.schema([('date', pa.date32()),
+                      ('open', pa.float64()),
+                      ('high', pa.float64()),
+                      ('low', pa.float64()),
+                      ('close', pa.float64()),
+                      ('volume', pa.int64()),
+                      ('delivery', pa.int64())])
+
+
+class ColumnarStore(object):
+    """Parquet store of OHLCVD data partitioned by symbol and year."""
+
+    def __init__(self, root):
+        if pq is None:
+            raise ImportError("pyarrow is required for the columnar store.")
+        self.root = root
+        self._pending = []
+
+    def _partition_dir(self, symbol, year):
+        return os.path.join(self.root, 'symbol=%s' % symbol, 'year=%d' % year)
+
+    def symbols(self):
+        """Returns a sorted list of symbols in the store."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d.split('=', 1)[1] for d in os.listdir(self.root)
+                      if d.startswith('symbol='))
+
+    def append(self, df):
+        """Queues a 'long' DataFrame (symbol, date and OHLCVD columns) to be
+        written on `flush`."""
+        if len(df):
+            self._pending.append(df[['symbol', 'date'] + FIELDS])
+
+    def append_batch(self, date, batch):
+        """Queues a `bhavcopy_parser.BhavcopyBatch` for `date` to be written on
+        `flush`."""
+        if not batch.count:
+            return
+        o, h, l, c = batch.ohlc.T
+        self.append(pd.DataFrame({'symbol': batch.symbols,
+                                  'date': np.datetime64(date, 'D'),
+                                  'open': o, 'high': h, 'low': l, 'close': c,
+                                  'volume': batch.volume,
+                                  'delivery': batch.delivery}))
+
+    def flush(self):
+        """Merges all the queued data into the partitions. Returns number of
+        rows written."""
+        if not self._pending:
+            return 0
+
+        df = pd.concat(self._pending, ignore_index=True)
+        self._pending = []
+        df['date'] = pd.to_datetime(df['date'])
+
+        for (symbol, year), rows in df.groupby([df['symbol'],
+                                                df['date'].dt.year]):
+            self._merge_partition(symbol, year, rows[['date'] + FIELDS])
+
+        module_logger.info("Wrote %d rows to columnar store %s",
+                           len(df), self.root)
+        return len(df)
+
+    def _merge_partition(self, symbol, year, rows):
+        dirname = self._partition_dir(symbol, year)
+        path = os.path.join(dirname, _PART_FILE)
+        if os.path.exists(path):
+            old = pq.read_table(path).to_pandas()
+            old['date'] = pd.to_datetime(old['date'])
+            # Newer rows win for the same date.
+            rows = pd.concat([old, rows], ignore_index=True).\
+                drop_duplicates('date', keep='last')
+        rows = rows.sort_values('date', kind='mergesort')
+        self._write(dirname, path, rows)
+
+    @staticmethod
+    def _write(dirname, path, rows):
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        table = pa.Table.from_pandas(rows, schema=_schema(),
+                                     preserve_index=False)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        os.close(fd)
+        try:
+            pq.write_table(table, tmp_path)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def rename_symbol(self, old, new, before):
+        """Moves data of `old` symbol for dates before `before`
+        (`datetime.date`) to `new` symbol, like the name changes applied to
+        the DB."""
+        old_dir = os.path.join(self.root, 'symbol=%s' % old)
+        if not os.path.isdir(old_dir):
+            return 0
+        df = self.read(symbols=[old], to_date=before)
+        df = df[df['date'] < pd.Timestamp(before)]
+        if not len(df):
+            return 0
+
+        df['symbol'] = new
+        self.append(df)
+        self.flush()
+
+        # Whatever remains (on or after `before`) is written back.
+        for year in sorted(set(df['date'].dt.year)):
+            dirname = self._partition_dir(old, year)
+            path = os.path.join(dirname, _PART_FILE)
+            rest = pq.read_table(path, filters=[
+                ('date', '>=', before)]).to_pandas()
+            if len(rest):
+                rest['date'] = pd.to_datetime(rest['date'])
+                self._write(dirname, path, rest[['date'] + FIELDS])
+            else:
+                os.unlink(path)
+                os.rmdir(dirname)
+        if not os.listdir(old_dir):
+            os.rmdir(old_dir)
+        return len(df)
+
+    def read(self, symbols=None, columns=None, from_date=None, to_date=None):
+        """Returns a 'long' DataFrame with symbol, date and `columns` (default
+        all of OHLCVD) for `symbols` (default all), like
+        `read_sql_data.get_hist_data_as_dataframe`. `from_date` and `to_date`
+        (`datetime.date`) restrict the date range."""
+
+        columns = list(FIELDS if columns is None else columns)
+        unknown = set(columns) - set(FIELDS)
+        if unknown:
+            raise ValueError("Unknown columns: %s" % ", ".join(unknown))
+
+        empty = pd.DataFrame(columns=['symbol', 'date'] + columns)
+        if not os.path.isdir(self.root):
+            return empty
+
+        filters = []
+        if symbols is not None:
+            symbols = list(symbols)
+            if not symbols:
+                return empty
+            filters.append(('symbol', 'in', symbols))
+        if from_date is not None:
+            filters.append(('year', '>=', from_date.year))
+            filters.append(('date', '>=', from_date))
+        if to_date is not None:
+            filters.append(('year', '<=', to_date.year))
+            filters.append(('date', '<=', to_date))
+
+        table = pq.read_table(self.root, columns=['symbol', 'date'] + columns,
+                              filters=filters or None,
+                              partitioning='hive')
+        df = table.to_pandas()
+        if not len(df):
+            return empty
+        df['symbol'] = df['symbol'].astype(object)
+        df['date'] = pd.to_datetime(df['date'])
+        return df[['symbol', 'date'] + columns]
+
+
+def export_from_db(metadata, root, from_year, to_year):
+    """Writes all the data from the DB for years `from_year` to `to_year`
+    into the columnar store at `root`, a year at a time. Returns number of
+    rows written."""
+
+    from read_sql_data import get_hist_data_as_dataframe
+
+    store = ColumnarStore(root)
+    rows = 0
+    for year in range(from_year, to_year + 1):
+        store.append(get_hist_data_as_dataframe(
+            metadata=metadata, from_date=ddate(year, 1, 1),
+            to_date=ddate(year, 12, 31)))
+        rows += store.flush()
+    return rows
+
+
+def main(args):
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Exports historical data "
+                                     "from the DB to a columnar store.")
+
+    # --dbpath option
+    parser.add_argument("--dbpath",
+                        help="Database URL to be used.",
+                        dest="dbpath")
+
+    # --root option
+    parser.add_argument("--root",
+                        help="Directory of the columnar store.",
+                        required=True)
+
+    # --from-year option
+    parser.add_argument("--from-year",
+                        help="First year to export. Default is 2002.",
+                        dest="from_year",
+                        type=int,
+                        default=2002)
+
+    # --to-year option
+    parser.add_argument("--to-year",
+                        help="Last year to export. Default is this year.",
+                        dest="to_year",
+                        type=int,
+                        default=ddate.today().year)
+
+    args = parser.parse_args(args)
+
+    from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+
+    try:
+        db_meta = get_metadata(args.dbpath)
+    except Exception as e:
+        print("Not a valid DB URL: {} (Exception: {})".format(
+            args.dbpath, e))
+        return -1
+
+    if args.from_year > args.to_year:
+        print(parser.format_usage())
+        return -1
+
+    rows = export_from_db(db_meta, args.root, args.from_year, args.to_year)
+    module_logger.info("Exported %d rows to %s", rows, args.root)
+
+    return 0
+
+if __name__ == '__main__':
+
+    sys.exit(main(sys.argv[1:]))
@@ -14,21 +14,29 @@ scrip, ex_date, type(B:bonus,D:dividend,S:split), ratio, value.
 ratio < 1.0 for bonus/split, value in Rs. for div"""
 
 import os
-import re
 import time
 import random
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from datetime import datetime as dt
 
-import requests
+from sqlalchemy import Table, Column, String, Date, Float
+from sqlalchemy import Index, inspect, and_
 
 from tickerplot.nse.nse_utils import nse_get_all_stocks_list
 from tickerplot.utils.logger import get_logger
 
 from tickerplot.sql.sqlalchemy_wrapper import create_or_get_nse_corp_actions_hist_data
-from tickerplot.sql.sqlalchemy_wrapper import execute_many_insert
 from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+from tickerplot.sql.sqlalchemy_wrapper import execute_one, select_expr
+
+from async_downloader import DownloadScheduler, Endpoint, Job
+from bulk_writer import bulk_insert, bulk_upsert
+from date_parser import parse_date
+from fetch_client import get_client
+from purpose_classifier import classify as classify_purpose
+from purpose_classifier import dividend_amount
+from purpose_classifier import normalize as normalize_purpose
 
 module_logger = get_logger(os.path.basename(__file__))
 
@@ -43,59 +51,99 @@ _CorpActionAll = namedtuple('_CorpActionAll', ['sym', 'name', 'industry',
                                         'rec_date', 'bc_sdate', 'bc_edate',
                                         'nd_sdate', 'nd_edate'])
 
+# `purpose` is the normalized purpose text the action comes from, dividends
+# are told apart by it.
 CorpAction = namedtuple('CorpAction', ['sym', 'ex_date', 'action',
-                                        'ratio', 'delta'])
+                                        'ratio', 'delta', 'purpose'])
+
+_CA_BASE_URL = 'http://nseindia.com/corporates/datafiles/'
+
+# Period wide CSVs (CA_LAST_<period>.csv) used for building corp actions
+# history in bulk.
+BULK_TIME_PERIODS = ('3_MONTHS', '6_MONTHS', '1_YEAR', '2_YEARS')
+
+# All the periods having period wide CSVs.
+_TIME_PERIODS = ('15_DAYS', '3_MONTHS', '6_MONTHS', '1_YEAR', '2_YEARS')
+
+# Natural key of corp actions, having a unique index.
+_NATURAL_KEY = ('symbol', 'ex_date', 'action')
+_NATURAL_KEY_INDEX = 'ix_nse_corp_actions_natural_key'
+
+# Key of the dividends saved, see `create_or_get_nse_corp_actions_dividends`.
+_DIVIDEND_KEY = ('symbol', 'ex_date', 'purpose')
+
+# Purpose of the part of a stored dividend from before the purposes were
+# saved.
+_UNKNOWN_PURPOSE = ''
+
+# DBs (URLs) for which the unique index is checked.
+_NATURAL_KEY_CHECKED = set()
+
+# Limits for per symbol downloads.
+_SYMBOL_ENDPOINT = Endpoint(rate=0.5, concurrency=1)
+
+
+def create_or_get_nse_corp_actions_dividends(metadata=None):
+    """Creates (if required) and returns the `nse_corp_actions_dividends`
+    table. Every dividend saved, by the purpose it comes from, so the same
+    dividend downloaded again is not added to the total dividend on the ex
+    date."""
+    table_name = 'nse_corp_actions_dividends'
+    if table_name in metadata.tables:
+        return metadata.tables[table_name]
+
+    tbl = Table(table_name, metadata,
+                Column('symbol', String(64), primary_key=True),
+                Column('ex_date', Date, primary_key=True),
+                Column('purpose', String(256), primary_key=True),
+                Column('delta', Float, nullable=False))
+    tbl.create(bind=metadata.bind, checkfirst=True)
+    return tbl
+
 
+def create_or_get_nse_corp_actions_fetched(metadata=None):
+    """Creates (if required) and returns the `nse_corp_actions_fetched`
+    table. Symbols for which the corp actions history has been downloaded per
+    symbol, with the date of the download."""
+    table_name = 'nse_corp_actions_fetched'
+    if table_name in metadata.tables:
+        return metadata.tables[table_name]
+
+    tbl = Table(table_name, metadata,
+                Column('symbol', String(64), primary_key=True),
+                Column('fetched_date', Date, nullable=False))
+    tbl.create(bind=metadata.bind, checkfirst=True)
+    return tbl
+
+
+def _purpose_key(purpose):
+    """Returns the purpose text identifying a corp action. A purpose revised
+    later is the same corp action."""
+    return normalize_purpose(purpose.replace('(Purpose Revised)', ''))[:256]
 
-# Don't ask me how I got these regex, lots of trial/error
-_div_regex = re.compile(r'(?:.*?)(?P<div>(?:(?:div.*?)(\d+%)|(?:div.*?(rs\.?)?)\s*(\d+\.?\d*)))')
-_rsr_regex = re.compile(r'rs\.?')
-_num_per_r = re.compile(r'(\d+\.?\d{0,2}%?)')
-_bonus_regex = re.compile(r'bon.*?(\d+)\s*:\s*(\d)')
-_split_regex = re.compile(r'.*f(?:.*?)v.*.*?spl.*?(\d+).*?(\d+).*')
 
 def _do_process_purpose(action):
-    """ Does all the 'hard work' in processing the purpose. Returns a single
-    line of the form
+    """ Does all the 'hard work' in processing the purpose. Returns a list of
+    `CorpAction`s of the form
     symbol, ex_date(yyyy-mm-dd), purpose(d/b/s), ratio(for b/s), value(for d),
+    Dividends in the purpose (eg. final and special) are added up.
     """
     symbol = action.sym.upper()
-    purpose = action.purpose.lower()
     ex_date = action.ex_date
+    purpose = _purpose_key(action.purpose)
     fv = float(action.fv)
     actions = []
-    if purpose.find('div') >= 0:
-        #r = re.compile(r'(?:.*?)(?P<Div>(?:div.*?)?((?:(rs.*?)|(\s+))\d+\.?\d*((?:\/-)|%)?))')
-        #r = re.compile(r'(?:.*?)(?P<Div>(?:div.*?)((?:(rs\.*?)|(\s+))\d+\.?\d*(?:\/-)?)|(\d+%))')
-
-        #r = re.compile(r'(?:.*?)(?P<div>(?:(?:div.*?)(\\d+%)|(?:div.*?(rs\\.?)?)\\s*(\\d+\\.?\\d*)))')
-
-        for x in _div_regex.finditer(purpose):
-            for _, v in x.groupdict().items():
-                v = re.sub(_rsr_regex, '', v)
-                for y in _num_per_r.finditer(v):
-                    z = y.group()
-                    if z.find('%') > 0:
-                        div = float(z.replace('%', '')) * (fv/100)
-                    else:
-                        div = float(z)
-                actions.append(CorpAction(symbol, ex_date, 'D', 1.0, div))
-    if purpose.find('bon') >= 0:
-        y = _bonus_regex.search(purpose)
-        if y:
-            n, d = float(y.group(1)), float(y.group(2))
-            ratio = n / (n+d)
-            action = CorpAction(symbol, ex_date, 'B', ratio, 0.0)
-            actions.append(action)
-            module_logger.debug("CorpAction: %s", str(CorpAction))
-    if purpose.find('spl') >= 0:
-        y = _split_regex.search(purpose)
-        if y:
-            d, n = float(y.group(1)), float(y.group(2))
-            ratio = n / d
-            action = CorpAction(symbol, ex_date, 'S', ratio, 0.0)
+    dividend = None
+    for kind, ratio, value, is_pct in classify_purpose(action.purpose):
+        if kind == 'D':
+            dividend = (dividend or 0.0) + dividend_amount(value, is_pct, fv)
+        else:
+            action = CorpAction(symbol, ex_date, kind, ratio, 0.0, purpose)
             actions.append(action)
-            module_logger.debug("CorpAction: %s", str(CorpAction))
+            module_logger.debug("CorpAction: %s", str(action))
+    if dividend is not None:
+        actions.append(CorpAction(symbol, ex_date, 'D', 1.0, dividend,
+                                  purpose))
     return actions
 
 
@@ -126,52 +174,286 @@ def _process_ca_text(ca_text):
         if len(l) < len(_CorpActionAll._fields):
             module_logger.info("Not Processed: %s", l)
             continue
-        l[6] = dt.date(dt.strptime(l[6], '%d-%b-%Y'))
+        l[6] = parse_date(l[6])
         a = _CorpActionAll(*l)
         corp_actions.append(a)
     return _process_purpose(sorted(list(set(corp_actions)),
                 key=lambda x: x.ex_date))
 
+def _get_ca_text(url):
+    """Returns text of a corp action CSV, empty if it couldn't be downloaded."""
+    module_logger.info("GET: %s", url)
+    r = get_client().get(url)
+    if r.ok:
+        return r.text
+    module_logger.error("GET: %s(%d)", url, r.status_code)
+    return ''
+
 def get_corp_action_csv(sym_name=None, time_period=None):
     """
     Get's the corp action CSV for the symbol name, if sym_name is specified or
     else get's corp action CSV for the time_period specifid. If both are
     specified, get's for both.
     """
-    ca_text = ''
+    ca_texts = []
     if sym_name:
         sym_name = sym_name.upper().replace('&', '%26')
-        base = 'http://nseindia.com/corporates/datafiles/'
-        sym_part = 'CA_%s_LAST_24_MONTHS.csv' % sym_name
-        url = base + sym_part
-        module_logger.info("GET: %s", url)
-        r = requests.get(url)
-        if r.ok:
-            ca_text += r.text
-        else:
-            module_logger.error("GET: %s(%d)", url, r.status_code)
-
-        sym_part2 = 'CA_%s_MORE_THAN_24_MONTHS.csv' % sym_name
-        url = base + sym_part2
-        module_logger.info("GET: %s", url)
-        r = requests.get(url)
-        if r.ok:
-            ca_text += r.text
-        else:
-            module_logger.error("GET: %s(%d)", url, r.status_code)
+        ca_texts.append(_get_ca_text(
+            _CA_BASE_URL + 'CA_%s_LAST_24_MONTHS.csv' % sym_name))
+        ca_texts.append(_get_ca_text(
+            _CA_BASE_URL + 'CA_%s_MORE_THAN_24_MONTHS.csv' % sym_name))
 
     if time_period:
-        base = 'http://nseindia.com/corporates/datafiles/'
-        sym_part = 'CA_LAST_%s.csv' % time_period
-        url = base + sym_part
-        module_logger.info("GET: %s", url)
-        r = requests.get(url)
-        if r.ok:
-            ca_text += r.text
-        else:
-            module_logger.error("GET: %s(%d)", url, r.status_code)
+        ca_texts.append(_get_ca_text(
+            _CA_BASE_URL + 'CA_LAST_%s.csv' % time_period))
+
+    return _process_ca_text('\n'.join(ca_texts))
+
+def get_bulk_corp_actions(time_periods=BULK_TIME_PERIODS):
+    """Get's the corp actions for all the symbols from the period wide CSVs
+    for `time_periods`. Files for overlapping periods are processed together,
+    so the actions are not repeated."""
+    return _process_ca_text('\n'.join(
+        _get_ca_text(_CA_BASE_URL + 'CA_LAST_%s.csv' % p)
+        for p in time_periods))
+
+def time_period_since(from_date):
+    """Returns the time period (as used by `get_corp_action_csv`) that covers
+    all the corp actions since `from_date`, None if `from_date` is in the
+    future."""
+    today = dt.date(dt.now())
+    td = today - from_date
+    if td.days < 0:
+        return None
+    if td.days < 15:
+        return '15_DAYS'
+    return '3_MONTHS'
+
+def _unique_dividends(rows):
+    """Returns the dividend rows (dictionaries) having a 'purpose', one for
+    each (symbol, ex_date, purpose). A dividend with the same purpose as one
+    already seen is the same dividend repeated (eg. in both the per symbol and
+    the period CSVs), the last one wins."""
+    dividends = OrderedDict()
+    for row in rows:
+        if row['action'] == 'D':
+            dividends[tuple(row[k] for k in _DIVIDEND_KEY)] = row
+    return list(dividends.values())
+
+def _merge_corp_actions(rows):
+    """Merges rows (dictionaries) having the same natural key. Dividends on
+    the same ex date (eg. interim and special) are added up, for others the
+    last one wins. If the rows have a 'purpose', dividends are added up once
+    per purpose (see `_unique_dividends`) and the 'purpose' is dropped."""
+    rows = list(rows)
+    if rows and 'purpose' in rows[0]:
+        rows = [r for r in rows if r['action'] != 'D'] + \
+            _unique_dividends(rows)
+    merged = OrderedDict()
+    for row in rows:
+        row = dict((k, v) for k, v in row.items() if k != 'purpose')
+        key = tuple(row[k] for k in _NATURAL_KEY)
+        old = merged.get(key)
+        if row['action'] == 'D' and old is not None:
+            row['delta'] += old['delta']
+        merged[key] = row
+    return list(merged.values())
+
+def compact_corp_actions(db_meta):
+    """Removes duplicate corp actions from the DB, merging actions having the
+    same natural key. Returns a tuple of (rows before, rows after)."""
+
+    tbl = create_or_get_nse_corp_actions_hist_data(metadata=db_meta)
+    columns = ['symbol', 'ex_date', 'action', 'ratio', 'delta']
+
+    with db_meta.bind.begin() as conn:
+        result = conn.execute(select_expr([tbl.c[c] for c in columns]))
+        rows = [tuple(r) for r in result.fetchall()]
+        result.close()
 
-    return _process_ca_text(ca_text)
+        # Exact duplicates are the result of the same action being saved
+        # again, so they are not added up.
+        unique_rows = list(OrderedDict.fromkeys(rows))
+        merged = _merge_corp_actions(dict(zip(columns, r))
+                                     for r in unique_rows)
+
+        conn.execute(tbl.delete())
+        bulk_insert(tbl, merged, conn=conn)
+
+    module_logger.info("Compacted %d corp actions to %d.",
+                       len(rows), len(merged))
+    return len(rows), len(merged)
+
+def ensure_natural_key(db_meta):
+    """Creates the unique index on the natural key of corp actions if it
+    doesn't exist, compacting the table first."""
+
+    if str(db_meta.bind.url) in _NATURAL_KEY_CHECKED:
+        return
+
+    tbl = create_or_get_nse_corp_actions_hist_data(metadata=db_meta)
+    indexes = inspect(db_meta.bind).get_indexes(tbl.name)
+    if not any(ix['name'] == _NATURAL_KEY_INDEX for ix in indexes):
+        module_logger.info("Creating index %s.", _NATURAL_KEY_INDEX)
+        compact_corp_actions(db_meta)
+        Index(_NATURAL_KEY_INDEX, *[tbl.c[k] for k in _NATURAL_KEY],
+              unique=True).create(bind=db_meta.bind)
+
+    _NATURAL_KEY_CHECKED.add(str(db_meta.bind.url))
+
+def _stored_dividends(conn, db_meta, ex_dates):
+    """Returns a tuple of dictionaries (symbol, ex_date) -> {purpose: delta}
+    of the dividends saved and (symbol, ex_date) -> delta of the dividends
+    in the corp actions, for ex dates between the `ex_dates`."""
+
+    tbl = create_or_get_nse_corp_actions_hist_data(metadata=db_meta)
+    div_tbl = create_or_get_nse_corp_actions_dividends(metadata=db_meta)
+
+    first, last = min(ex_dates), max(ex_dates)
+
+    purposes = {}
+    result = conn.execute(select_expr(
+        [div_tbl.c.symbol, div_tbl.c.ex_date, div_tbl.c.purpose,
+         div_tbl.c.delta]).where(
+             and_(div_tbl.c.ex_date >= first, div_tbl.c.ex_date <= last)))
+    for symbol, ex_date, purpose, delta in result.fetchall():
+        purposes.setdefault((symbol, ex_date), {})[purpose] = delta
+    result.close()
+
+    result = conn.execute(select_expr(
+        [tbl.c.symbol, tbl.c.ex_date, tbl.c.delta]).where(
+            and_(tbl.c.action == 'D', tbl.c.ex_date >= first,
+                 tbl.c.ex_date <= last)))
+    totals = dict(((symbol, ex_date), delta)
+                  for symbol, ex_date, delta in result.fetchall())
+    result.close()
+
+    return purposes, totals
+
+def _save_dividends(conn, db_meta, rows):
+    """Saves the dividends of the `rows` (see `save_corp_actions`) by purpose
+    and returns a dictionary of (symbol, ex_date) -> the total dividend, of
+    the dividends saved earlier too.
+
+    A dividend in the corp actions with no purposes saved is from before the
+    purposes were saved, the dividends in `rows` are taken to be part of it
+    and the rest of it is saved with an unknown purpose."""
+
+    dividends = _unique_dividends(rows)
+    if not dividends:
+        return {}
+
+    purposes, totals = _stored_dividends(
+        conn, db_meta, [d['ex_date'] for d in dividends])
+
+    new = OrderedDict()
+    for d in dividends:
+        new.setdefault((d['symbol'], d['ex_date']), {})[d['purpose']] = \
+            d['delta']
+
+    save = []
+    for key, deltas in new.items():
+        if key in totals and key not in purposes:
+            rest = totals[key] - sum(deltas.values())
+            if rest > 1e-6:
+                deltas[_UNKNOWN_PURPOSE] = rest
+        purposes.setdefault(key, {}).update(deltas)
+        save.extend({'symbol': key[0], 'ex_date': key[1], 'purpose': p,
+                     'delta': delta} for p, delta in deltas.items())
+
+    div_tbl = create_or_get_nse_corp_actions_dividends(metadata=db_meta)
+    bulk_upsert(div_tbl, save, _DIVIDEND_KEY, conn=conn)
+
+    return dict((key, sum(purposes[key].values())) for key in new)
+
+def save_corp_actions(corp_actions, db_meta):
+    """Saves a list of `CorpAction` in the DB. Actions already in the DB are
+    updated, dividends not saved already are added to the dividend on the ex
+    date."""
+
+    ensure_natural_key(db_meta)
+    tbl = create_or_get_nse_corp_actions_hist_data(metadata=db_meta)
+
+    rows = []
+    for corp_action in corp_actions:
+        module_logger.debug("CorpAction :%s", str(corp_action))
+        rows.append({'symbol': corp_action.sym,
+                     'ex_date': corp_action.ex_date,
+                     'action': corp_action.action,
+                     'ratio': corp_action.ratio,
+                     'delta': corp_action.delta,
+                     'purpose': corp_action.purpose})
+
+    with db_meta.bind.begin() as conn:
+        totals = _save_dividends(conn, db_meta, rows)
+        merged = _merge_corp_actions(rows)
+        for row in merged:
+            if row['action'] == 'D':
+                row['delta'] = totals[(row['symbol'], row['ex_date'])]
+        bulk_upsert(tbl, merged, _NATURAL_KEY, conn=conn)
+
+def symbols_fetched(db_meta):
+    """Returns a set of symbols for which the corp actions history has been
+    downloaded per symbol."""
+    tbl = create_or_get_nse_corp_actions_fetched(metadata=db_meta)
+    result = execute_one(select_expr([tbl.c.symbol]), engine=db_meta.bind)
+    symbols = set(row[0] for row in result.fetchall())
+    result.close()
+    return symbols
+
+def mark_fetched(db_meta, symbols):
+    """Records that the corp actions history of the `symbols` has been
+    downloaded per symbol (today)."""
+    tbl = create_or_get_nse_corp_actions_fetched(metadata=db_meta)
+    today = dt.date(dt.now())
+    bulk_upsert(tbl, [{'symbol': s.upper(), 'fetched_date': today}
+                      for s in set(symbols)], ('symbol',),
+                engine=db_meta.bind)
+
+def bulk_download(db_meta, symbols, time_periods=BULK_TIME_PERIODS):
+    """Builds the corp actions history using the period wide CSVs and saves
+    it in the DB. The period CSVs go back only as far as the longest of the
+    `time_periods`, so corp actions are then downloaded per symbol for the
+    `symbols` not downloaded per symbol before (see `symbols_fetched`), once
+    for every symbol. Returns a list of symbols for which per symbol download
+    was tried."""
+
+    save_corp_actions(get_bulk_corp_actions(time_periods), db_meta)
+
+    fetched = symbols_fetched(db_meta)
+    missing = [s for s in symbols if s.upper() not in fetched]
+    module_logger.info("%d of %d symbols not downloaded per symbol yet, "
+                       "downloading them.", len(missing), len(symbols))
+    if missing:
+        scheduler = DownloadScheduler({'nse_corp_actions': _SYMBOL_ENDPOINT},
+                                      workers=1)
+        scheduler.run(corp_action_jobs(db_meta, 'nse_corp_actions',
+                                       symbols=missing))
+    return missing
+
+def corp_action_jobs(db_meta, endpoint, symbols=None, time_period=None):
+    """Returns a list of `async_downloader.Job`, one for each of the `symbols`
+    and one for the `time_period` (if given). Corp actions are saved as soon
+    as they are downloaded, symbols are marked as downloaded (see
+    `mark_fetched`) after that."""
+
+    on_done = lambda r: save_corp_actions(r.result, db_meta)
+
+    def on_symbol_done(sym):
+        def _on_done(r):
+            on_done(r)
+            mark_fetched(db_meta, [sym])
+        return _on_done
+
+    jobs = []
+    for sym in symbols or []:
+        jobs.append(Job('corp actions %s' % sym, endpoint,
+                        get_corp_action_csv, (sym,), on_symbol_done(sym),
+                        tokens=2))
+    if time_period:
+        jobs.append(Job('corp actions %s' % time_period, endpoint,
+                        get_corp_action_csv, (None, time_period), on_done))
+    return jobs
 
 def main(args):
 
@@ -185,12 +467,30 @@ def main(args):
                         dest="all_stocks",
                         action="store_true")
 
+    group.add_argument("--compact",
+                        help="Remove duplicate corp actions from the DB. "
+                            "Usually you'd have to do it only once.",
+                        action="store_true")
+
     group.add_argument("--from",
                         help="Download data from this data. Date Format "
                             "'DD-MM-YYYY'.",
                         dest="from_date")
 
 
+    # --bulk option
+    parser.add_argument("--bulk",
+                        help="With --all, use the period wide CSVs and "
+                        "download per symbol only for symbols not downloaded "
+                        "per symbol before.",
+                        action="store_true")
+
+    # --periods option
+    parser.add_argument("--periods",
+                        help="Comma separated periods used by --bulk. "
+                        "Default is %s." % ",".join(BULK_TIME_PERIODS),
+                        default=",".join(BULK_TIME_PERIODS))
+
     # --dbpath option
     parser.add_argument("--dbpath",
                         help="Database URL to be used.",
@@ -198,6 +498,10 @@ def main(args):
 
     args, unprocessed = parser.parse_known_args()
 
+    if args.bulk and not args.all_stocks:
+        print("--bulk can only be used with --all.")
+        return -1
+
     # Make sure we can access the DB path if specified or else exit right here.
     if args.dbpath:
         try:
@@ -207,7 +511,25 @@ def main(args):
                                                             args.dbpath, e))
             return -1
 
+    if args.compact:
+        compact_corp_actions(db_meta)
+        ensure_natural_key(db_meta)
+        return 0
+
+    if args.bulk:
+        periods = [p for p in args.periods.split(',') if p]
+        unknown = [p for p in periods if p not in _TIME_PERIODS]
+        if unknown or not periods:
+            print("Unknown periods: %s (Known: %s)" % (
+                ",".join(unknown), ",".join(_TIME_PERIODS)))
+            return -1
+        symbols = [x.symbol for x in nse_get_all_stocks_list()]
+        bulk_download(db_meta, symbols, periods)
+        get_client().log_stats()
+        return 0
+
     all_corp_actions = []
+    fetched = []
     if args.all_stocks:
         unprocessed = (x.symbol for x in nse_get_all_stocks_list())
 
@@ -220,19 +542,16 @@ def main(args):
             module_logger.exception(e)
             continue
         all_corp_actions.extend(corp_actions)
+        fetched.append(stock)
 
     if args.from_date:
         try:
             from_date = dt.date(dt.strptime(args.from_date, '%d-%m-%Y'))
-            today = dt.date(dt.now())
-            td = today - from_date
-            if td.days < 0:
+            time_period = time_period_since(from_date)
+            if time_period is None:
                 print("From date cannot be greater than today.")
                 return -1
-            if td.days < 15:
-                corp_actions = get_corp_action_csv(time_period='15_DAYS')
-            else:
-                corp_actions = get_corp_action_csv(time_period='3_MONTHS')
+            corp_actions = get_corp_action_csv(time_period=time_period)
 
             all_corp_actions.extend(corp_actions)
 
@@ -240,23 +559,10 @@ def main(args):
             print("Date '{}' in unsupported format".format(args.from_date))
             return -1
 
-    tbl = create_or_get_nse_corp_actions_hist_data(metadata=db_meta)
+    save_corp_actions(all_corp_actions, db_meta)
+    mark_fetched(db_meta, fetched)
 
-    all_insert_statements = []
-    for corp_action in all_corp_actions:
-        module_logger.debug("CorpAction :%s", str(corp_action))
-        insert_st = tbl.insert().values(symbol=corp_action.sym,
-                                        ex_date=corp_action.ex_date,
-                                        action=corp_action.action,
-                                        ratio=corp_action.ratio,
-                                        delta=corp_action.delta)
-        all_insert_statements.append(insert_st)
-        module_logger.debug("insert_st : %s", insert_st.compile().params)
-
-    results = execute_many_insert(all_insert_statements,
-                                    engine=db_meta.bind)
-    for result in results:
-        result.close()
+    get_client().log_stats()
 
     return 0
 
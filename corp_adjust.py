@@ -0,0 +1,155 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+"""
+Adjusts historical prices and volumes for bonus issues and splits.
+
+For every symbol, an adjustment factor for each date is the product of the
+ratios (< 1.0, see `corp_actions_nse`) of all the bonus/split actions with an
+ex date after that date. Factors for all the symbols are computed together,
+as a single reverse cumulative product over a (symbols x dates) matrix of
+ratios, and then applied to an `OHLCVDArray` with broadcasting - prices are
+multiplied by the factor and volumes divided by it.
+
+`AdjustmentFactors` caches the factors, and recomputes them only when the
+corp actions in the DB change.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import func
+
+from tickerplot.sql.sqlalchemy_wrapper import create_or_get_nse_corp_actions_hist_data
+from tickerplot.sql.sqlalchemy_wrapper import execute_one, select_expr
+
+from ohlcvd_array import OHLCVDArray
+
+from tickerplot.utils.logger import get_logger
+module_logger = get_logger(os.path.basename(__file__))
+
+# Actions that change the number of shares.
+ADJUSTED_ACTIONS = ('B', 'S')
+
+_PRICE_FIELDS = slice(0, 4)
+_VOLUME_FIELDS = slice(4, 6)
+
+
+def actions_frame(corp_actions):
+    """Returns a DataFrame (symbol, ex_date, action, ratio) from a list of
+    `corp_actions_nse.CorpAction`s."""
+    return pd.DataFrame([(a.sym, a.ex_date, a.action, a.ratio)
+                         for a in corp_actions],
+                        columns=['symbol', 'ex_date', 'action', 'ratio'])
+
+
+def load_actions(metadata):
+    """Returns a DataFrame (symbol, ex_date, action, ratio) of all bonus and
+    split actions in the DB."""
+
+    corp_actions = create_or_get_nse_corp_actions_hist_data(metadata=metadata)
+    sel = select_expr([corp_actions.c.symbol, corp_actions.c.ex_date,
+                       corp_actions.c.action, corp_actions.c.ratio]).\
+        where(corp_actions.c.action.in_(ADJUSTED_ACTIONS))
+
+    result = execute_one(sel, engine=metadata.bind)
+    rows = result.fetchall()
+    result.close()
+    return pd.DataFrame([tuple(r) for r in rows],
+                        columns=['symbol', 'ex_date', 'action', 'ratio'])
+
+
+def adjustment_factors(actions, symbols, dates):
+    """Returns a (symbols x dates) float64 array of adjustment factors for
+    `actions` (as returned by `load_actions`). `dates` must be sorted.
+    Actions for symbols not in `symbols` are ignored."""
+
+    symbols = np.asarray(symbols, dtype=object)
+    dates = np.asarray(dates, dtype='datetime64[D]')
+
+    # ratios[s, i] is the product of ratios of actions for symbol s that
+    # are effective from dates[i] (first date on or after the ex date).
+    # Column len(dates) is for actions after the last date.
+    ratios = np.ones((len(symbols), len(dates) + 1), dtype=np.float64)
+
+    actions = actions[actions['action'].isin(ADJUSTED_ACTIONS)]
+    if len(actions) and len(symbols):
+        sym_index = pd.Index(symbols).get_indexer(actions['symbol'].values)
+        r = actions['ratio'].values.astype(np.float64)
+        valid = (sym_index >= 0) & (r > 0) & np.isfinite(r)
+        if not valid.all():
+            module_logger.debug("Ignoring %d corp actions.",
+                                (~valid).sum())
+        ex_dates = pd.to_datetime(actions['ex_date'].values[valid]).\
+            values.astype('datetime64[D]')
+        np.multiply.at(ratios, (sym_index[valid],
+                                np.searchsorted(dates, ex_dates)),
+                       r[valid])
+
+    # factor[:, j] = product of ratios[:, j+1:]
+    return np.cumprod(ratios[:, :0:-1], axis=1)[:, ::-1].copy()
+
+
+def apply_factors(arr, factors):
+    """Returns a new `OHLCVDArray` with the `factors` (symbols x dates)
+    applied to `arr`."""
+
+    data = arr.data.copy()
+    data[:, :, _PRICE_FIELDS] *= factors[:, :, np.newaxis]
+    data[:, :, _VOLUME_FIELDS] /= factors[:, :, np.newaxis]
+    return OHLCVDArray(arr.symbols, arr.dates, data, mask=arr.mask)
+
+
+class AdjustmentFactors(object):
+    """Adjustment factors for the corp actions in the DB. Factors are cached
+    per (symbols, dates) and recomputed only when the corp actions change."""
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self._signature = None
+        self._actions = None
+        self._factors = {}
+
+    def _current_signature(self):
+        corp_actions = create_or_get_nse_corp_actions_hist_data(
+            metadata=self.metadata)
+        sel = select_expr([func.count(), func.max(corp_actions.c.ex_date),
+                           func.sum(corp_actions.c.ratio)]).\
+            where(corp_actions.c.action.in_(ADJUSTED_ACTIONS))
+        result = execute_one(sel, engine=self.metadata.bind)
+        signature = tuple(result.fetchone())
+        result.close()
+        return signature
+
+    def invalidate(self):
+        """Drops all the cached factors."""
+        self._signature = None
+        self._actions = None
+        self._factors = {}
+
+    def actions(self):
+        """Returns the corp actions, reloading them if they have changed."""
+        signature = self._current_signature()
+        if signature != self._signature:
+            module_logger.info("Corp actions changed, reloading.")
+            self.invalidate()
+            self._actions = load_actions(self.metadata)
+            self._signature = signature
+        return self._actions
+
+    def factors(self, symbols, dates):
+        """Returns (symbols x dates) adjustment factors."""
+        actions = self.actions()
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        key = (tuple(symbols), dates.tobytes())
+        factors = self._factors.get(key)
+        if factors is None:
+            factors = adjustment_factors(actions, symbols, dates)
+            self._factors[key] = factors
+        return factors
+
+    def adjust(self, arr):
+        """Returns a new, adjusted `OHLCVDArray` for `arr`."""
+        return apply_factors(arr, self.factors(arr.symbols, arr.dates))
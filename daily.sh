@@ -38,27 +38,15 @@ echo $VENV_PYTHON
 
 from_date=`date --date='2 weeks ago' +%d-%m-%Y`
 
-# 1. Download historical data for last 2 weeks (name changes get applied)
+# 1. Download stocks, indices and Bonus/Split data for last 2 weeks together
+#    and then apply name changes. Only trading days are requested, see
+#    trading_calendar.py
 
-$VENV_PYTHON get_stocks_nse.py --yes --from $from_date --dbpath ${DB_PATH} || {
-		echo "Error downloading all stocks historical data.";
+$VENV_PYTHON daily_download.py --from $from_date --dbpath ${DB_PATH} || {
+		echo "Error downloading daily data.";
 		exit -1;
 	}
 
-# 2. Bonus splits data
-
-$VENV_PYTHON corp_actions_nse.py --from $from_date --dbpath ${DB_PATH} || {
-		echo "Error downloading corp actions data.";
-		exit -2;
-	}
-
-# 3. Indices data
-
-$VENV_PYTHON get_indices_nse.py --all --yes --from $from_date --dbpath ${DB_PATH} || {
-		echo "Downloading Indices data.";
-		exit -3;
-	}
-
 echo << EOF
 
 Following data was downloaded.
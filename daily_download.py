@@ -0,0 +1,163 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+#pylint: disable-msg=broad-except
+"""
+Runs all the daily downloads (bhavcopies, indices and corp actions) together
+using a single `async_downloader.DownloadScheduler`, so that the downloads
+for different endpoints overlap while each endpoint is still accessed within
+polite limits. After all the downloads are done, symbol name changes are
+applied.
+"""
+
+import os
+import sys
+from datetime import datetime as dt
+from datetime import timedelta as td
+
+from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+
+from async_downloader import DownloadScheduler, Endpoint
+from columnar_store import ColumnarStore
+from fetch_client import get_client
+from trading_calendar import get_trading_days
+import sqlite_profile
+
+import get_stocks_nse
+import get_indices_nse
+import corp_actions_nse
+
+from tickerplot.utils.logger import get_logger
+module_logger = get_logger(os.path.basename(__file__))
+
+_DATE_FMT = '%d-%m-%Y'
+
+# Default number of days for which data is downloaded.
+_DEFAULT_DAYS = 14
+
+ENDPOINTS = {
+    'nse_bhavcopy': Endpoint(rate=1.0, concurrency=4),
+    'nse_indices': Endpoint(rate=0.5, concurrency=2),
+    'nse_corp_actions': Endpoint(rate=0.5, concurrency=1),
+}
+
+
+def daily_download(db_meta, from_date, to_date, workers=8):
+    """Downloads all the data between `from_date` and `to_date`
+    (`datetime.date`) and saves it in the DB. Returns a list of
+    `async_downloader.JobResult`."""
+
+    get_stocks_nse.set_db_metadata(db_meta)
+
+    dates = get_trading_days(from_date, to_date, metadata=db_meta)
+    jobs, bhav_writer = get_stocks_nse.bhavcopy_jobs(dates, 'nse_bhavcopy')
+
+    jobs.extend(get_indices_nse.index_jobs(
+        get_indices_nse.supported_indices(), db_meta, 'nse_indices',
+        from_date.strftime(_DATE_FMT), to_date.strftime(_DATE_FMT),
+        resume=True))
+
+    time_period = corp_actions_nse.time_period_since(from_date)
+    if time_period:
+        jobs.extend(corp_actions_nse.corp_action_jobs(
+            db_meta, 'nse_corp_actions', time_period=time_period))
+
+    scheduler = DownloadScheduler(ENDPOINTS, workers=workers)
+    try:
+        results = scheduler.run(jobs)
+    finally:
+        bhav_writer.flush()
+
+    module_logger.info("Saved bhavcopy data for %d days", bhav_writer.saved)
+    return results
+
+
+def main(args):
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    # --from option
+    parser.add_argument("--from",
+                        help="From Date in DD-MM-YYYY format. "
+                        "Default is %d days ago." % _DEFAULT_DAYS,
+                        dest='fromdate')
+
+    # --to option
+    parser.add_argument("--to",
+                        help="To Date in DD-MM-YYYY format. Default is Today.",
+                        dest='todate',
+                        default="today")
+
+    # --workers option
+    parser.add_argument("--workers",
+                        help="Number of concurrent downloads.",
+                        type=int,
+                        default=8)
+
+    # --columnar option
+    parser.add_argument("--columnar",
+                        help="Directory of a columnar (Parquet) store, to "
+                        "which the bhavcopy data is also written.",
+                        dest="columnar")
+
+    # --sqlite-profile option
+    parser.add_argument("--sqlite-profile",
+                        help="Use the SQLite performance profile (WAL, "
+                        "tuned pragmas and grouped commits).",
+                        dest="sqlite_profile",
+                        action="store_true")
+
+    # --dbpath option
+    parser.add_argument("--dbpath",
+                        help="Database URL to be used.",
+                        dest="dbpath")
+
+    args = parser.parse_args()
+
+    try:
+        db_meta = get_metadata(args.dbpath)
+    except Exception as e:
+        print("Not a valid DB URL: {} (Exception: {})".format(
+            args.dbpath, e))
+        return -1
+
+    try:
+        if args.todate.lower() == 'today':
+            to_date = dt.date(dt.now())
+        else:
+            to_date = dt.date(dt.strptime(args.todate, _DATE_FMT))
+        if args.fromdate:
+            from_date = dt.date(dt.strptime(args.fromdate, _DATE_FMT))
+        else:
+            from_date = to_date - td(days=_DEFAULT_DAYS)
+    except ValueError:
+        print(parser.format_usage())
+        return -1
+
+    if from_date > to_date or args.workers < 1:
+        print(parser.format_usage())
+        return -1
+
+    if args.sqlite_profile:
+        sqlite_profile.enable(db_meta)
+
+    if args.columnar:
+        try:
+            get_stocks_nse.set_columnar_store(ColumnarStore(args.columnar))
+        except ImportError as e:
+            print(e)
+            return -1
+
+    daily_download(db_meta, from_date, to_date, workers=args.workers)
+
+    if not get_stocks_nse.apply_name_changes(since=from_date):
+        return -1
+
+    get_client().log_stats()
+
+    return 0
+
+if __name__ == '__main__':
+
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,34 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+"""
+Memoized parsing of the date strings in the files and lists from NSE/BSE.
+
+The same few thousand dates (listing dates, ex dates, dates of name changes)
+are repeated over and over in these, so every distinct (string, format) is
+parsed by `strptime` only once.
+"""
+
+from datetime import datetime as dt
+from functools import lru_cache
+
+# Format of dates in NSE lists and corp actions eg. 01-Jan-2010
+NSE_DATE_FMT = '%d-%b-%Y'
+
+# Size of the memo of (string, format) -> date.
+MEMO_SIZE = 16384
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def parse_date(date_str, fmt=NSE_DATE_FMT):
+    """Returns `datetime.date` for the `date_str` in `fmt`. Raises ValueError
+    like `strptime`."""
+    return dt.date(dt.strptime(date_str, fmt))
+
+
+def clear_memo():
+    parse_date.cache_clear()
+
+
+def memo_info():
+    return parse_date.cache_info()
@@ -0,0 +1,208 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+#pylint: disable-msg=global-statement
+"""
+HTTP client shared by all the downloaders.
+
+ - Uses a single `requests.Session`, so connections (and TLS handshakes) are
+   reused across requests.
+ - Limits number of concurrent requests to any given host.
+ - Retries idempotent requests (eg. GET, not POST unless asked for) on
+   timeouts, connection errors and 5xx (and 429) responses with exponential
+   backoff and jitter.
+ - Remembers ETag/Last-Modified of responses and revalidates them using
+   conditional GETs, so unchanged files are not downloaded again.
+ - Maintains per host counters for requests, retries, bytes and latency.
+"""
+
+import os
+import time
+import random
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tickerplot.utils.logger import get_logger
+module_logger = get_logger(os.path.basename(__file__))
+
+_RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# Methods that are safe to send again when we don't know whether the server
+# acted on the request.
+_IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+class FetchClient(object):
+    """A pooled keep-alive HTTP client with retries and revalidation."""
+
+    def __init__(self, max_per_host=4, retries=4, backoff=1.0,
+                 max_backoff=60.0, timeout=30.0, cache_size=256):
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.cache_size = cache_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max_per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._host_sems = {}
+        self._stats = {}
+        # url -> cached response, having an ETag and/or Last-Modified
+        self._cache = OrderedDict()
+
+    def _host_semaphore(self, host):
+        with self._lock:
+            sem = self._host_sems.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.max_per_host)
+                self._host_sems[host] = sem
+            return sem
+
+    def _count(self, host, **counts):
+        with self._lock:
+            stats = self._stats.setdefault(host, {'requests': 0,
+                                                  'errors': 0,
+                                                  'retries': 0,
+                                                  'not_modified': 0,
+                                                  'bytes': 0,
+                                                  'latency': 0.0})
+            for k, v in counts.items():
+                stats[k] += v
+
+    def _cached(self, url):
+        with self._lock:
+            return self._cache.get(url)
+
+    def _cache_response(self, url, response):
+        with self._lock:
+            # Re-insert so that the url becomes most recently used.
+            self._cache.pop(url, None)
+            self._cache[url] = response
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _sleep_backoff(self, attempt):
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        time.sleep(random.uniform(0, delay))
+
+    def request(self, method, url, revalidate=True, retry=None, **kwargs):
+        """Makes a request, retrying on failures. Returns the response (which
+        may still be an error response after all the retries) or raises a
+        `requests.RequestException` if no response could be obtained.
+
+        Only idempotent methods are retried, unless `retry` is True (eg. for
+        a POST that only queries data). `retry` False never retries.
+
+        For GET requests (unless `revalidate` is False or response is
+        streamed), a previously seen response for the URL is revalidated and
+        returned if the server responds with '304 Not Modified'."""
+
+        host = urlparse(url).netloc
+        kwargs.setdefault('timeout', self.timeout)
+
+        if retry is None:
+            retry = method.upper() in _IDEMPOTENT_METHODS
+        retries = self.retries if retry else 0
+
+        cacheable = method == 'GET' and revalidate and \
+            not kwargs.get('stream')
+
+        cached = None
+        if cacheable:
+            cached = self._cached(url)
+            if cached is not None:
+                headers = dict(kwargs.get('headers') or {})
+                if cached.headers.get('ETag'):
+                    headers['If-None-Match'] = cached.headers['ETag']
+                if cached.headers.get('Last-Modified'):
+                    headers['If-Modified-Since'] = \
+                        cached.headers['Last-Modified']
+                kwargs['headers'] = headers
+
+        sem = self._host_semaphore(host)
+        attempt = 0
+        while True:
+            then = time.time()
+            try:
+                with sem:
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                self._count(host, requests=1, errors=1,
+                            latency=time.time() - then)
+                if attempt >= retries:
+                    raise
+                module_logger.warning("%s: %s (%s), retrying.", method, url, e)
+                self._count(host, retries=1)
+                self._sleep_backoff(attempt)
+                attempt += 1
+                continue
+
+            nbytes = 0 if kwargs.get('stream') else len(response.content)
+            self._count(host, requests=1, bytes=nbytes,
+                        latency=time.time() - then)
+
+            if response.status_code in _RETRY_STATUSES and \
+                    attempt < retries:
+                module_logger.warning("%s: %s (%d), retrying.", method, url,
+                                      response.status_code)
+                self._count(host, retries=1)
+                response.close()
+                self._sleep_backoff(attempt)
+                attempt += 1
+                continue
+            break
+
+        if response.status_code == 304 and cached is not None:
+            module_logger.debug("%s: %s not modified.", method, url)
+            self._count(host, not_modified=1)
+            return cached
+
+        if not response.ok:
+            self._count(host, errors=1)
+        elif cacheable and (response.headers.get('ETag') or
+                            response.headers.get('Last-Modified')):
+            self._cache_response(url, response)
+
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Returns a dictionary of host -> counters."""
+        with self._lock:
+            return dict((h, dict(s)) for h, s in self._stats.items())
+
+    def log_stats(self):
+        for host, s in sorted(self.stats().items()):
+            module_logger.info("%s: %d requests (%d retries, %d errors, "
+                               "%d not modified), %d bytes, %.3fs avg latency",
+                               host, s['requests'], s['retries'], s['errors'],
+                               s['not_modified'], s['bytes'],
+                               s['latency'] / s['requests']
+                               if s['requests'] else 0.0)
+
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    """Returns the `FetchClient` shared by all the downloaders."""
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = FetchClient()
+        return _CLIENT
@@ -8,15 +8,27 @@ import os
 import sys
 import time
 import random
+import threading
 from datetime import datetime as dt
 from datetime import timedelta as td
 
+from collections import namedtuple
+from datetime import date as ddate
+import queue
+
+import numpy as np
 import requests
-import bs4
+from sqlalchemy import func
 
 from tickerplot.sql.sqlalchemy_wrapper import create_or_get_nse_indices_hist_data
-from tickerplot.sql.sqlalchemy_wrapper import execute_many_insert
 from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+from tickerplot.sql.sqlalchemy_wrapper import execute_one, select_expr
+
+from async_downloader import Job
+from bulk_writer import bulk_insert
+from fetch_client import get_client
+from html_table import table_rows
+from rate_limit import TokenBucket
 
 from tickerplot.utils.logger import get_logger
 module_logger = get_logger(os.path.basename(__file__))
@@ -26,6 +38,22 @@ _MAX_DAYS = 365
 _PREF_DAYS = 100
 _DATE_FMT = '%d-%m-%Y'
 
+# Number of indices downloaded concurrently and the total requests per second
+# to NSE, when downloading indices in parallel.
+_PARALLEL_WORKERS = 4
+_PARALLEL_RATE = 1.0
+
+# Response is parsed as it's downloaded, in chunks of this size.
+_CHUNK_SIZE = 16384
+
+_MONTHS = dict((m, i + 1) for i, m in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+     'jul', 'aug', 'sep', 'oct', 'nov', 'dec']))
+
+# Data of an index for a window. dates is a datetime64[D] array and ohlc is a
+# float64 array of shape (n, 4) for open, high, low and close.
+IndexRows = namedtuple('IndexRows', ['dates', 'ohlc'])
+
 _INDICES_DICT = {
                     'NIFTY' : ('NIFTY 50', '03-11-1995'),
                     'JUNIOR' : ('NIFTY NEXT 50', '01-01-1997'),
@@ -57,21 +85,17 @@ _INDICES_DICT = {
 
                 }
 
-def download_and_save_index(idx, db_meta, start_date=None, end_date=None):
-    """
-    Returns an iterator over the rows of the data
+def supported_indices():
+    """Returns a list of all the supported indices."""
+    return list(_INDICES_DICT.keys())
 
-    The way this works is - we download data for 100 days at a time - something
-    that fits in the table and then read that table using BS4. Then collect all
-    such data and return back.
-    """
-
-    if idx not in _INDICES_DICT.keys():
-        module_logger.error("Index %s not found or not supported yet.", idx)
-        module_logger.error("supported Indices are: %s",
-                                    (", ".join(_INDICES_DICT.keys())))
-        return None
 
+def _index_windows(idx, start_date=None, end_date=None):
+    """
+    Yields (from, to) dates in DD-MM-YYYY format for windows of `_PREF_DAYS`
+    days (something that fits in the table) between `start_date` (default is
+    the first date for the index) and `end_date` (default is today).
+    """
     start_dt = start_date or _INDICES_DICT[idx][1]
     s = dt.strptime(start_dt, _DATE_FMT)
 
@@ -84,48 +108,214 @@ def download_and_save_index(idx, db_meta, start_date=None, end_date=None):
     if e2 > e:
         e2 = e
 
-    all_data = []
-    while e > s:
-        e_ = e2.strftime(_DATE_FMT)
-        s_ = s.strftime(_DATE_FMT)
-        r = _do_get_index(idx, s_, e_)
-        if r:
-            module_logger.debug("Downloaded %d records", len(r))
-            all_data.extend(r)
-        else:
-            module_logger.info("Unable to download some records for"
-                                "%s (%s-%s)", idx, s_, e_)
+    while e >= s:
+        yield s.strftime(_DATE_FMT), e2.strftime(_DATE_FMT)
 
-        time.sleep(random.randint(1,5))
         s = e2 + td(days=1)
         e2 = s + td(days=_PREF_DAYS)
         if e2 > e:
             e2 = e
 
+
+def _check_index(idx):
+    if idx not in _INDICES_DICT.keys():
+        module_logger.error("Index %s not found or not supported yet.", idx)
+        module_logger.error("supported Indices are: %s",
+                                    (", ".join(_INDICES_DICT.keys())))
+        return False
+    return True
+
+
+def save_index_rows(idx, data, db_meta):
+    """Saves `IndexRows` (as returned by `_do_get_index`) for the index in the
+    DB."""
+
+    tbl = create_or_get_nse_indices_hist_data(metadata=db_meta)
+
+    rows = [{'symbol': idx,
+             'date': d,
+             'open': o,
+             'high': h,
+             'low': l,
+             'close': c}
+            for d, (o, h, l, c) in zip(data.dates.astype(object),
+                                       data.ohlc.tolist())]
+
+    bulk_insert(tbl, rows, engine=db_meta.bind)
+
+
+def _save_job_result(result, db_meta):
+    if result.result is not None:
+        save_index_rows(result.job.args[0], result.result, db_meta)
+
+
+class _InOrderSaver(object):
+    """Saves the windows of an index downloaded concurrently in the order of
+    the windows. A window downloaded before the earlier ones is held till they
+    are saved, and nothing after a window that couldn't be downloaded is
+    saved, so the last date in the DB is always a good point to resume from."""
+
+    def __init__(self, idx, db_meta):
+        self.idx = idx
+        self.db_meta = db_meta
+        self._next = 0
+        self._held = {}
+        self._failed = False
+
+    def done(self, n, data):
+        """Called with `IndexRows` (or None) for the `n`th window."""
+        if self._failed:
+            return
+        if data is None or not len(data.dates):
+            module_logger.info("Unable to download window %d of %s, not "
+                               "saving the later windows.", n, self.idx)
+            self._failed = True
+            self._held.clear()
+            return
+        self._held[n] = data
+        while self._next in self._held:
+            save_index_rows(self.idx, self._held.pop(self._next),
+                            self.db_meta)
+            self._next += 1
+
+
+def last_index_dates(db_meta):
+    """Returns a dictionary of index -> last date (`datetime.date`) for which
+    data is available in the DB."""
+
     tbl = create_or_get_nse_indices_hist_data(metadata=db_meta)
+    sel = select_expr([tbl.c.symbol, func.max(tbl.c.date)]).\
+        group_by(tbl.c.symbol)
+    result = execute_one(sel, engine=db_meta.bind)
+    last_dates = dict((row[0], row[1]) for row in result.fetchall())
+    result.close()
+    return last_dates
+
+
+def _resume_start_date(idx, start_date, last_dates):
+    """Returns the start date (DD-MM-YYYY) after the last date for the index
+    in `last_dates`, or `start_date` if that's later."""
+
+    last = last_dates.get(idx)
+    if last is None:
+        return start_date
+    resume = (last + td(days=1)).strftime(_DATE_FMT)
+    if start_date and \
+            dt.strptime(start_date, _DATE_FMT) > dt.strptime(resume, _DATE_FMT):
+        return start_date
+    return resume
+
+
+def download_and_save_index(idx, db_meta, start_date=None, end_date=None,
+                            resume=False):
+    """
+    Downloads and saves the data for the index.
+
+    The way this works is - we download data for 100 days at a time - something
+    that fits in the table and then read that table using BS4. Data for every
+    such window is saved as soon as it's downloaded.
+
+    If `resume` is True, download starts after the last date for which the
+    data is in the DB. Windows are downloaded in order and we stop at the
+    first window that can't be downloaded, so the last date in the DB is
+    always a good point to resume from.
+    """
 
-    insert_statements = []
-    for row in all_data:
-        d = dt.date(dt.strptime(row[1].strip(), '%d-%b-%Y'))
-        o = float(row[2])
-        h = float(row[3])
-        l = float(row[4])
-        c = float(row[5])
+    if not _check_index(idx):
+        return None
+
+    if resume:
+        start_date = _resume_start_date(idx, start_date,
+                                        last_index_dates(db_meta))
+        module_logger.info("Resuming %s from %s.", idx,
+                           start_date or _INDICES_DICT[idx][1])
+
+    for s_, e_ in _index_windows(idx, start_date, end_date):
+        r = _do_get_index(idx, s_, e_)
+        if r is not None and len(r.dates):
+            module_logger.debug("Downloaded %d records", len(r.dates))
+            save_index_rows(idx, r, db_meta)
+        else:
+            module_logger.info("Unable to download some records for "
+                                "%s (%s-%s)", idx, s_, e_)
+            if resume:
+                break
+
+        time.sleep(random.randint(1,5))
 
-        insert_st = tbl.insert().values(symbol=idx,
-                                        date=d,
-                                        open=o,
-                                        high=h,
-                                        low=l,
-                                        close=c)
-        insert_statements.append(insert_st)
 
-    results = execute_many_insert(insert_statements, engine=db_meta.bind)
-    for r in results:
-        r.close()
+def index_jobs(indices, db_meta, endpoint, start_date=None, end_date=None,
+               resume=False):
+    """
+    Returns a list of `async_downloader.Job` one for every window of every
+    index. Data for a window is saved as soon as it's downloaded. If `resume`
+    is True, only windows after the last date in the DB for the index are
+    downloaded, and they are saved in order (see `_InOrderSaver`) - a window
+    that fails is downloaded again next time, not skipped.
+    """
+
+    last_dates = last_index_dates(db_meta) if resume else {}
+
+    jobs = []
+    for idx in indices:
+        idx = idx.upper()
+        if not _check_index(idx):
+            continue
+        idx_start = _resume_start_date(idx, start_date, last_dates)
+        saver = _InOrderSaver(idx, db_meta) if resume else None
+        for n, (s_, e_) in enumerate(_index_windows(idx, idx_start,
+                                                    end_date)):
+            if saver is not None:
+                on_done = lambda r, saver=saver, n=n: saver.done(n, r.result)
+            else:
+                on_done = lambda r: _save_job_result(r, db_meta)
+            jobs.append(Job('index %s (%s-%s)' % (idx, s_, e_), endpoint,
+                            _do_get_index, (idx, s_, e_), on_done))
+    return jobs
+
+
+def _parse_date(date_str):
+    """Parses a DD-Mon-YYYY date."""
+    d, m, y = date_str.split('-')
+    return ddate(int(y), _MONTHS[m.lower()], int(d))
+
+
+def parse_index_rows(rows):
+    """Returns `IndexRows` for the data rows (lists of cell texts - date,
+    open, high, low, close, ...) of the historical indices table. Rows that
+    can't be parsed are skipped."""
+
+    dates = np.empty(len(rows), dtype='datetime64[D]')
+    ohlc = np.empty((len(rows), 4), dtype=np.float64)
+    n = 0
+    for cells in rows:
+        try:
+            dates[n] = _parse_date(cells[0])
+            ohlc[n] = [float(x.replace(',', '')) for x in cells[1:5]]
+        except (ValueError, KeyError, IndexError):
+            module_logger.debug("Ignoring row: %s", cells)
+            continue
+        n += 1
+    return IndexRows(dates[:n], ohlc[:n])
+
+
+def _table_data_rows(rows):
+    """Returns the data rows of the historical indices table, None if the
+    table is not found or has no data."""
+    if not rows:
+        return None
+    if len(rows) <= 3: # Probably an error
+        module_logger.debug("fewer rows, possibly an error. %s",
+                            " ".join(rows[-1]))
+        return None
+    # First 3 rows are headers and the last one used to have a link to the
+    # CSV (which often gives 404, so we download 100 entries at a time.)
+    return rows[3:-1]
 
 
 def _do_get_index(idx, start_dt, end_dt):
+    """Downloads the data for the index between the dates and returns
+    `IndexRows`, None on errors."""
     module_logger.info("getting data for %s : from : %s to : %s",
                         idx, start_dt, end_dt)
 
@@ -137,45 +327,196 @@ def _do_get_index(idx, start_dt, end_dt):
         u = 'http://nseindia.com/products/dynaContent/equities/indices/'\
             'historicalindices.jsp?indexType=%(idxstr)s&'\
             'fromDate=%(from)s&toDate=%(to)s' % params
-        response = requests.get(u)
-        soup = bs4.BeautifulSoup(response.text, 'html.parser')
-        tbl = soup.find('table')
-        if not tbl:
-            return None
-        vals = []
-        rows = tbl.find_all('tr')
-        if len(rows) <= 3: # Probably an error
-            module_logger.debug("fewer rows, possibly an error. %s",
-                                rows[-1].text.strip())
-            return None
+        response = get_client().get(u, stream=True)
+        try:
+            if response.encoding is None:
+                response.encoding = 'utf-8'
+            rows = table_rows(response.iter_content(chunk_size=_CHUNK_SIZE,
+                                                    decode_unicode=True))
+        finally:
+            response.close()
     except requests.RequestException as e:
         module_logger.exception(e)
         return None
 
-    for i, row in enumerate(rows):
-        if i <= 2:
+    rows = _table_data_rows(rows)
+    if rows is None:
+        return None
+    return parse_index_rows(rows)
+
+
+def _parse_index_page_bs4(text):
+    """Parses a historical indices page using BeautifulSoup the way it used to
+    be done (numbers have thousands separators). Used only to check
+    `parse_index_rows`."""
+
+    import bs4
+
+    soup = bs4.BeautifulSoup(text, 'html.parser')
+    tbl = soup.find('table')
+    if not tbl:
+        return None
+    rows = tbl.find_all('tr')
+    if len(rows) <= 3:
+        return None
+
+    dates = []
+    ohlc = []
+    for row in rows[3:-1]:
+        row = [x.strip() for x in row.text.split('\n')]
+        dates.append(dt.date(dt.strptime(row[1].strip(), '%d-%b-%Y')))
+        ohlc.append([float(x.replace(',', '')) for x in row[2:6]])
+    return IndexRows(np.array(dates, dtype='datetime64[D]'),
+                     np.array(ohlc, dtype=np.float64).reshape(-1, 4))
+
+
+def check_parser(paths):
+    """Parses saved historical indices pages at `paths` with both the
+    streaming parser and BeautifulSoup. Returns a list of paths for which the
+    results differ, or BeautifulSoup couldn't parse the page."""
+
+    mismatches = []
+    for path in paths:
+        with open(path) as f:
+            text = f.read()
+        try:
+            expected = _parse_index_page_bs4(text)
+        except (ValueError, IndexError) as e:
+            module_logger.info("%s: %s", path, e)
+            mismatches.append(path)
+            continue
+        rows = _table_data_rows(table_rows(text))
+        actual = None if rows is None else parse_index_rows(rows)
+        if expected is None or actual is None:
+            same = expected is None and actual is None
+        else:
+            same = np.array_equal(expected.dates, actual.dates) and \
+                np.array_equal(expected.ohlc, actual.ohlc)
+        if not same:
+            mismatches.append(path)
+    return mismatches
+
+
+def _index_fetch_worker(indices_q, results_q, bucket, windows, resume):
+    """Fetch stage of the parallel download. Takes indices from `indices_q`
+    and puts (idx, from, to, `IndexRows` or None) on the `results_q` for every
+    window of the index in order. A `None` index tells the worker to exit,
+    which it acknowledges by putting a `None` on the `results_q`."""
+
+    while True:
+        idx = indices_q.get()
+        if idx is None:
+            results_q.put(None)
+            return
+        for s_, e_ in windows[idx]:
+            bucket.acquire()
+            try:
+                r = _do_get_index(idx, s_, e_)
+            except Exception as e:
+                module_logger.exception(e)
+                r = None
+            if r is not None and not len(r.dates):
+                r = None
+            results_q.put((idx, s_, e_, r))
+            if r is None and resume:
+                break
+
+
+def _fetch_indices_concurrently(windows, workers, rate, resume):
+    """Fetches windows (dictionary of index -> list of (from, to) dates) for
+    the indices using `workers` threads, one index per thread at a time, with
+    total requests limited to `rate` requests per second. Yields (idx, from,
+    to, `IndexRows` or None) as they are downloaded, windows of an index are
+    yielded in order."""
+
+    workers = max(1, min(workers, len(windows)))
+    module_logger.info("Downloading %d indices using %d workers at %.2f "
+                       "req/s", len(windows), workers, rate)
+
+    bucket = TokenBucket(rate, capacity=max(rate, 1))
+    indices_q = queue.Queue()
+    # Bounded so that fetchers don't run too far ahead of the DB writer.
+    results_q = queue.Queue(maxsize=2 * workers)
+
+    # Longest first, so that the slowest index starts right away.
+    for idx in sorted(windows, key=lambda i: len(windows[i]), reverse=True):
+        indices_q.put(idx)
+    for _ in range(workers):
+        indices_q.put(None)
+
+    threads = []
+    for _ in range(workers):
+        t = threading.Thread(target=_index_fetch_worker,
+                             args=(indices_q, results_q, bucket, windows,
+                                   resume))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    running = workers
+    while running:
+        result = results_q.get()
+        if result is None:
+            running -= 1
+            continue
+        yield result
+
+    for t in threads:
+        t.join()
+
+
+def get_indices_parallel(indices, db_meta, from_date=None, to_date=None,
+                         resume=False, workers=_PARALLEL_WORKERS,
+                         rate=_PARALLEL_RATE):
+    """
+    Downloads all indices given in the list in parallel, using `workers`
+    threads that share a rate limit of `rate` requests per second (instead
+    of sleeping after every window).
+
+    Only the calling thread writes to the DB, as the windows are downloaded,
+    so the DB connection is never shared between threads. Windows of an
+    index are still downloaded and saved in order, so `resume` works the same
+    way as in `download_and_save_index`.
+    """
+
+    last_dates = last_index_dates(db_meta) if resume else {}
+
+    windows = {}
+    for idx in indices:
+        idx = idx.upper()
+        if not _check_index(idx):
             continue
-        elif i == len(rows)-1:
-            pass # previously this used to give href, now we ignore this
-            # anchor = row.find('a')
-            # csv_link = anchor['href']
+        idx_start = _resume_start_date(idx, from_date, last_dates)
+        if resume:
+            module_logger.info("Resuming %s from %s.", idx,
+                               idx_start or _INDICES_DICT[idx][1])
+        windows[idx] = list(_index_windows(idx, idx_start, to_date))
+
+    windows = dict((idx, w) for idx, w in windows.items() if w)
+    if not windows:
+        return 0
+
+    for idx, s_, e_, r in _fetch_indices_concurrently(windows, workers, rate,
+                                                      resume):
+        if r is not None:
+            module_logger.debug("Downloaded %d records for %s", len(r.dates),
+                                idx)
+            save_index_rows(idx, r, db_meta)
         else:
-            vals.append([x.strip() for x in row.text.split('\n')])
-            #vals.append(map(lambda x: x.strip(),
-            #                filter(lambda x: x, row.text.split('\n'))))
-    ## Optionally get the CSV - this often gives 404, we've to find why!
-    # The CSV downloading part is unreliable - so we are just downloading
-    # 100 entries at a time
-    # print(vals)
-    return vals
-
-def get_indices(indices, db_meta, from_date=None, to_date=None):
+            module_logger.info("Unable to download some records for "
+                               "%s (%s-%s)", idx, s_, e_)
+    return 0
+
+
+def get_indices(indices, db_meta, from_date=None, to_date=None,
+                resume=False):
     """
     Downloads all indices givenin the list.
     """
     for idx in indices:
         module_logger.info("Downloading data for %s.", idx.upper())
-        download_and_save_index(idx.upper(), db_meta, from_date, to_date)
+        download_and_save_index(idx.upper(), db_meta, from_date, to_date,
+                                resume=resume)
     return 0
 
 def _format_indices():
@@ -230,6 +571,35 @@ def main(args):
                         dest="all_indices",
                         action="store_true")
 
+    # --resume option
+    parser.add_argument("--resume",
+                        help="Download only the data after the last date "
+                        "in the DB for every index.",
+                        action="store_true")
+
+    # --workers option
+    parser.add_argument("--workers",
+                        help="Number of indices downloaded concurrently "
+                        "with --all. Default is %d, 1 downloads one index "
+                        "at a time." % _PARALLEL_WORKERS,
+                        type=int,
+                        default=_PARALLEL_WORKERS)
+
+    # --rate option
+    parser.add_argument("--rate",
+                        help="Maximum requests per second with --all. "
+                        "Default is %.1f." % _PARALLEL_RATE,
+                        type=float,
+                        default=_PARALLEL_RATE)
+
+    # --check-parser option
+    parser.add_argument("--check-parser",
+                        help="Check the table parser against BeautifulSoup "
+                        "for saved historical indices pages given as "
+                        "arguments.",
+                        dest="check_parser",
+                        action="store_true")
+
     # --dbpath option
     parser.add_argument("--dbpath",
                         help="Database URL to be used.",
@@ -250,6 +620,12 @@ def main(args):
         print(_format_indices())
         return 0
 
+    if args.check_parser:
+        mismatches = check_parser(unprocessed)
+        for path in mismatches:
+            print("Mismatch: %s" % path)
+        return 1 if mismatches else 0
+
     try:
         if args.fromdate:
             from_date = dt.strptime(args.fromdate, _DATE_FMT)
@@ -280,6 +656,8 @@ def main(args):
                     sure = False
         else:
             sure = True
+    elif args.resume or args.sure:
+        sure = True
     else:
         sure = input("Downloading data from beginning for the Index. "
                      "Are you Sure?[y|N] ")
@@ -291,10 +669,21 @@ def main(args):
     if not sure:
         return 0
 
-    if args.all_indices:
-        unprocessed = _INDICES_DICT.keys()
+    if args.all_indices and args.workers > 1:
+        result = get_indices_parallel(_INDICES_DICT.keys(), db_meta,
+                                      args.fromdate, args.todate,
+                                      resume=args.resume,
+                                      workers=args.workers, rate=args.rate)
+    else:
+        if args.all_indices:
+            unprocessed = _INDICES_DICT.keys()
+
+        result = get_indices(unprocessed, db_meta, args.fromdate,
+                             args.todate, resume=args.resume)
+
+    get_client().log_stats()
 
-    return get_indices(unprocessed, db_meta, args.fromdate, args.todate)
+    return result
 
 
 if __name__ == '__main__':
@@ -7,9 +7,10 @@
 import os
 from datetime import datetime as dt
 
-import requests
 import bs4
 
+from fetch_client import get_client
+
 from tickerplot.utils.logger import get_logger
 module_logger = get_logger(os.path.basename(__file__))
 
@@ -30,7 +31,7 @@ def _do_get_data_for_security(script_code, sdate, edate):
             'StockPrcHistori.aspx?expandable=7&flag=0'
 
     module_logger.info("GET: %s", url)
-    x = requests.get(url)
+    x = get_client().get(url)
 
     html = bs4.BeautifulSoup(x.text, 'html.parser')
 
@@ -77,7 +78,7 @@ def _do_get_data_for_security(script_code, sdate, edate):
 
     module_logger.info("POST: %s", url)
     module_logger.debug("POST Data: %s", form_data)
-    y = requests.post(url, data=form_data, stream=True)
+    y = get_client().post(url, data=form_data, stream=True)
 
     if y.ok:
         start_end = "_".join([sdate.replace("/", ""),
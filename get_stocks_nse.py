@@ -17,36 +17,48 @@ import os
 import sys
 import random
 import time
+import threading
+import multiprocessing
+import queue
+from io import BytesIO as bio
 
-from zipfile import ZipFile
+from datetime import date as ddate
 from datetime import datetime as dt
 from datetime import timedelta as td
 
 import requests
-
-if sys.version_info.major < 3:
-    from StringIO import StringIO as bio
-else:
-    from io import BytesIO as bio
+from sqlalchemy import bindparam
 
 # BIG FIXME: There are sql statements littered all over the place, sqlalchemy?
 
-from tickerplot.nse.nse_utils import nse_get_name_change_tuples, ScripOHLCVD
+from tickerplot.nse.nse_utils import nse_get_name_change_tuples
 
 from tickerplot.sql.sqlalchemy_wrapper import \
     create_or_get_nse_bhav_deliv_download_info, \
     create_or_get_nse_equities_hist_data
-from tickerplot.sql.sqlalchemy_wrapper import execute_one, execute_one_insert, \
-    execute_many_insert
+from tickerplot.sql.sqlalchemy_wrapper import execute_one, execute_one_insert
 from tickerplot.sql.sqlalchemy_wrapper import and_expr, select_expr
 from tickerplot.sql.sqlalchemy_wrapper import get_metadata
 
 from tickerplot.utils.logger import get_logger
 
+from async_downloader import Job
+from bhavcopy_parser import parse_bhavcopy
+from bulk_writer import bulk_insert
+from columnar_store import ColumnarStore
+from fetch_client import get_client
+from name_changes import save_name_changes, mark_pending, \
+    apply_pending_name_changes
+from raw_archive import RawArchive
+import sqlite_profile
+import symbol_resolver
+from rate_limit import TokenBucket
+from trading_calendar import get_trading_days, NOT_FOUND_SETTLE_DAYS
+
 module_logger = get_logger(os.path.basename(__file__))
 
-_BHAV_HEADERS = {'Host': 'www.nseindia.com',
-                 'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:54.0) Gecko/20100101 Firefox/54.0',
+# Host is set from the URL (see `_NSE_BASE_URL`).
+_BHAV_HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:54.0) Gecko/20100101 Firefox/54.0',
                  'Accept': 'application/xml,application/xhtml+xml,text/html;q=0.9,text/plain;q=0.8,image/png,*/*;q=0.5',
                  'Accept-Encoding': 'gzip, deflate, br',
                  'Referer': 'https://www.nseindia.com/product/content/equities/equities/archives_eq.htm',
@@ -55,125 +67,476 @@ _BHAV_HEADERS = {'Host': 'www.nseindia.com',
 
 _DB_METADATA = None
 
+# RawArchive where all the downloaded files are stored (if specified).
+_RAW_ARCHIVE = None
+
+# ColumnarStore to which all the saved data is also written (if specified).
+_COLUMNAR_STORE = None
+
+_ARCHIVE_BHAV = 'nse_bhav'
+_ARCHIVE_DELIV = 'nse_deliv'
+
 _DATE_FMT = '%d-%m-%Y'
 
-_BHAV_URL_BASE = 'https://www.nseindia.com/content/historical/EQUITIES/' \
+# Can be pointed to a local server serving recorded files for testing.
+_NSE_BASE_URL = 'https://www.nseindia.com'
+
+_BHAV_URL_BASE = '%(base)s/content/historical/EQUITIES/' \
     '%(year)s/%(mon)s/cm%(dd)s%(mon)s%(year)sbhav.csv.zip'
 
-_DELIV_URL_BASE = 'https://www.nseindia.com/archives/equities/mto/' \
+_DELIV_URL_BASE = '%(base)s/archives/equities/mto/' \
     'MTO_%(dd)s%(mm)s%(year)s.DAT'
 
 # Warn user if number of days data is greater than this
 _WARN_DAYS = 100
 
+# Default number of fetch threads and requests per second for backfill.
+_BACKFILL_WORKERS = 4
+_BACKFILL_RATE = 1.0
 
-def get_bhavcopy(date='01-01-2002'):
-    """Downloads a bhavcopy for a given date and returns a dictionary of rows
-    where each row stands for a traded scrip. The scripname is key. If the
-    bhavcopy for a given day is already downloaded, returns None. date is in
-    DD-MM-YYYY format"""
+# Number of days for which download status is saved in one go.
+_STATUS_BATCH = 50
 
-    global _DATE_FMT
-    if isinstance(date, str):
-        d2 = dt.date(dt.strptime(date, _DATE_FMT))
-    elif isinstance(date, dt):
-        d2 = dt.date(date)
-    else:
-        return None
+
+def _bhavcopy_urls(d2):
+    """Returns a tuple of (bhavcopy url, delivery url) for a given date."""
     yr = d2.strftime('%Y')
     mon = d2.strftime('%b').upper()
     mm = d2.strftime('%0m')
     dd = d2.strftime('%0d')
 
-    if _bhavcopy_downloaded(d2):  # already downloaded
-        return None
+    bhav_url = _BHAV_URL_BASE % ({'base': _NSE_BASE_URL,
+                                  'year': yr, 'mon': mon, 'dd': dd})
+    deliv_url = _DELIV_URL_BASE % ({'base': _NSE_BASE_URL,
+                                    'year': yr, 'mm': mm, 'dd': dd})
+    return bhav_url, deliv_url
 
-    global _BHAV_URL_BASE
-    global _DELIV_URL_BASE
 
-    bhav_url = _BHAV_URL_BASE % ({'year': yr, 'mon': mon, 'dd': dd})
-    deliv_url = _DELIV_URL_BASE % ({'year': yr, 'mm': mm, 'dd': dd})
+def _fetch_bhavcopy(d2):
+    """Downloads the bhavcopy and delivery data for a given date. Returns a
+    tuple of (bhavcopy response, delivery response) or None if there was an
+    error in making requests. Does not touch the DB, so it is safe to call this
+    from any thread."""
 
+    bhav_url, deliv_url = _bhavcopy_urls(d2)
 
     try:
-        bhavcopy_response = requests.get(bhav_url, headers=_BHAV_HEADERS)
+        # Every file is downloaded only once, nothing to revalidate.
+        client = get_client()
+        bhavcopy_response = client.get(bhav_url, headers=_BHAV_HEADERS,
+                                       revalidate=False)
         module_logger.info("GET:Bhavcopy URL: %s", bhav_url)
 
-        delivery_response = requests.get(deliv_url, headers=_BHAV_HEADERS)
+        delivery_response = client.get(deliv_url, headers=_BHAV_HEADERS,
+                                       revalidate=False)
         module_logger.info("GET:Delivery URL: %s", deliv_url)
     except requests.RequestException as e:
         module_logger.exception(e)
-        # We don't update bhav_deliv_downloaded here
         return None
 
-    stocks_dict = {}
+    return bhavcopy_response, delivery_response
 
+
+def _download_error_code(bhavcopy_response, delivery_response):
+    """Returns the error_type to be recorded for the download."""
     # We do all of the following to avoid - network calls
     error_code = None
-    if bhavcopy_response.status_code == 404 or delivery_response.status_code == 404:
+    if bhavcopy_response.status_code == 404 or \
+            delivery_response.status_code == 404:
         error_code = 'NOT_FOUND'
     else:
         if not (bhavcopy_response.ok and delivery_response.ok):
             error_code = 'DLOAD_ERR'
+    return error_code
+
+
+def _process_bhavcopy_responses(d2, bhavcopy_response, delivery_response):
+    """Returns a tuple of (`BhavcopyBatch`, download status). Batch is None
+    unless both the downloads were successful. Download status is a tuple of
+    (date, bhav_ok, deliv_ok, error_code) to be saved in the download info
+    table."""
+
+    error_code = _download_error_code(bhavcopy_response, delivery_response)
+    status = (d2, bhavcopy_response.ok, delivery_response.ok, error_code)
 
-    _update_dload_success(d2, bhavcopy_response.ok,
-                          delivery_response.ok, error_code)
+    if _RAW_ARCHIVE is not None:
+        if bhavcopy_response.ok:
+            _RAW_ARCHIVE.put(_ARCHIVE_BHAV, d2, bhavcopy_response.content)
+        if delivery_response.ok:
+            _RAW_ARCHIVE.put(_ARCHIVE_DELIV, d2, delivery_response.content)
 
     if bhavcopy_response.ok and delivery_response.ok:
-        bhavs = ZipFile(bio(bhavcopy_response.content))
-        for name in bhavs.namelist():
-            csv_name = name
-        delivery = bio(delivery_response.content)
-        with bhavs.open(csv_name) as bhav:
-            i = 0
-            for line in bhav:
-                if i == 0:
-                    i += 1
-                    continue
-                line = line.decode()
-                l = line.split(',')
-                if l[1] not in ['EQ', 'BE', 'BZ']:
-                    continue
-                sym, o, h, l, c, v, d = l[0], l[2], l[3], l[4], \
-                    l[5], l[8], l[8]
-                stocks_dict[sym] = [float(o), float(h), float(l), float(c),
-                                    int(v), int(d)]
-
-        i = 0
-        for line in delivery:
-            line = line.decode()
-            if not line.startswith('20'):
-                i += 1
+        return parse_bhavcopy(bio(bhavcopy_response.content),
+                              bio(delivery_response.content),
+                              logger=module_logger), status
+
+    if not bhavcopy_response.ok:
+        module_logger.error("GET:Bhavcopy URL %s (%d)",
+                            bhavcopy_response.url,
+                            bhavcopy_response.status_code)
+    if not delivery_response.ok:
+        module_logger.error("GET:Delivery URL %s (%d)",
+                            delivery_response.url,
+                            delivery_response.status_code)
+    return None, status
+
+
+def _to_date(date):
+    """Returns a `datetime.date` for a date in DD-MM-YYYY format, a datetime or
+    a date, None otherwise."""
+    if isinstance(date, str):
+        return dt.date(dt.strptime(date, _DATE_FMT))
+    elif isinstance(date, dt):
+        return dt.date(date)
+    elif isinstance(date, ddate):
+        return date
+    return None
+
+
+def get_bhavcopy(date='01-01-2002'):
+    """Downloads a bhavcopy for a given date and returns a `BhavcopyBatch`
+    with data for all the traded scrips. If the bhavcopy for a given day is
+    already downloaded, returns None. date is in DD-MM-YYYY format"""
+
+    d2 = _to_date(date)
+    if d2 is None:
+        return None
+
+    if _bhavcopy_downloaded(d2):  # already downloaded
+        return None
+
+    responses = _fetch_bhavcopy(d2)
+    if responses is None:
+        # We don't update bhav_deliv_downloaded here
+        return None
+
+    batch, status = _process_bhavcopy_responses(d2, *responses)
+    _update_dload_success(*status)
+
+    return batch
+
+
+def _backfill_fetch_worker(dates_q, results_q, bucket):
+    """Fetch stage of the backfill. Takes dates from `dates_q` and puts
+    (date, responses) on the `results_q`. A `None` date tells the worker to
+    exit, which it acknowledges by putting a `None` on the `results_q`."""
+
+    while True:
+        d2 = dates_q.get()
+        if d2 is None:
+            results_q.put(None)
+            return
+        # Each date costs us two requests (bhavcopy and delivery)
+        bucket.acquire(2)
+        try:
+            responses = _fetch_bhavcopy(d2)
+        except Exception as e:
+            module_logger.exception(e)
+            responses = None
+        results_q.put((d2, responses))
+
+
+def _fetch_concurrently(dates, workers, rate):
+    """Fetches bhavcopies for `dates` using `workers` threads, with total
+    requests limited to `rate` requests per second. Yields (date, responses)
+    in the order they are downloaded."""
+
+    workers = max(1, min(workers, len(dates)))
+    module_logger.info("Backfilling %d days using %d workers at %.2f req/s",
+                       len(dates), workers, rate)
+
+    bucket = TokenBucket(rate, capacity=max(rate, 2))
+    dates_q = queue.Queue()
+    # Bounded so that fetchers don't run too far ahead of the DB writer.
+    results_q = queue.Queue(maxsize=2 * workers)
+
+    for d in dates:
+        dates_q.put(d)
+    for _ in range(workers):
+        dates_q.put(None)
+
+    threads = []
+    for _ in range(workers):
+        t = threading.Thread(target=_backfill_fetch_worker,
+                             args=(dates_q, results_q, bucket))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    running = workers
+    while running:
+        result = results_q.get()
+        if result is None:
+            running -= 1
+            continue
+        yield result
+
+    for t in threads:
+        t.join()
+
+
+def _fetch_serially(dates):
+    """Fetches bhavcopies for `dates` one at a time, sleeping randomly after
+    every download. Yields (date, responses)."""
+
+    for d2 in dates:
+        module_logger.debug("Getting data for %s", str(d2))
+        yield d2, _fetch_bhavcopy(d2)
+
+        time.sleep(random.randrange(1, 10))
+
+
+class BhavcopyWriter(object):
+    """Writer stage. Parses the downloaded (date, responses) and saves the
+    data. Download status is saved in batches of `_STATUS_BATCH` days, after
+    the data for those days is saved. `existing` is the set of days already
+    having a row in the download info table. Must be used from a single
+    thread.
+
+    With `group_commits` (default is whether the `sqlite_profile` is enabled)
+    the data and status of all the days in a batch are written in a single
+    transaction, else every day is a transaction."""
+
+    def __init__(self, existing, group_commits=None):
+        self.existing = existing
+        self.saved = 0
+        self._statuses = []
+        if group_commits is None:
+            group_commits = sqlite_profile.is_enabled(_DB_METADATA)
+        self.group_commits = group_commits
+        self._conn = None
+        self._txn = None
+
+    def _connection(self):
+        """Returns the connection for the current batch, None if commits are
+        not grouped."""
+        if not self.group_commits:
+            return None
+        if self._conn is None:
+            # Tables are created (if required) on connections of their own,
+            # which can't happen while we hold the write lock (SQLite).
+            create_or_get_nse_equities_hist_data(metadata=_DB_METADATA)
+            create_or_get_nse_bhav_deliv_download_info(metadata=_DB_METADATA)
+            self._conn = _DB_METADATA.bind.connect()
+            self._txn = self._conn.begin()
+        return self._conn
+
+    def save(self, d2, responses):
+        """Saves data for a day. `responses` is what `_fetch_bhavcopy`
+        returns."""
+        if responses is None:
+            # We don't update bhav_deliv_downloaded here
+            return
+        self.save_batch(d2, *_process_bhavcopy_responses(d2, *responses))
+
+    def save_batch(self, d2, batch, status):
+        """Saves a parsed `BhavcopyBatch` (None if there's no data) and the
+        download status for a day."""
+        if batch is not None:
+            _save_batch(d2, batch, conn=self._connection())
+            self.saved += 1
+        self._statuses.append(status)
+        if len(self._statuses) >= _STATUS_BATCH:
+            self.flush()
+
+    def flush(self):
+        """Saves the pending download status (and commits the batch)."""
+        _flush_columnar_store()
+        _save_dload_status(self._statuses, self.existing,
+                           conn=self._connection())
+        self._statuses = []
+        if self._txn is not None:
+            self._txn.commit()
+            self._conn.close()
+            self._conn = self._txn = None
+
+
+def pending_days(dates):
+    """Returns a tuple of (days to be downloaded, set of days already having
+    a row in the download info table) for `dates`."""
+
+    if not dates:
+        return [], set()
+
+    status = _load_dload_status(min(dates), max(dates))
+    pending = [d for d in dates if not _is_downloaded(d, status.get(d))]
+    module_logger.info("%d of %d days are pending download.",
+                       len(pending), len(dates))
+    return pending, set(status.keys())
+
+
+def download(dates, workers=1, rate=_BACKFILL_RATE):
+    """Downloads bhavcopies for all the `dates` that are not already
+    downloaded. With `workers` greater than 1, fetches happen concurrently in
+    worker threads with total requests limited to `rate` requests per second,
+    else days are fetched one at a time.
+
+    Parsing and the DB updates always happen in the calling thread, so a slow
+    download never blocks the DB and the DB connection is never shared across
+    threads. Returns number of days for which data was saved."""
+
+    pending, existing = pending_days(dates)
+    if not pending:
+        return 0
+
+    if workers > 1:
+        fetched = _fetch_concurrently(pending, workers, rate)
+    else:
+        fetched = _fetch_serially(pending)
+
+    writer = BhavcopyWriter(existing)
+    for d2, responses in fetched:
+        writer.save(d2, responses)
+    writer.flush()
+
+    return writer.saved
+
+
+def bhavcopy_jobs(dates, endpoint):
+    """Returns a tuple of (list of `async_downloader.Job`, `BhavcopyWriter`)
+    for downloading bhavcopies for `dates` that are not already downloaded.
+    Writer should be flushed after all the jobs are done.
+
+    Other jobs of the scheduler write to the DB on connections of their own,
+    so the writer doesn't group commits (a transaction held open across
+    days would keep them waiting for the lock on SQLite)."""
+
+    pending, existing = pending_days(dates)
+    writer = BhavcopyWriter(existing, group_commits=False)
+
+    jobs = []
+    for d2 in pending:
+        jobs.append(Job('bhavcopy %s' % d2, endpoint, _fetch_bhavcopy, (d2,),
+                        lambda r: writer.save(r.job.args[0], r.result),
+                        tokens=2))
+    return jobs, writer
+
+
+def set_db_metadata(metadata):
+    """Sets the DB to be used by this module, when not run from `main`."""
+    global _DB_METADATA
+    _DB_METADATA = metadata
+
+
+def set_columnar_store(store):
+    """Sets the `ColumnarStore` to which saved data is also written."""
+    global _COLUMNAR_STORE
+    _COLUMNAR_STORE = store
+
+
+def backfill(dates, workers=_BACKFILL_WORKERS, rate=_BACKFILL_RATE):
+    """Downloads bhavcopies for all the `dates` using `workers` fetch threads,
+    with total requests limited to `rate` requests per second. Returns number
+    of days for which data was saved."""
+
+    return download(dates, workers=workers, rate=rate)
+
+
+def _replay_parse(root_and_date):
+    """Parses archived files for a date. Runs in a worker process, so it takes
+    archive root as an argument instead of using the module global."""
+
+    root, d2 = root_and_date
+    archive = RawArchive(root)
+    try:
+        with archive.open(_ARCHIVE_BHAV, d2) as bhav_file:
+            with archive.open(_ARCHIVE_DELIV, d2) as deliv_file:
+                return d2, parse_bhavcopy(bhav_file, deliv_file)
+    except Exception as e:
+        module_logger.error("Error parsing archived files for %s: %s", d2, e)
+        return d2, None
+
+
+def replay(from_date, to_date, processes=None):
+    """Rebuilds the data for the days between `from_date` and `to_date` from
+    the raw archive, without any network access. Files are parsed using
+    `processes` worker processes (default is number of CPUs), while the DB is
+    updated from the calling process. Returns number of days saved."""
+
+    bhav_dates = set(_RAW_ARCHIVE.dates(_ARCHIVE_BHAV))
+    dates = [d for d in _RAW_ARCHIVE.dates(_ARCHIVE_DELIV)
+             if d in bhav_dates and from_date <= d <= to_date]
+    module_logger.info("Replaying %d days from archive %s",
+                       len(dates), _RAW_ARCHIVE.root)
+    if not dates:
+        return 0
+
+    writer = BhavcopyWriter(set(_load_dload_status(dates[0],
+                                                   dates[-1]).keys()))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        work = [(_RAW_ARCHIVE.root, d) for d in dates]
+        for d2, batch in pool.imap_unordered(_replay_parse, work, chunksize=8):
+            if batch is None:
                 continue
-            l = line.split(',')
-            if (len(l)) == 4:
-                sym, d = l[1].strip(), l[3].strip()
-            elif len(l) == 7:
-                if l[3] not in ['EQ', 'BE', 'BZ']:
-                    i += 1
-                    continue
-                sym, d = l[2].strip(), l[5].strip()
-            try:
-                stocks_dict[sym][-1] = int(d)
-            except KeyError:
-                module_logger.error(
-                    "For Symbol: %s Delivery Data found but no Bhavcopy Data", sym)
-            i += 1
-
-        for sym in stocks_dict.keys():
-            stocks_dict[sym] = ScripOHLCVD(*stocks_dict[sym])
-            module_logger.debug("ScripInfo(%s): %s", sym,
-                                str(stocks_dict[sym]))
-
-        return stocks_dict
+            writer.save_batch(d2, batch, (d2, True, True, None))
+        writer.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    return writer.saved
+
+
+def _load_dload_status(from_date, to_date):
+    """Returns a dictionary of date -> download info row for all the days
+    between `from_date` and `to_date` using a single query."""
+
+    tbl = create_or_get_nse_bhav_deliv_download_info(metadata=_DB_METADATA)
+
+    sel_st = select_expr([tbl]).\
+        where(and_expr(tbl.c.download_date >= from_date,
+                       tbl.c.download_date <= to_date))
+
+    result = execute_one(sel_st, engine=_DB_METADATA.bind)
+    status = dict((row.download_date, row) for row in result.fetchall())
+    result.close()
+
+    return status
+
+
+def _save_dload_status(statuses, existing, conn=None):
+    """Saves a list of (date, bhav_ok, deliv_ok, error_code) `statuses` in a
+    single transaction (or as a part of the transaction on `conn`). Days in
+    the `existing` set are updated, others are inserted (and added to
+    `existing`)."""
+
+    if not statuses:
+        return
+
+    tbl = create_or_get_nse_bhav_deliv_download_info(metadata=_DB_METADATA)
+
+    inserts = []
+    updates = []
+    for fdate, bhav_ok, deliv_ok, error_code in statuses:
+        row = {'bhav_success': bhav_ok,
+               'deliv_success': deliv_ok,
+               'error_type': error_code}
+        if fdate in existing:
+            row['_download_date'] = fdate
+            updates.append(row)
+        else:
+            row['download_date'] = fdate
+            inserts.append(row)
+            existing.add(fdate)
+
+    module_logger.debug("Saving download status: %d new, %d updated.",
+                        len(inserts), len(updates))
+
+    if conn is not None:
+        _do_save_dload_status(conn, tbl, inserts, updates)
     else:
-        if not bhavcopy_response.ok:
-            module_logger.error("GET:Bhavcopy URL %s (%d)",
-                                bhav_url, bhavcopy_response.status_code)
-        if not delivery_response.ok:
-            module_logger.error("GET:Delivery URL %s (%d)",
-                                deliv_url, delivery_response.status_code)
-        return None
+        with _DB_METADATA.bind.begin() as conn:
+            _do_save_dload_status(conn, tbl, inserts, updates)
+
+
+def _do_save_dload_status(conn, tbl, inserts, updates):
+    bulk_insert(tbl, inserts, conn=conn)
+    if updates:
+        upd_st = tbl.update().where(
+            tbl.c.download_date == bindparam('_download_date'))
+        conn.execute(upd_st, updates)
 
 
 def _update_dload_success(fdate, bhav_ok, deliv_ok, error_code=None):
@@ -211,45 +574,52 @@ def _update_dload_success(fdate, bhav_ok, deliv_ok, error_code=None):
     result.close()
 
 
-def _update_bhavcopy(curdate, stocks_dict):
-    """update bhavcopy Database date in DD-MM-YYYY format."""
+def _update_bhavcopy(curdate, batch, conn=None):
+    """update bhavcopy Database for the date from a `BhavcopyBatch`, in a
+    transaction of it's own or as a part of the transaction on `conn`."""
 
     nse_eq_hist_data = create_or_get_nse_equities_hist_data(
         metadata=_DB_METADATA)
 
+    rows = batch.to_rows(curdate)
+
+    if conn is not None:
+        _do_update_bhavcopy(conn, nse_eq_hist_data, curdate, rows)
+    else:
+        with _DB_METADATA.bind.begin() as conn:
+            _do_update_bhavcopy(conn, nse_eq_hist_data, curdate, rows)
+
+
+def _do_update_bhavcopy(conn, nse_eq_hist_data, curdate, rows):
     # delete for today's date if there's anything FWIW
     module_logger.debug("Deleting any old data for date %s.", curdate)
     d = nse_eq_hist_data.delete(nse_eq_hist_data.c.date == curdate)
-    r = execute_one(d, engine=_DB_METADATA.bind)
+    r = conn.execute(d)
     module_logger.debug("Deleted %d rows.", r.rowcount)
 
-    insert_statements = []
-    for k, v in stocks_dict.items():
-        ins = nse_eq_hist_data.insert().values(symbol=k, date=curdate,
-                                               open=v.open, high=v.high,
-                                               low=v.low, close=v.close,
-                                               volume=v.volume,
-                                               delivery=v.deliv)
-        insert_statements.append(ins)
-        module_logger.debug(ins.compile().params)
+    bulk_insert(nse_eq_hist_data, rows, conn=conn)
 
-    results = execute_many_insert(insert_statements, engine=_DB_METADATA.bind)
-    for r in results:
-        r.close()
 
+def _save_batch(curdate, batch, conn=None):
+    """Saves data for the date to the DB, and queues it for the columnar store
+    if one is used."""
 
-def _bhavcopy_downloaded(fdate):
-    """
-    Returns success/failure for a given date if bhav/delivery data.
-    """
-    tbl = create_or_get_nse_bhav_deliv_download_info(metadata=_DB_METADATA)
+    _update_bhavcopy(curdate, batch, conn=conn)
+    if _COLUMNAR_STORE is not None:
+        _COLUMNAR_STORE.append_batch(curdate, batch)
 
-    select_st = tbl.select().where(tbl.c.download_date == fdate)
 
-    result = execute_one(select_st.compile(), engine=_DB_METADATA.bind)
-    result = result.fetchone()
+def _flush_columnar_store():
+    if _COLUMNAR_STORE is not None:
+        _COLUMNAR_STORE.flush()
 
-    if not result:
+
+def _is_downloaded(fdate, row):
+    """
+    Returns whether we need not download data for `fdate` given it's row in
+    the download info table (None if there's no row).
+    """
+    if not row:
         return False
 
     # For anything older than 7 days from now, if Error is not found,
@@ -257,38 +627,55 @@ def _bhavcopy_downloaded(fdate):
     d = dt.date(dt.today())
     delta = d - fdate
     ignore_error = False
-    if (delta.days > 7) and result.error_type == 'NOT_FOUND':
+    if (delta.days > NOT_FOUND_SETTLE_DAYS) and row.error_type == 'NOT_FOUND':
         ignore_error = True
 
-    return (result[1] and result[2]) or ignore_error
+    return bool(row.bhav_success and row.deliv_success) or ignore_error
 
 
-def _apply_name_changes_to_db(syms):
-    """Changes security names in nse_hist_data table so the name of the security
-    is always the latest."""
+def _bhavcopy_downloaded(fdate):
+    """
+    Returns success/failure for a given date if bhav/delivery data.
+    """
+    tbl = create_or_get_nse_bhav_deliv_download_info(metadata=_DB_METADATA)
+
+    select_st = tbl.select().where(tbl.c.download_date == fdate)
+
+    result = execute_one(select_st.compile(), engine=_DB_METADATA.bind)
+    result = result.fetchone()
 
-    hist_data = create_or_get_nse_equities_hist_data(metadata=_DB_METADATA)
+    return _is_downloaded(fdate, result)
 
-    update_statements = []
-    for sym in syms:
-        old = sym[0]
-        new = sym[1]
-        chdate = sym[2]
 
-        chdt = dt.date(dt.strptime(chdate, '%d-%b-%Y'))
+def _apply_name_changes_to_db(syms, since=None):
+    """Changes security names in nse_hist_data table so the name of the security
+    is always the latest. Only the changes not applied before (or the ones
+    after `since`, if given) are applied."""
 
-        upd = hist_data.update().values(symbol=new).\
-            where(and_expr(hist_data.c.symbol == old,
-                           hist_data.c.date < chdt))
+    save_name_changes(syms, _DB_METADATA)
+    if since is not None:
+        mark_pending(_DB_METADATA, since)
+    if apply_pending_name_changes(_DB_METADATA,
+                                  columnar_store=_COLUMNAR_STORE):
+        symbol_resolver.invalidate(_DB_METADATA)
 
-        update_statements.append(upd)
 
-    results = execute_many_insert(update_statements, engine=_DB_METADATA.bind)
-    for r in results:
-        r.close()
+def apply_name_changes(since=None):
+    """Gets the symbol name changes from NSE and applies them to the DB.
+    `since` (`datetime.date`) is the earliest date for which data was
+    downloaded, changes after that are applied again. Returns False if no
+    name changes were found."""
+
+    sym_change_tuples = nse_get_name_change_tuples()
+    if len(sym_change_tuples) == 0:
+        module_logger.info("No name change tuples found...")
+        return False
+    _apply_name_changes_to_db(sym_change_tuples, since=since)
+    return True
 
 
 def main(args):
+    global _NSE_BASE_URL, _RAW_ARCHIVE, _COLUMNAR_STORE
     # We run the full program
     import argparse
     parser = argparse.ArgumentParser()
@@ -322,9 +709,93 @@ def main(args):
                         help="Database URL to be used.",
                         dest="dbpath")
 
+    # --all-days option
+    parser.add_argument("--all-days",
+                        help="Try all calendar days, including weekends and "
+                        "known holidays.",
+                        dest="all_days",
+                        action="store_true")
+
+    # --backfill option
+    parser.add_argument("--backfill",
+                        help="Download many days concurrently.",
+                        action="store_true")
+
+    # --workers option
+    parser.add_argument("--workers",
+                        help="Number of concurrent downloads for backfill. "
+                        "Default is %d." % _BACKFILL_WORKERS,
+                        type=int,
+                        default=_BACKFILL_WORKERS)
+
+    # --rate option
+    parser.add_argument("--rate",
+                        help="Maximum requests per second for backfill. "
+                        "Default is %.1f." % _BACKFILL_RATE,
+                        type=float,
+                        default=_BACKFILL_RATE)
+
+    # --base-url option
+    parser.add_argument("--base-url",
+                        help="Base URL to download bhavcopies from. "
+                        "Default is %s." % _NSE_BASE_URL,
+                        dest="base_url")
+
+    # --archive option
+    parser.add_argument("--archive",
+                        help="Directory where all the downloaded files are "
+                        "archived.",
+                        dest="archive")
+
+    # --columnar option
+    parser.add_argument("--columnar",
+                        help="Directory of a columnar (Parquet) store, to "
+                        "which all the saved data is also written.",
+                        dest="columnar")
+
+    # --sqlite-profile option
+    parser.add_argument("--sqlite-profile",
+                        help="Use the SQLite performance profile (WAL, "
+                        "tuned pragmas and grouped commits).",
+                        dest="sqlite_profile",
+                        action="store_true")
+
+    # --replay option
+    parser.add_argument("--replay",
+                        help="Rebuild data from the files in --archive "
+                        "without downloading.",
+                        action="store_true")
+
+    # --processes option
+    parser.add_argument("--processes",
+                        help="Number of processes used for --replay. "
+                        "Default is number of CPUs.",
+                        type=int)
+
     args = parser.parse_args()
     print(args)
 
+    if args.base_url:
+        _NSE_BASE_URL = args.base_url.rstrip('/')
+
+    if args.replay and not args.archive:
+        print("--replay requires --archive.")
+        return -1
+
+    if args.archive:
+        _RAW_ARCHIVE = RawArchive(args.archive)
+
+    if args.columnar:
+        try:
+            _COLUMNAR_STORE = ColumnarStore(args.columnar)
+        except ImportError as e:
+            print(e)
+            return -1
+
+    if args.workers < 1 or args.rate <= 0:
+        print(parser.format_usage())
+        return -1
+
     # Make sure we can access the DB path if specified or else exit right here.
     if args.dbpath:
         try:
@@ -335,6 +806,9 @@ def main(args):
                 args.dbpath, e))
             return -1
 
+        if args.sqlite_profile:
+            sqlite_profile.enable(_DB_METADATA)
+
     try:
         from_date = dt.strptime(args.fromdate, _DATE_FMT)
         if args.todate.lower() == 'today':
@@ -369,23 +843,28 @@ def main(args):
 
     module_logger.info("Downloading data for %d days", num_days.days)
 
-    cur_date = from_date
-    while cur_date <= to_date:
-        module_logger.debug("Getting data for %s", str(cur_date))
-        scrips_dict = get_bhavcopy(cur_date)
-        if scrips_dict is not None:
-            _update_bhavcopy(cur_date, scrips_dict)
-
-        time.sleep(random.randrange(1, 10))
-
-        cur_date += td(1)
+    if args.replay:
+        dates = []
+    elif args.all_days:
+        dates = [dt.date(from_date + td(i)) for i in range(num_days.days + 1)]
+    else:
+        dates = get_trading_days(dt.date(from_date), dt.date(to_date),
+                                 metadata=_DB_METADATA)
+
+    if args.replay:
+        saved = replay(dt.date(from_date), dt.date(to_date),
+                       processes=args.processes)
+    elif args.backfill:
+        saved = backfill(dates, workers=args.workers, rate=args.rate)
+    else:
+        saved = download(dates)
+    module_logger.info("Saved data for %d days", saved)
 
     # Apply the name changes to the DB
-    sym_change_tuples = nse_get_name_change_tuples()
-    if len(sym_change_tuples) == 0:
-        module_logger.info("No name change tuples found...")
+    if not apply_name_changes(since=dt.date(from_date)):
         sys.exit(-1)
-    _apply_name_changes_to_db(sym_change_tuples)
+
+    get_client().log_stats()
 
     return 0
 
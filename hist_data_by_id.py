@@ -0,0 +1,287 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+#pylint: disable-msg=broad-except
+"""
+Migrates NSE equities historical data to a table keyed by the integer
+security ID (see `symbol_resolver`) instead of the symbol text.
+
+`nse_equities_hist_data_by_id` has a primary key on (security_id, date), and
+on SQLite is a `WITHOUT ROWID` table, so the rows are stored in the order of
+this key. Reading a range of dates for a security is then a contiguous scan
+of the primary key, and the symbol names live only in `security_ids` and
+`all_scrips_info` - a name change doesn't touch any rows of this table.
+
+Migration reads `nse_equities_hist_data` in chunks of consecutive symbols
+and writes the rows with their security IDs, symbols without a security ID
+(eg. delisted securities not in `all_scrips_info`) are assigned one. Every
+chunk is committed on it's own, so an interrupted migration keeps the chunks
+already done. It can be run again (eg. after every download with `--from`),
+rows already migrated are replaced.
+"""
+
+import os
+import sys
+from datetime import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import Table, Column, Integer, Date, Float, BigInteger
+from sqlalchemy import PrimaryKeyConstraint, func
+
+from tickerplot.sql.sqlalchemy_wrapper import \
+    create_or_get_nse_equities_hist_data
+from tickerplot.sql.sqlalchemy_wrapper import execute_one, select_expr
+from tickerplot.sql.sqlalchemy_wrapper import and_expr
+from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+
+from bulk_writer import bulk_upsert
+import symbol_resolver
+
+from tickerplot.utils.logger import get_logger
+module_logger = get_logger(os.path.basename(__file__))
+
+_HIST_DATA_COLUMNS = ['open', 'high', 'low', 'close', 'volume', 'delivery']
+
+_KEYS = ['security_id', 'date']
+
+# Rows read from the old table (and written) at a time, about
+_MIGRATE_CHUNK_ROWS = 100000
+
+
+def create_or_get_nse_equities_hist_data_by_id(metadata=None):
+    """Creates (if required) and returns `nse_equities_hist_data_by_id`
+    table."""
+    table_name = 'nse_equities_hist_data_by_id'
+    if table_name in metadata.tables:
+        return metadata.tables[table_name]
+
+    tbl = Table(table_name, metadata,
+                Column('security_id', Integer, nullable=False),
+                Column('date', Date, nullable=False),
+                Column('open', Float),
+                Column('high', Float),
+                Column('low', Float),
+                Column('close', Float),
+                Column('volume', BigInteger),
+                Column('delivery', BigInteger),
+                PrimaryKeyConstraint('security_id', 'date'),
+                sqlite_with_rowid=False)
+    tbl.create(bind=metadata.bind, checkfirst=True)
+    return tbl
+
+
+def _symbol_rows(metadata, from_date=None):
+    """Returns a list of (symbol, number of rows) for all the symbols in
+    `nse_equities_hist_data` (on or after `from_date`), sorted by symbol."""
+
+    hist_data = create_or_get_nse_equities_hist_data(metadata=metadata)
+    sel = select_expr([hist_data.c.symbol, func.count()]).\
+        group_by(hist_data.c.symbol).order_by(hist_data.c.symbol)
+    if from_date:
+        sel = sel.where(hist_data.c.date >= from_date)
+    result = execute_one(sel, engine=metadata.bind)
+    symbol_rows = [(r[0], r[1]) for r in result.fetchall() if r[0]]
+    result.close()
+    return symbol_rows
+
+
+def _symbol_ranges(symbol_rows, chunk_rows):
+    """Yields (first, last) symbols of runs of consecutive symbols in
+    `symbol_rows` having about `chunk_rows` rows together. All the rows of a
+    symbol are always in the same run."""
+
+    first, rows = None, 0
+    for symbol, n in symbol_rows:
+        if first is None:
+            first = symbol
+        rows += n
+        if rows >= chunk_rows:
+            yield first, symbol
+            first, rows = None, 0
+    if first is not None:
+        yield first, symbol_rows[-1][0]
+
+
+def _symbol_ids(metadata, symbols):
+    """Returns a dictionary of symbol -> security ID for the `symbols`,
+    assigning IDs to the securities in `all_scrips_info` and then to the
+    symbols that don't have one."""
+
+    symbol_resolver.assign_scrips_security_ids(metadata)
+    symbol_resolver.invalidate(metadata)
+    ids = symbol_resolver.get_resolver(metadata).security_ids_for(symbols)
+    unknown = [s for s, i in zip(symbols, ids) if i < 0]
+    if unknown:
+        module_logger.info("Assigning security IDs to %d symbols.",
+                           len(unknown))
+        symbol_resolver.assign_security_ids(metadata, nse_symbols=unknown)
+        symbol_resolver.invalidate(metadata)
+        ids = symbol_resolver.get_resolver(metadata).security_ids_for(symbols)
+    return dict(zip(symbols, ids.tolist()))
+
+
+def _chunk_rows(chunk, symbol_ids):
+    """Returns a list of rows (dictionaries) for the new table for a chunk of
+    the old one."""
+
+    chunk = chunk[chunk['symbol'].isin(symbol_ids)]
+    out = pd.DataFrame({'security_id': chunk['symbol'].map(symbol_ids),
+                        'date': pd.to_datetime(chunk['date']).dt.date})
+    for col in _HIST_DATA_COLUMNS:
+        out[col] = chunk[col].values
+    # Duplicate rows in the old table, the last one wins.
+    out = out.drop_duplicates(_KEYS, keep='last')
+    out = out.astype(object).where(pd.notnull(out), None)
+    out['security_id'] = out['security_id'].astype(int)
+    return out.to_dict('records')
+
+
+def migrate(metadata, from_date=None, chunk_rows=_MIGRATE_CHUNK_ROWS):
+    """Copies the rows from `nse_equities_hist_data` (on or after `from_date`,
+    default all) to `nse_equities_hist_data_by_id`, committing every chunk of
+    about `chunk_rows` rows. Returns number of rows written."""
+
+    tbl = create_or_get_nse_equities_hist_data_by_id(metadata=metadata)
+    hist_data = create_or_get_nse_equities_hist_data(metadata=metadata)
+
+    symbol_rows = _symbol_rows(metadata, from_date)
+    symbol_ids = _symbol_ids(metadata, [s for s, _ in symbol_rows])
+
+    sel = select_expr([hist_data.c.symbol, hist_data.c.date] +
+                      [hist_data.c[col] for col in _HIST_DATA_COLUMNS])
+    if from_date:
+        sel = sel.where(hist_data.c.date >= from_date)
+
+    # A chunk is read completely before it's written (SQLite can't commit
+    # writes on another connection while a read is in progress).
+    written = 0
+    for first, last in _symbol_ranges(symbol_rows, chunk_rows):
+        chunk = pd.io.sql.read_sql(
+            sel.where(and_expr(hist_data.c.symbol >= first,
+                               hist_data.c.symbol <= last)),
+            metadata.bind)
+        chunk.columns = ['symbol', 'date'] + _HIST_DATA_COLUMNS
+        written += bulk_upsert(tbl, _chunk_rows(chunk, symbol_ids), _KEYS,
+                               engine=metadata.bind)
+        module_logger.info("Migrated %d rows (symbols up to %s).", written,
+                           last)
+    return written
+
+
+def verify(metadata):
+    """Compares the number of rows for every security in the old and the new
+    tables. Returns a list of (security ID, rows in old table, rows in new
+    table) for the securities where they differ."""
+
+    tbl = create_or_get_nse_equities_hist_data_by_id(metadata=metadata)
+    hist_data = create_or_get_nse_equities_hist_data(metadata=metadata)
+    resolver = symbol_resolver.get_resolver(metadata)
+
+    # Number of days for every symbol, summed up for every security.
+    days = func.count(hist_data.c.date.distinct())
+    result = execute_one(select_expr([hist_data.c.symbol, days]).
+                         group_by(hist_data.c.symbol), engine=metadata.bind)
+    rows = result.fetchall()
+    result.close()
+    ids = resolver.security_ids_for([r[0] for r in rows])
+    old = pd.Series([r[1] for r in rows], dtype=np.int64).groupby(ids).sum()
+
+    result = execute_one(select_expr([tbl.c.security_id, func.count()]).
+                         group_by(tbl.c.security_id), engine=metadata.bind)
+    new = pd.Series(dict((r[0], r[1]) for r in result.fetchall()),
+                    dtype=np.int64)
+    result.close()
+
+    counts = pd.concat([old, new], axis=1).fillna(0).astype(np.int64)
+    counts.columns = ['old', 'new']
+    counts = counts[counts['old'] != counts['new']]
+    return [(int(sid), int(o), int(n))
+            for sid, o, n in counts.itertuples()]
+
+
+def read_hist_data(metadata, security_ids=None, from_date=None, to_date=None):
+    """Returns a 'long' DataFrame with columns security_id, symbol (current),
+    date and OHLCVD from `nse_equities_hist_data_by_id` for `security_ids`
+    (default all), sorted by security ID and date. `from_date` and `to_date`
+    (`datetime.date`) restrict the date range."""
+
+    tbl = create_or_get_nse_equities_hist_data_by_id(metadata=metadata)
+    sel = select_expr([tbl.c.security_id, tbl.c.date] +
+                      [tbl.c[col] for col in _HIST_DATA_COLUMNS]).\
+        order_by(tbl.c.security_id, tbl.c.date)
+    if security_ids is not None:
+        sel = sel.where(tbl.c.security_id.in_(list(security_ids)))
+    if from_date:
+        sel = sel.where(tbl.c.date >= from_date)
+    if to_date:
+        sel = sel.where(tbl.c.date <= to_date)
+
+    df = pd.io.sql.read_sql(sel, metadata.bind)
+    df.columns = ['security_id', 'date'] + _HIST_DATA_COLUMNS
+    df['date'] = pd.to_datetime(df['date'])
+
+    resolver = symbol_resolver.get_resolver(metadata)
+    ids = df['security_id'].unique()
+    symbols = dict((sid, getattr(resolver.by_security_id(int(sid)),
+                                 'nse_symbol', None)) for sid in ids)
+    df.insert(1, 'symbol', df['security_id'].map(symbols))
+    return df
+
+
+def main(args):
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Migrates NSE equities "
+                                     "historical data to a table keyed by "
+                                     "security ID.")
+
+    # --from option
+    parser.add_argument("--from",
+                        help="Migrate only the data on or after this date "
+                        "(DD-MM-YYYY). Default is all the data.",
+                        dest="fromdate")
+
+    # --verify option
+    parser.add_argument("--verify",
+                        help="Only compare the number of rows for every "
+                        "security in the two tables.",
+                        action="store_true")
+
+    # --dbpath option
+    parser.add_argument("--dbpath",
+                        help="Database URL to be used.",
+                        dest="dbpath")
+
+    args = parser.parse_args(args)
+
+    try:
+        db_meta = get_metadata(args.dbpath)
+    except Exception as e:
+        print("Not a valid DB URL: {} (Exception: {})".format(
+            args.dbpath, e))
+        return -1
+
+    if args.verify:
+        mismatches = verify(db_meta)
+        for sid, old, new in mismatches:
+            print("Security %d: %d rows, migrated %d" % (sid, old, new))
+        print("%d mismatches." % len(mismatches))
+        return 1 if mismatches else 0
+
+    try:
+        from_date = dt.date(dt.strptime(args.fromdate, '%d-%m-%Y')) \
+            if args.fromdate else None
+    except ValueError:
+        print(parser.format_usage())
+        return -1
+
+    rows = migrate(db_meta, from_date=from_date)
+    module_logger.info("Migrated %d rows in all.", rows)
+
+    return 0
+
+if __name__ == '__main__':
+
+    sys.exit(main(sys.argv[1:]))
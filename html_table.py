@@ -0,0 +1,93 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+"""
+Streaming extraction of rows of an HTML table.
+
+Instead of building a full document tree (eg. using BeautifulSoup), the HTML
+is fed to `html.parser` in chunks and only the text of the cells of the
+wanted table is collected. Parsing stops as soon as that table ends, so the
+rest of the page is never parsed.
+"""
+
+from html.parser import HTMLParser
+
+_CHUNK_SIZE = 65536
+
+_CELL_TAGS = ('td', 'th')
+
+
+class _TableExtractor(HTMLParser):
+    """Collects rows (list of cell texts) of `table`th table in the page.
+    Rows of any tables nested inside it are collected as well."""
+
+    def __init__(self, table=0):
+        HTMLParser.__init__(self)
+        self.table = table
+        self.rows = []
+        self.done = False
+        self._tables_seen = 0
+        self._depth = 0
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            if self._depth:
+                self._depth += 1
+            elif self._tables_seen == self.table:
+                self._depth = 1
+            self._tables_seen += 1
+        elif not self._depth:
+            return
+        elif tag == 'tr':
+            self._end_cell()
+            self.rows.append([])
+        elif tag in _CELL_TAGS and self.rows:
+            self._end_cell()
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if not self._depth:
+            return
+        if tag in _CELL_TAGS or tag == 'tr':
+            self._end_cell()
+        elif tag == 'table':
+            self._end_cell()
+            self._depth -= 1
+            if not self._depth:
+                self.done = True
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+    def finish(self):
+        """Ends the cell being collected, if any (for unterminated tables)."""
+        self._end_cell()
+
+    def _end_cell(self):
+        if self._cell is not None:
+            self.rows[-1].append(''.join(self._cell).strip())
+            self._cell = None
+
+
+def table_rows(html, table=0):
+    """Returns a list of rows, each a list of (stripped) cell texts, of the
+    `table`th (0 based) table in `html`. `html` is either a string or an
+    iterable of strings (eg. chunks of a streamed response). Returns an empty
+    list if there is no such table."""
+
+    chunks = html
+    if isinstance(html, (str, type(u''))):
+        chunks = (html[i:i + _CHUNK_SIZE]
+                  for i in range(0, len(html), _CHUNK_SIZE))
+
+    parser = _TableExtractor(table=table)
+    for chunk in chunks:
+        parser.feed(chunk)
+        if parser.done:
+            break
+    else:
+        parser.close()
+    parser.finish()
+    return parser.rows
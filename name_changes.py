@@ -0,0 +1,262 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+#pylint: disable-msg=broad-except
+"""
+Symbol name changes for NSE equities, applied to the historical data so that
+the name of a security is always the latest one.
+
+Name changes (old symbol, new symbol, date of change) are saved in the
+`symbol_name_changes` table along with whether they have been applied to
+`nse_equities_hist_data`. Only the changes that are not applied yet are
+applied, all of them together using a single UPDATE joined to this table, in
+one transaction.
+
+Chained renames (A -> B, then later B -> C) are resolved before the update,
+so rows of A before the first change become C directly. For a row of a symbol
+the change applicable is the earliest change of that symbol after the date of
+the row, which is the same as applying the changes one at a time in the order
+of their dates.
+"""
+
+import os
+import sys
+from datetime import datetime as dt
+
+from sqlalchemy import Table, Column, Date, Boolean, String
+from sqlalchemy import exists, true, false
+
+from tickerplot.sql.sqlalchemy_wrapper import \
+    create_or_get_nse_equities_hist_data
+from tickerplot.sql.sqlalchemy_wrapper import execute_one
+from tickerplot.sql.sqlalchemy_wrapper import and_expr, select_expr
+from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+
+from bulk_writer import bulk_insert
+from date_parser import parse_date
+
+from tickerplot.utils.logger import get_logger
+module_logger = get_logger(os.path.basename(__file__))
+
+
+def create_or_get_symbol_name_changes(metadata=None):
+    """Creates (if required) and returns the `symbol_name_changes` table.
+    `final_symbol` is the symbol at the end of the chain of renames starting
+    with this change, valid for changes not applied yet."""
+    table_name = 'symbol_name_changes'
+    if table_name in metadata.tables:
+        return metadata.tables[table_name]
+
+    tbl = Table(table_name, metadata,
+                Column('old_symbol', String(64), primary_key=True),
+                Column('change_date', Date, primary_key=True),
+                Column('new_symbol', String(64), nullable=False),
+                Column('final_symbol', String(64), nullable=False),
+                Column('applied', Boolean, nullable=False, default=False))
+    tbl.create(bind=metadata.bind, checkfirst=True)
+    return tbl
+
+
+def parse_name_change_tuples(sym_change_tuples):
+    """Returns a list of (old, new, `datetime.date`) for the name change
+    tuples (old, new, DD-Mon-YYYY) from NSE. Duplicates are dropped."""
+
+    changes = set()
+    for old, new, chdate in sym_change_tuples:
+        try:
+            chdt = parse_date(chdate.strip())
+        except ValueError:
+            module_logger.warning("Ignoring name change %s -> %s (%s)",
+                                  old, new, chdate)
+            continue
+        old, new = old.strip(), new.strip()
+        if old != new:
+            changes.add((old, new, chdt))
+    return sorted(changes, key=lambda c: (c[2], c[0]))
+
+
+def resolve_chains(changes):
+    """Returns a dictionary of (old, change date) -> final symbol for the
+    `changes` (old, new, change date). A rename is followed by the next
+    rename of the new symbol, the earliest one after its date."""
+
+    by_symbol = {}
+    for old, new, chdt in changes:
+        by_symbol.setdefault(old, []).append((chdt, new))
+    for renames in by_symbol.values():
+        renames.sort()
+
+    final = {}
+    for old, new, chdt in changes:
+        sym, since = new, chdt
+        # Change dates strictly increase along the chain, so this ends.
+        while True:
+            later = [r for r in by_symbol.get(sym, ()) if r[0] > since]
+            if not later:
+                break
+            since, sym = later[0]
+        final[(old, chdt)] = sym
+    return final
+
+
+def save_name_changes(sym_change_tuples, metadata):
+    """Saves name change tuples (old, new, DD-Mon-YYYY) from NSE that are not
+    in the `symbol_name_changes` table yet, as not applied. Returns number of
+    new changes."""
+
+    tbl = create_or_get_symbol_name_changes(metadata=metadata)
+
+    result = execute_one(select_expr([tbl.c.old_symbol, tbl.c.change_date]),
+                         engine=metadata.bind)
+    known = set((r[0], r[1]) for r in result.fetchall())
+    result.close()
+
+    rows = [{'old_symbol': old,
+             'change_date': chdt,
+             'new_symbol': new,
+             'final_symbol': new,
+             'applied': False}
+            for old, new, chdt in parse_name_change_tuples(sym_change_tuples)
+            if (old, chdt) not in known]
+    # Only one change per symbol per day.
+    rows = list(dict(((r['old_symbol'], r['change_date']), r)
+                     for r in rows).values())
+
+    bulk_insert(tbl, rows, engine=metadata.bind)
+    return len(rows)
+
+
+def mark_pending(metadata, since):
+    """Marks the changes after `since` (`datetime.date`) as not applied, so
+    that they are applied again (eg. after older data is downloaded, which
+    will have old symbols). Returns number of changes marked."""
+
+    tbl = create_or_get_symbol_name_changes(metadata=metadata)
+    upd = tbl.update().values(applied=False).\
+        where(and_expr(tbl.c.change_date > since, tbl.c.applied == true()))
+    result = execute_one(upd, engine=metadata.bind)
+    count = result.rowcount
+    result.close()
+    return count
+
+
+def pending_name_changes(metadata):
+    """Returns a list of (old, final symbol, change date) for the changes not
+    applied yet, in the order of change dates."""
+
+    tbl = create_or_get_symbol_name_changes(metadata=metadata)
+    sel = select_expr([tbl.c.old_symbol, tbl.c.final_symbol,
+                       tbl.c.change_date]).\
+        where(tbl.c.applied == false()).\
+        order_by(tbl.c.change_date, tbl.c.old_symbol)
+    result = execute_one(sel, engine=metadata.bind)
+    pending = [tuple(r) for r in result.fetchall()]
+    result.close()
+    return pending
+
+
+def _do_apply(conn, tbl, hist_data):
+    """Resolves chains and applies all the pending changes on `conn`. Returns
+    (number of changes, number of rows updated)."""
+
+    rows = conn.execute(select_expr([tbl.c.old_symbol, tbl.c.new_symbol,
+                                     tbl.c.change_date,
+                                     tbl.c.applied])).fetchall()
+    pending = [(r[0], r[2]) for r in rows if not r[3]]
+    if not pending:
+        return 0, 0
+
+    final = resolve_chains([(r[0], r[1], r[2]) for r in rows])
+    for old, chdt in pending:
+        conn.execute(tbl.update().values(final_symbol=final[(old, chdt)]).
+                     where(and_expr(tbl.c.old_symbol == old,
+                                    tbl.c.change_date == chdt)))
+
+    # For every row, the earliest pending change for it's symbol after it's
+    # date.
+    changes = tbl.alias('changes')
+    applicable = and_expr(changes.c.old_symbol == hist_data.c.symbol,
+                          changes.c.change_date > hist_data.c.date,
+                          changes.c.applied == false())
+    final_symbol = select_expr([changes.c.final_symbol]).\
+        where(applicable).\
+        order_by(changes.c.change_date).limit(1).as_scalar()
+
+    old_symbols = sorted(set(old for old, _ in pending))
+    upd = hist_data.update().values(symbol=final_symbol).\
+        where(and_expr(hist_data.c.symbol.in_(old_symbols),
+                       exists().where(applicable)))
+    result = conn.execute(upd)
+    updated = result.rowcount
+    result.close()
+
+    conn.execute(tbl.update().values(applied=True).
+                 where(tbl.c.applied == false()))
+    return len(pending), updated
+
+
+def apply_pending_name_changes(metadata, columnar_store=None):
+    """Applies all the name changes not applied yet to the
+    `nse_equities_hist_data` table (and the `columnar_store` if given) and
+    marks them applied. Returns number of changes applied."""
+
+    tbl = create_or_get_symbol_name_changes(metadata=metadata)
+    hist_data = create_or_get_nse_equities_hist_data(metadata=metadata)
+
+    if columnar_store is not None:
+        for old, final, chdt in pending_name_changes(metadata):
+            columnar_store.rename_symbol(old, final, chdt)
+
+    with metadata.bind.begin() as conn:
+        count, updated = _do_apply(conn, tbl, hist_data)
+
+    module_logger.info("Applied %d name changes, %d rows updated.",
+                       count, updated)
+    return count
+
+
+def main(args):
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Applies the symbol name "
+                                     "changes from NSE to the DB.")
+
+    # --since option
+    parser.add_argument("--since",
+                        help="Apply again the changes after this date "
+                        "(DD-MM-YYYY).",
+                        dest="since")
+
+    # --dbpath option
+    parser.add_argument("--dbpath",
+                        help="Database URL to be used.",
+                        dest="dbpath")
+
+    args = parser.parse_args(args)
+
+    try:
+        db_meta = get_metadata(args.dbpath)
+    except Exception as e:
+        print("Not a valid DB URL: {} (Exception: {})".format(
+            args.dbpath, e))
+        return -1
+
+    try:
+        since = dt.date(dt.strptime(args.since, '%d-%m-%Y')) \
+            if args.since else None
+    except ValueError:
+        print(parser.format_usage())
+        return -1
+
+    from tickerplot.nse.nse_utils import nse_get_name_change_tuples
+
+    save_name_changes(nse_get_name_change_tuples(), db_meta)
+    if since is not None:
+        mark_pending(db_meta, since)
+    apply_pending_name_changes(db_meta)
+
+    return 0
+
+if __name__ == '__main__':
+
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,129 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+"""
+A dense 3-D store of OHLCVD data for all the symbols, as a replacement for the
+pandas `Panel` (which is no longer available in pandas).
+
+All the data is kept in a single contiguous float64 NumPy array of shape
+(symbols, dates, fields), along with a symbol -> index map, a sorted array of
+dates and a mask of missing days (a symbol not traded on a date). Missing
+values are NaN, so comparisons on missing days are always False.
+
+Cross sectional screens are then simple vectorized expressions, eg. all the
+symbols that closed higher on the last day -
+
+    close = arr.field('close')
+    arr.select(close[:, -1] > close[:, -2])
+"""
+
+import numpy as np
+import pandas as pd
+
+from read_sql_data import get_hist_data_as_dataframe
+
+
+class OHLCVDArray(object):
+    """Dense symbols x dates x fields array of OHLCVD data."""
+
+    FIELDS = ('open', 'high', 'low', 'close', 'volume', 'delivery')
+
+    def __init__(self, symbols, dates, data, mask=None):
+        self.symbols = np.asarray(symbols, dtype=object)
+        self.dates = np.asarray(dates, dtype='datetime64[D]')
+        self.data = np.ascontiguousarray(data, dtype=np.float64)
+
+        if self.data.shape != (len(self.symbols), len(self.dates),
+                               len(self.FIELDS)):
+            raise ValueError("Data shape %s doesn't match symbols and dates." %
+                             str(self.data.shape))
+
+        if mask is None:
+            mask = np.isnan(self.data).all(axis=2)
+        self.mask = mask
+
+        self.symbol_index = dict((s, i) for i, s in enumerate(self.symbols))
+        self._field_index = dict((f, i) for i, f in enumerate(self.FIELDS))
+
+    @classmethod
+    def from_long(cls, symbols, dates, values):
+        """Builds from 'long' data - one row per (symbol, date). `values` is
+        an array of shape (rows, 6) with fields in `FIELDS` order."""
+
+        sym_codes, sym_uniques = pd.factorize(np.asarray(symbols),
+                                              sort=True)
+        date_codes, date_uniques = pd.factorize(
+            np.asarray(dates, dtype='datetime64[D]'), sort=True)
+
+        shape = (len(sym_uniques), len(date_uniques), len(cls.FIELDS))
+        data = np.full(shape, np.nan, dtype=np.float64)
+        data[sym_codes, date_codes] = values
+
+        mask = np.ones(shape[:2], dtype=bool)
+        mask[sym_codes, date_codes] = False
+
+        return cls(sym_uniques, date_uniques, data, mask=mask)
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """Builds from a DataFrame with symbol, date and OHLCVD columns."""
+        return cls.from_long(df['symbol'].values, df['date'].values,
+                             df[list(cls.FIELDS)].values.astype(np.float64))
+
+    @classmethod
+    def from_db(cls, metadata, from_date=None, to_date=None):
+        """Builds directly from the DB using a single query."""
+        return cls.from_dataframe(get_hist_data_as_dataframe(
+            metadata=metadata, from_date=from_date, to_date=to_date))
+
+    @classmethod
+    def from_columnar(cls, root, symbols=None, from_date=None, to_date=None):
+        """Builds from a `columnar_store.ColumnarStore` at `root`."""
+        from columnar_store import ColumnarStore
+        return cls.from_dataframe(ColumnarStore(root).read(
+            symbols=symbols, from_date=from_date, to_date=to_date))
+
+    @classmethod
+    def from_frames(cls, frames):
+        """Builds from a dictionary of symbol -> DataFrame (indexed by date),
+        as returned by `read_sql_data.get_hist_data_as_dataframes_dict`."""
+        parts = []
+        for sym, frame in frames.items():
+            if not len(frame):
+                continue
+            part = frame[list(cls.FIELDS)].copy()
+            part['symbol'] = sym
+            part['date'] = frame.index.values
+            parts.append(part)
+        if not parts:
+            return cls([], [], np.empty((0, 0, len(cls.FIELDS))))
+        return cls.from_dataframe(pd.concat(parts, ignore_index=True))
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def field(self, name):
+        """Returns a (symbols x dates) view of the field."""
+        return self.data[:, :, self._field_index[name]]
+
+    def symbol(self, sym):
+        """Returns a (dates x fields) view of the symbol's data."""
+        return self.data[self.symbol_index[sym]]
+
+    def date_loc(self, date):
+        """Returns index of `date` in `dates`, raises KeyError if not found."""
+        d = np.datetime64(date, 'D')
+        i = np.searchsorted(self.dates, d)
+        if i == len(self.dates) or self.dates[i] != d:
+            raise KeyError(date)
+        return int(i)
+
+    def last(self, n):
+        """Returns a new `OHLCVDArray` for the last `n` dates."""
+        return OHLCVDArray(self.symbols, self.dates[-n:], self.data[:, -n:],
+                           mask=self.mask[:, -n:])
+
+    def select(self, selector):
+        """Returns the symbols for which the boolean `selector` is True."""
+        return self.symbols[selector]
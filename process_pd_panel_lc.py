@@ -11,8 +11,6 @@ from __future__ import print_function
 import time
 import cProfile
 
-import pandas as pd
-
 from read_sql_data import get_hist_data_as_dataframes_dict
 from tickerplot.sql.sqlalchemy_wrapper import get_metadata
 
@@ -24,13 +22,13 @@ limit = 20
 while limit < max_limit:
     scripdata_dict = get_hist_data_as_dataframes_dict(metadata=metadata,
                                                         limit=limit)
-    pan = pd.Panel(scripdata_dict)
-
     then0 = time.time()
     pr = cProfile.Profile()
     pr.enable()
 
-    sels = [pan[x]['close'][-1] > pan[x]['close'][-2] for x in pan]
+    # Frames are latest first.
+    sels = [x['close'].iloc[0] > x['close'].iloc[1]
+            for x in scripdata_dict.values() if len(x) > 1]
 
     #pr.disable()
     #s = StringIO.StringIO()
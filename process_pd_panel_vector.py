@@ -1,6 +1,6 @@
 """
-In this approach, we transpose a given panel and select the list of `items`
-that we are interested in using `vector` methods.
+In this approach, we select the symbols that we are interested in using
+`vector` methods on a dense `OHLCVDArray` (symbols x dates x fields).
 
 Intuitively this approach is fast one. But we have seen a radically different
 behavior on different data sizes, so we want to be able to profile both
@@ -14,8 +14,7 @@ import cProfile
 import pstats
 from io import StringIO
 
-import pandas as pd
-
+from ohlcvd_array import OHLCVDArray
 from read_sql_data import get_hist_data_as_dataframes_dict
 from tickerplot.sql.sqlalchemy_wrapper import get_metadata
 
@@ -27,16 +26,14 @@ limit = 20
 while limit < max_limit:
     scripdata_dict = get_hist_data_as_dataframes_dict(metadata=metadata,
                                                         limit=limit)
-    pan = pd.Panel(scripdata_dict)
+    arr = OHLCVDArray.from_frames(scripdata_dict)
 
     then0 = time.time()
     pr = cProfile.Profile()
     pr.enable()
 
-    pan2 = pan.transpose(2, 0, 1)
-    cl = pan2['close']
-    cl2 = cl[cl.iloc[:, -1] > cl.iloc[:, -2]]
-    pan11 = pan[cl2.index]
+    cl = arr.field('close')
+    sels = arr.select(cl[:, -1] > cl[:, -2])
 
     pr.disable()
     pr.dump_stats('vector.stats')
@@ -47,7 +44,7 @@ while limit < max_limit:
     now0 = time.time()
 
     #print (limit, now0 - then0)
-    #print (len(cl2.index))
+    #print (len(sels))
     #print (s.getvalue())
 
     limit *= 2
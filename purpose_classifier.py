@@ -0,0 +1,185 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+"""
+Classifies the 'Purpose' text of NSE corporate actions into dividends,
+bonuses and face value splits.
+
+The purpose text is tokenized in a single pass by one precompiled pattern
+(ratios like '1:1', numbers with an optional '%' and words) and classified
+with a simple state machine, so the time taken is linear in the length of the
+text. (The earlier regular expressions could backtrack catastrophically on
+long purpose texts.)
+
+ - Dividend : a word containing 'div' (but not 'division'), followed by an
+   amount in Rs. or a percentage of face value. 'Final ... and special
+   dividend' gives two dividends.
+ - Bonus : a word containing 'bon' followed by a ratio 'n:d'.
+ - Split : face value ('fv', 'f.v.' or 'face value') followed by a word
+   containing 'spl' and then the old and the new face values.
+
+NSE repeats the same purpose text thousands of times, so classifications are
+memoized on the normalized text.
+
+Golden corpus of purpose texts and their expected classifications is in
+`misc/purpose_golden.jsonl`, run this module to check it.
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+from functools import lru_cache
+
+# Size of the memo of purpose text -> classification.
+MEMO_SIZE = 4096
+
+_TOKEN_RE = re.compile(r'(?P<ratio>(?P<rn>\d+)\s*:\s*(?P<rd>\d+))|'
+                       r'(?P<num>\d+(?:\.\d+)?)(?P<pct>\s*%)?|'
+                       r'(?P<word>[a-z]+)')
+
+_GOLDEN_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'misc', 'purpose_golden.jsonl')
+
+
+def normalize(purpose):
+    """Returns the purpose text, lowercased with whitespace collapsed."""
+    return ' '.join(purpose.lower().split())
+
+
+def _tokens(text):
+    """Yields (kind, value) tokens for the normalized text."""
+    for m in _TOKEN_RE.finditer(text):
+        if m.group('ratio'):
+            yield 'ratio', (float(m.group('rn')), float(m.group('rd')))
+        elif m.group('num'):
+            yield ('pct' if m.group('pct') else 'num'), float(m.group('num'))
+        else:
+            yield 'word', m.group('word')
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def _classify(text):
+    dividends = []
+    bonus = None
+    split = None
+
+    div_pending = False
+    bon_pending = False
+    # Face value seen, 'spl' seen, old face value after 'spl'
+    fv_seen = False
+    spl_pending = False
+    split_from = None
+    prev_word = None
+
+    for kind, value in _tokens(text):
+        if kind == 'word':
+            if value == 'fv' or (prev_word == 'f' and value == 'v') or \
+                    (prev_word == 'face' and value.startswith('val')):
+                fv_seen = True
+            if 'div' in value and 'division' not in value:
+                if spl_pending and split_from is None:
+                    # 'spl div' is a special dividend, not a split.
+                    spl_pending = False
+                div_pending = True
+            elif 'bon' in value and bonus is None:
+                bon_pending = True
+            elif 'spl' in value and fv_seen and split is None:
+                spl_pending = True
+            prev_word = value
+            continue
+
+        prev_word = None
+        if kind == 'ratio':
+            if bon_pending:
+                n, d = value
+                if n + d:
+                    bonus = n / (n + d)
+                bon_pending = False
+            continue
+
+        # Numbers and percentages
+        if div_pending:
+            dividends.append((value, kind == 'pct'))
+            div_pending = False
+        elif spl_pending:
+            if split_from is None:
+                split_from = value
+            else:
+                if split_from:
+                    split = value / split_from
+                spl_pending = False
+
+    actions = [('D', 1.0, value, is_pct) for value, is_pct in dividends]
+    if bonus is not None:
+        actions.append(('B', bonus, 0.0, False))
+    if split is not None:
+        actions.append(('S', split, 0.0, False))
+    return tuple(actions)
+
+
+def classify(purpose):
+    """Returns a tuple of (action, ratio, value, is_pct) for the purpose
+    text, where action is 'D', 'B' or 'S'. For dividends value is in Rs. or a
+    percentage of face value (if is_pct), ratio is < 1.0 for bonuses and
+    splits."""
+    return _classify(normalize(purpose))
+
+
+def clear_memo():
+    _classify.cache_clear()
+
+
+def memo_info():
+    return _classify.cache_info()
+
+
+def dividend_amount(value, is_pct, face_value):
+    """Returns dividend amount in Rs."""
+    return value * (face_value / 100) if is_pct else value
+
+
+def check_golden(path=_GOLDEN_CORPUS):
+    """Classifies every purpose in the golden corpus at `path` (JSON lines of
+    purpose, face value and expected [action, ratio, amount] lists). Returns
+    a list of (purpose, expected, actual) for the mismatches."""
+
+    mismatches = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            case = json.loads(line)
+            actual = [[a, round(r, 6), round(dividend_amount(v, p,
+                                                             case['fv']), 6)]
+                      for a, r, v, p in classify(case['purpose'])]
+            if actual != case['expected']:
+                mismatches.append((case['purpose'], case['expected'], actual))
+    return mismatches
+
+
+def main(args):
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Checks the classifier "
+                                     "against the golden corpus.")
+
+    parser.add_argument("--golden",
+                        help="Golden corpus file. Default is %s." %
+                        _GOLDEN_CORPUS,
+                        default=_GOLDEN_CORPUS)
+
+    args = parser.parse_args(args)
+
+    mismatches = check_golden(args.golden)
+    for purpose, expected, actual in mismatches:
+        print("%r: expected %s, got %s" % (purpose, expected, actual))
+    print("%d mismatches." % len(mismatches))
+
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+
+    sys.exit(main(sys.argv[1:]))
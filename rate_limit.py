@@ -0,0 +1,54 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+"""
+A thread safe token bucket used to keep the number of requests we send to
+NSE/BSE within polite limits, instead of sleeping for a random amount of time
+after every request.
+
+Tokens are added to the bucket at `rate` tokens per second up to `capacity`.
+Every request takes a token out of the bucket, blocking till one is available.
+"""
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter. `rate` is in tokens per second, `capacity`
+    is the maximum burst allowed (defaults to `rate`, but at least 1)."""
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate should be greater than 0")
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1.0))
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, tokens=1):
+        """Takes `tokens` out of the bucket if available. Returns 0.0 on
+        success, or else number of seconds to wait before trying again."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Blocks till `tokens` are available and takes them."""
+        if tokens > self.capacity:
+            raise ValueError("Cannot acquire more tokens than capacity.")
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
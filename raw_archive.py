@@ -0,0 +1,102 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+"""
+A content addressed on-disk archive of raw files downloaded from the exchange
+(eg. bhavcopy zip and delivery DAT files), so that the DB can be rebuilt from
+the archive without downloading everything again.
+
+Layout of the archive directory is as follows -
+
+    objects/<first 2 chars of sha256>/<sha256>  - Raw contents.
+    refs/<source>/<YYYY>/<YYYYMMDD>             - sha256 of the contents
+                                                  for the source and date.
+
+All writes are done to a temporary file first and then renamed, so the archive
+is safe to be written from multiple threads or processes.
+"""
+
+import os
+import hashlib
+import tempfile
+from datetime import datetime as dt
+
+_REF_DATE_FMT = '%Y%m%d'
+
+
+class RawArchive(object):
+    """Archive of raw downloaded contents keyed by source and date."""
+
+    def __init__(self, root):
+        self.root = root
+        self._objects = os.path.join(root, 'objects')
+        self._refs = os.path.join(root, 'refs')
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def _ref_path(self, source, date):
+        return os.path.join(self._refs, source, date.strftime('%Y'),
+                            date.strftime(_REF_DATE_FMT))
+
+    @staticmethod
+    def _atomic_write(path, data):
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def put(self, source, date, content):
+        """Stores `content` (bytes) for the `source` and `date`. Returns the
+        sha256 hex digest of the content."""
+        digest = hashlib.sha256(content).hexdigest()
+        obj_path = self._object_path(digest)
+        if not os.path.exists(obj_path):
+            self._atomic_write(obj_path, content)
+        self._atomic_write(self._ref_path(source, date), digest.encode())
+        return digest
+
+    def path(self, source, date):
+        """Returns path of the archived contents for `source` and `date`, None
+        if not found in the archive."""
+        try:
+            with open(self._ref_path(source, date), 'rb') as f:
+                digest = f.read().decode().strip()
+        except IOError:
+            return None
+        obj_path = self._object_path(digest)
+        if not os.path.exists(obj_path):
+            return None
+        return obj_path
+
+    def open(self, source, date):
+        """Returns a binary file object for archived contents of `source` and
+        `date`. Raises IOError if not found."""
+        obj_path = self.path(source, date)
+        if obj_path is None:
+            raise IOError("%s for %s not found in archive." % (source, date))
+        return open(obj_path, 'rb')
+
+    def dates(self, source):
+        """Returns a sorted list of dates for which `source` is archived."""
+        source_dir = os.path.join(self._refs, source)
+        if not os.path.isdir(source_dir):
+            return []
+        dates = []
+        for year in os.listdir(source_dir):
+            for name in os.listdir(os.path.join(source_dir, year)):
+                if name.startswith('.tmp'):
+                    continue
+                dates.append(dt.date(dt.strptime(name, _REF_DATE_FMT)))
+        return sorted(dates)
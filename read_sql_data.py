@@ -1,58 +1,102 @@
 #pylint: disable-msg=broad-except, global-statement
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import desc
 
-from tickerplot.sql.sqlalchemy_wrapper import execute_one
 from tickerplot.sql.sqlalchemy_wrapper import create_or_get_all_scrips_table
 from tickerplot.sql.sqlalchemy_wrapper import create_or_get_nse_equities_hist_data
 from tickerplot.sql.sqlalchemy_wrapper import select_expr
 from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+
+from symbol_resolver import get_resolver
+
 _DB_METADATA = None
 
 def get_all_scrips_names_in_db(metadata=None):
+    """Returns a list of NSE symbols of all the NSE traded scrips, from the
+    `symbol_resolver` (so the DB is queried only the first time)."""
+    return get_resolver(metadata).traded_nse_symbols()
+
+_HIST_DATA_COLUMNS = ['open', 'high', 'low', 'close', 'volume', 'delivery']
+
+# Rows fetched from the DB at a time
+_READ_CHUNK_ROWS = 100000
+
+def get_hist_data_as_dataframe(metadata=None, from_date=None, to_date=None):
+    """Returns a single DataFrame with columns symbol, date and OHLCVD for all
+    the NSE traded scrips (in no particular order). `from_date` and `to_date`
+    (`datetime.date`) restrict the date range. Data is read using a single
+    streamed query."""
+
+    e = metadata.bind
+    hist_data = create_or_get_nse_equities_hist_data(metadata=metadata)
     all_scrips_table = create_or_get_all_scrips_table(metadata=metadata)
-    scrips_select_st = select_expr([all_scrips_table.c.nse_symbol]).\
-                                   where(all_scrips_table.c.nse_traded == True)
 
+    nse_scrips = select_expr([all_scrips_table.c.nse_symbol]).\
+                            where(all_scrips_table.c.nse_traded == True)
+
+    sql_st = select_expr([hist_data.c.symbol, hist_data.c.date,
+                        hist_data.c.open, hist_data.c.high,
+                        hist_data.c.low, hist_data.c.close,
+                        hist_data.c.volume, hist_data.c.delivery]).\
+                            where(hist_data.c.symbol.in_(nse_scrips))
+    if from_date:
+        sql_st = sql_st.where(hist_data.c.date >= from_date)
+    if to_date:
+        sql_st = sql_st.where(hist_data.c.date <= to_date)
+
+    chunks = list(pd.io.sql.read_sql(sql_st, e, chunksize=_READ_CHUNK_ROWS))
+    if chunks:
+        alldata = pd.concat(chunks, ignore_index=True)
+    else:
+        alldata = pd.DataFrame(columns=['symbol', 'date'] + _HIST_DATA_COLUMNS)
+    alldata.columns = ['symbol', 'date'] + _HIST_DATA_COLUMNS
 
-    result = execute_one(scrips_select_st, engine=metadata.bind)
-    symbols = [row[0] for row in result.fetchall()]
+    alldata['date'] = pd.to_datetime(alldata['date'])
 
-    return symbols
+    return alldata
 
 # FIXME metadata=None doesn't look correct, we need to pass db_meta perhaps?
-def get_hist_data_as_dataframes_dict(metadata=None, limit=0, max_scrips=16000):
-    lscrips = get_all_scrips_names_in_db(metadata=metadata)
+def get_hist_data_as_dataframes_dict(metadata=None, limit=0, max_scrips=16000,
+                                     from_date=None, to_date=None):
+    """Returns a dictionary of symbol -> DataFrame of historical data (latest
+    first) for all the NSE traded scrips. If `limit` is given, only last
+    `limit` rows for every symbol are returned. `from_date` and `to_date`
+    (`datetime.date`) restrict the date range.
 
-    e = metadata.bind
-    hist_data = create_or_get_nse_equities_hist_data(metadata=metadata)
+    All the data is read using a single streamed query and then split per
+    symbol, instead of one query per symbol."""
 
-    scripdata_dict = {}
-    scrips = 0
-    for scrip in lscrips:
-        sql_st = select_expr([hist_data.c.date,
-                            hist_data.c.open, hist_data.c.high,
-                            hist_data.c.low, hist_data.c.close,
-                            hist_data.c.volume, hist_data.c.delivery]).\
-                                where(hist_data.c.symbol == scrip).\
-                                        order_by(desc(hist_data.c.date))
+    all_scrips = get_all_scrips_names_in_db(metadata=metadata)
+    lscrips = all_scrips[:max_scrips]
+
+    alldata = get_hist_data_as_dataframe(metadata=metadata,
+                                         from_date=from_date, to_date=to_date)
 
-        if limit and isinstance(limit, int) and limit > 0:
-            sql_st = sql_st.limit(limit)
+    if len(lscrips) < len(all_scrips):
+        alldata = alldata[alldata['symbol'].isin(lscrips)]
+    alldata = alldata.sort_values(['symbol', 'date'], ascending=[True, False],
+                                  kind='mergesort')
 
-        scripdata = pd.io.sql.read_sql(sql_st, e)
+    if limit and isinstance(limit, int) and limit > 0:
+        alldata = alldata.groupby('symbol', sort=False).head(limit)
 
-        scripdata.columns = ['date', 'open', 'high', 'low', 'close', 'volume',
-                            'delivery']
-        scripdata.reset_index(inplace=True)
-        scripdata.set_index(pd.DatetimeIndex(scripdata['date']), inplace=True)
-        scripdata.drop('date', axis=1, inplace=True)
-        scripdata_dict[scrip] = scripdata
+    alldata.set_index('date', inplace=True)
 
-        scrips += 1
-        if scrips == max_scrips:
-            break
+    # Rows are sorted by symbol, so every symbol is a contiguous slice.
+    symbols = alldata['symbol'].values
+    starts = np.flatnonzero(np.r_[True, symbols[1:] != symbols[:-1]])
+    ends = np.r_[starts[1:], len(symbols)]
+
+    values = alldata[_HIST_DATA_COLUMNS]
+    scripdata_dict = {}
+    for start, end in zip(starts, ends):
+        scripdata_dict[symbols[start]] = values.iloc[start:end]
+
+    empty = values.iloc[0:0]
+    for scrip in lscrips:
+        if scrip not in scripdata_dict:
+            scripdata_dict[scrip] = empty
 
     return scripdata_dict
 
@@ -78,7 +122,8 @@ def main(args):
                                                             args.dbpath, e))
             return -1
 
-    get_hist_data_as_dataframes_dict()
+    scripdata_dict = get_hist_data_as_dataframes_dict(metadata=_DB_METADATA)
+    print("Read data for {} scrips.".format(len(scripdata_dict)))
 
     return 0
 
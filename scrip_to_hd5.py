@@ -5,6 +5,7 @@
 import pandas as pd
 
 from corp_actions_nse import get_corp_action_csv
+from corp_adjust import actions_frame, adjustment_factors
 
 csv_filename = '500209.csv'
 
@@ -39,16 +40,10 @@ infy = h5store['infy']
 corp_actions = h5store.get_storer('infy').attrs.corp_actions
 
 print(infy[:10])
-for act in corp_actions:
-    if act.action in ['B', 'S']:
-        ts = pd.Timestamp(act.ex_date)
-        ratio = act.ratio
-        infy['O'][infy.index < ts] = infy['O'] * ratio
-        infy['H'][infy.index < ts] = infy['H'] * ratio
-        infy['L'][infy.index < ts] = infy['L'] * ratio
-        infy['C'][infy.index < ts] = infy['C'] * ratio
-        infy['V'][infy.index < ts] = infy['V'] / ratio
-        infy['D'][infy.index < ts] = infy['D'] / ratio
+factors = adjustment_factors(actions_frame(corp_actions), ['INFY'],
+                             infy.index.values)[0]
+infy[list('OHLC')] = infy[list('OHLC')].mul(factors, axis=0)
+infy[list('VD')] = infy[list('VD')].div(factors, axis=0)
 
 print(infy[:10])
 h5store.close()
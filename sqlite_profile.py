@@ -0,0 +1,173 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+#pylint: disable-msg=broad-except
+"""
+An opt-in performance profile for SQLite DBs, and maintenance commands.
+
+With the profile enabled every connection to the DB uses -
+ - WAL journaling, so readers (eg. screens using `read_sql_data`) can run
+   while a download or backfill is writing. (WAL is a property of the DB file,
+   once set it stays for all the connections.)
+ - synchronous=NORMAL, so a commit doesn't wait for an fsync. (A commit may be
+   lost on a power failure, but the DB is never corrupted. We can always
+   download the day again.)
+ - A larger page cache and memory mapped I/O, and temporary tables in memory.
+
+Downloaders also group the writes of many days into a single transaction
+when the profile is enabled (see `get_stocks_nse.BhavcopyWriter`).
+
+In WAL mode, the WAL file is checkpointed into the DB automatically, but it's
+never truncated and a VACUUM is required to give back the space of deleted
+rows, `main` does both.
+"""
+
+import os
+import sys
+
+from sqlalchemy import event
+
+from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+
+from tickerplot.utils.logger import get_logger
+module_logger = get_logger(os.path.basename(__file__))
+
+# Defaults for cache and mmap sizes in MB
+CACHE_MB = 256
+MMAP_MB = 1024
+
+# Lock waits (in ms) before giving up with 'database is locked'
+BUSY_TIMEOUT_MS = 30000
+
+# Engines (by URL) for which the profile is enabled.
+_ENABLED = set()
+
+
+def _pragmas(cache_mb, mmap_mb):
+    return [('journal_mode', 'WAL'),
+            ('synchronous', 'NORMAL'),
+            # Negative is in KiB rather than in pages
+            ('cache_size', -cache_mb * 1024),
+            ('mmap_size', mmap_mb * 1024 * 1024),
+            ('temp_store', 'MEMORY'),
+            ('busy_timeout', BUSY_TIMEOUT_MS)]
+
+
+def _is_sqlite(metadata):
+    return metadata.bind.dialect.name == 'sqlite'
+
+
+def enable(metadata, cache_mb=CACHE_MB, mmap_mb=MMAP_MB):
+    """Enables the performance profile for all the connections to the DB.
+    Returns False (and does nothing) if the DB is not SQLite."""
+
+    engine = metadata.bind
+    if not _is_sqlite(metadata):
+        module_logger.warning("Not a SQLite DB, ignoring the SQLite profile.")
+        return False
+    if str(engine.url) in _ENABLED:
+        return True
+
+    pragmas = _pragmas(cache_mb, mmap_mb)
+
+    def _set_pragmas(dbapi_conn, _):
+        cursor = dbapi_conn.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    event.listen(engine, 'connect', _set_pragmas)
+    # Connections already in the pool don't have the pragmas.
+    engine.dispose()
+    _ENABLED.add(str(engine.url))
+
+    module_logger.info("SQLite profile enabled: %s",
+                       ", ".join("%s=%s" % p for p in pragmas))
+    return True
+
+
+def is_enabled(metadata):
+    """Returns whether the profile is enabled for the DB."""
+    return metadata is not None and str(metadata.bind.url) in _ENABLED
+
+
+def checkpoint(metadata):
+    """Checkpoints the WAL into the DB and truncates it. Returns a tuple of
+    (busy, WAL pages, pages checkpointed) as returned by SQLite."""
+
+    with metadata.bind.connect() as conn:
+        result = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    module_logger.info("Checkpoint: busy %d, WAL pages %d, checkpointed %d",
+                       *result)
+    return tuple(result)
+
+
+def vacuum(metadata):
+    """Rebuilds the DB file giving back the free pages, and updates the
+    statistics used by the query planner."""
+
+    with metadata.bind.connect() as conn:
+        conn.execute('VACUUM')
+        conn.execute('ANALYZE')
+    module_logger.info("Vacuumed and analyzed %s", metadata.bind.url)
+
+
+def main(args):
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Maintenance of SQLite "
+                                     "DBs used with the performance profile.")
+
+    # --wal option
+    parser.add_argument("--wal",
+                        help="Switch the DB to WAL journaling.",
+                        action="store_true")
+
+    # --checkpoint option
+    parser.add_argument("--checkpoint",
+                        help="Checkpoint and truncate the WAL.",
+                        action="store_true")
+
+    # --vacuum option
+    parser.add_argument("--vacuum",
+                        help="VACUUM and ANALYZE the DB. Requires no other "
+                        "connections to the DB.",
+                        action="store_true")
+
+    # --dbpath option
+    parser.add_argument("--dbpath",
+                        help="Database URL to be used.",
+                        dest="dbpath")
+
+    args = parser.parse_args(args)
+
+    try:
+        db_meta = get_metadata(args.dbpath)
+    except Exception as e:
+        print("Not a valid DB URL: {} (Exception: {})".format(
+            args.dbpath, e))
+        return -1
+
+    if not _is_sqlite(db_meta):
+        print("Not a SQLite DB: {}".format(args.dbpath))
+        return -1
+
+    if not (args.wal or args.checkpoint or args.vacuum):
+        print(parser.format_usage())
+        return -1
+
+    if args.wal:
+        enable(db_meta)
+        with db_meta.bind.connect() as conn:
+            mode = conn.execute('PRAGMA journal_mode').scalar()
+        print("Journal mode: %s" % mode)
+    if args.checkpoint:
+        checkpoint(db_meta)
+    if args.vacuum:
+        vacuum(db_meta)
+
+    return 0
+
+if __name__ == '__main__':
+
+    sys.exit(main(sys.argv[1:]))
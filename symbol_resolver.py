@@ -0,0 +1,381 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+#pylint: disable-msg=broad-except
+"""
+Resolves NSE symbols, ISINs, BSE IDs and integer security IDs to each other.
+
+`all_scrips_info` and the symbol name change history (`name_changes`) are
+loaded once into arrays indexed by the position of the security, with the
+strings interned, and dictionaries from every key to that position. So all
+the lookups are O(1) without any round trips to the DB.
+
+Every security gets a small integer security ID that never changes, saved
+in the `security_ids` table (by ISIN, or by NSE symbol for securities we
+don't have an ISIN for, eg. the ones only in the historical data), so that
+data can be keyed on these instead of symbol strings. IDs are assigned by the
+downloaders (`all_stocks_list`) and the migration (`hist_data_by_id`),
+loading a resolver only reads the DB.
+
+Symbols are point in time. A symbol seen on a date (eg. in a bhavcopy) is
+resolved to the current symbol using the name changes after that date, and
+`symbol_on` gives what a security was called on a date.
+"""
+
+import os
+import sys
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import Table, Column, Integer, String, inspect
+
+from tickerplot.sql.sqlalchemy_wrapper import create_or_get_all_scrips_table
+from tickerplot.sql.sqlalchemy_wrapper import execute_one, select_expr
+from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+
+from bulk_writer import bulk_insert
+from name_changes import create_or_get_symbol_name_changes
+
+from tickerplot.utils.logger import get_logger
+module_logger = get_logger(os.path.basename(__file__))
+
+_intern = sys.intern
+
+Security = namedtuple('Security', ['security_id', 'isin', 'nse_symbol',
+                                   'bse_id', 'nse_traded'])
+
+# Resolvers loaded by `get_resolver`, by DB URL.
+_RESOLVERS = {}
+
+
+def create_or_get_security_ids(metadata=None):
+    """Creates (if required) and returns the `security_ids` table. A security
+    is identified by it's ISIN, or if there's none, by it's NSE symbol."""
+    table_name = 'security_ids'
+    if table_name in metadata.tables:
+        return metadata.tables[table_name]
+
+    tbl = Table(table_name, metadata,
+                Column('security_id', Integer, primary_key=True,
+                       autoincrement=False),
+                Column('isin', String(16), unique=True),
+                Column('nse_symbol', String(64), unique=True))
+    tbl.create(bind=metadata.bind, checkfirst=True)
+    return tbl
+
+
+def _str(s):
+    return _intern(str(s)) if s else None
+
+
+class SymbolResolver(object):
+    """Lookups between NSE symbols, ISINs, BSE IDs and security IDs.
+
+    `securities` is a list of `Security` (security ID is -1 for securities not
+    assigned one yet), `name_changes` a list of (old, new, change date)."""
+
+    def __init__(self, securities, name_changes=()):
+        n = len(securities)
+        self.security_ids = np.empty(n, dtype=np.int64)
+        self.isins = np.empty(n, dtype=object)
+        self.nse_symbols = np.empty(n, dtype=object)
+        self.bse_ids = np.empty(n, dtype=object)
+        self.nse_traded = np.zeros(n, dtype=bool)
+
+        self._by_id = {}
+        self._by_isin = {}
+        self._by_nse_symbol = {}
+        self._by_bse_id = {}
+
+        for i, sec in enumerate(securities):
+            isin, nse_symbol, bse_id = \
+                _str(sec.isin), _str(sec.nse_symbol), _str(sec.bse_id)
+            self.security_ids[i] = sec.security_id
+            self.isins[i] = isin
+            self.nse_symbols[i] = nse_symbol
+            self.bse_ids[i] = bse_id
+            self.nse_traded[i] = bool(sec.nse_traded)
+
+            if sec.security_id >= 0:
+                self._by_id[int(sec.security_id)] = i
+            if isin:
+                self._by_isin[isin] = i
+            if nse_symbol:
+                # A traded security wins over an old one with the same symbol.
+                if nse_symbol not in self._by_nse_symbol or sec.nse_traded:
+                    self._by_nse_symbol[nse_symbol] = i
+            if bse_id:
+                self._by_bse_id[bse_id] = i
+
+        # For vectorized lookups of NSE symbols
+        self._nse_symbol_index = pd.Index(list(self._by_nse_symbol.keys()))
+        self._nse_symbol_rows = np.array(list(self._by_nse_symbol.values()),
+                                         dtype=np.int64)
+
+        # symbol -> (sorted change dates, new symbols) and
+        # symbol -> (sorted change dates, old symbols)
+        renames_from = {}
+        renames_to = {}
+        for old, new, chdt in sorted(name_changes, key=lambda c: c[2]):
+            old, new = _str(old), _str(new)
+            renames_from.setdefault(old, ([], []))
+            renames_from[old][0].append(chdt)
+            renames_from[old][1].append(new)
+            renames_to.setdefault(new, ([], []))
+            renames_to[new][0].append(chdt)
+            renames_to[new][1].append(old)
+        self._renames_from = renames_from
+        self._renames_to = renames_to
+
+    def __len__(self):
+        return len(self.security_ids)
+
+    def _security(self, i):
+        if i is None:
+            return None
+        return Security(int(self.security_ids[i]), self.isins[i],
+                        self.nse_symbols[i], self.bse_ids[i],
+                        bool(self.nse_traded[i]))
+
+    def current_symbol(self, symbol, on=None):
+        """Returns the current symbol of the security that was called
+        `symbol` on the date `on` (`datetime.date`, default today)."""
+        if on is None:
+            return symbol
+        while symbol in self._renames_from:
+            dates, new = self._renames_from[symbol]
+            i = bisect_right(dates, on)
+            if i == len(dates):
+                break
+            symbol, on = new[i], dates[i]
+        return symbol
+
+    def symbol_on(self, symbol, on):
+        """Returns what the security with current symbol `symbol` was called on
+        the date `on` (`datetime.date`)."""
+        upto = None
+        while symbol in self._renames_to:
+            dates, old = self._renames_to[symbol]
+            # Latest rename into symbol (before the rename we came from)
+            i = (len(dates) if upto is None else bisect_left(dates, upto)) - 1
+            if i < 0 or dates[i] <= on:
+                break
+            symbol, upto = old[i], dates[i]
+        return symbol
+
+    def by_nse_symbol(self, symbol, on=None):
+        """Returns the `Security` for the NSE symbol as of the date `on`
+        (default today), None if not known."""
+        return self._security(self._by_nse_symbol.get(
+            self.current_symbol(symbol, on)))
+
+    def by_isin(self, isin):
+        return self._security(self._by_isin.get(isin))
+
+    def by_bse_id(self, bse_id):
+        return self._security(self._by_bse_id.get(bse_id))
+
+    def by_security_id(self, security_id):
+        return self._security(self._by_id.get(security_id))
+
+    def security_id(self, symbol, on=None):
+        """Returns the security ID for the NSE symbol as of the date `on`
+        (default today), None if not known."""
+        i = self._by_nse_symbol.get(self.current_symbol(symbol, on))
+        if i is None or self.security_ids[i] < 0:
+            return None
+        return int(self.security_ids[i])
+
+    def security_ids_for(self, symbols, on=None):
+        """Returns an int64 array of security IDs for the NSE `symbols` (an
+        array like) as of the date `on`, -1 for symbols not known."""
+        symbols = pd.Index(symbols)
+        if on is not None and self._renames_from:
+            uniq = symbols.unique()
+            current = dict((s, self.current_symbol(s, on)) for s in uniq
+                           if s in self._renames_from)
+            if current:
+                symbols = pd.Index([current.get(s, s) for s in symbols])
+        pos = self._nse_symbol_index.get_indexer(symbols)
+        ids = np.full(len(symbols), -1, dtype=np.int64)
+        found = pos >= 0
+        ids[found] = self.security_ids[self._nse_symbol_rows[pos[found]]]
+        return ids
+
+    def traded_nse_symbols(self):
+        """Returns a list of NSE symbols of the securities traded on NSE."""
+        return [s for s in self.nse_symbols[self.nse_traded] if s]
+
+
+def _has_table(metadata, table_name):
+    return table_name in inspect(metadata.bind).get_table_names()
+
+
+def _load_name_changes(metadata):
+    if not _has_table(metadata, 'symbol_name_changes'):
+        return []
+    tbl = create_or_get_symbol_name_changes(metadata=metadata)
+    result = execute_one(select_expr([tbl.c.old_symbol, tbl.c.new_symbol,
+                                      tbl.c.change_date]),
+                         engine=metadata.bind)
+    changes = [tuple(r) for r in result.fetchall()]
+    result.close()
+    return changes
+
+
+def assign_security_ids(metadata, isins=(), nse_symbols=()):
+    """Assigns security IDs to the `isins` and (securities without an ISIN)
+    `nse_symbols` that don't have one yet. Returns a dictionary of ISIN or
+    NSE symbol -> security ID for all the securities."""
+
+    tbl = create_or_get_security_ids(metadata=metadata)
+
+    with metadata.bind.begin() as conn:
+        rows = conn.execute(select_expr([tbl.c.security_id, tbl.c.isin,
+                                         tbl.c.nse_symbol])).fetchall()
+        ids = {}
+        for sid, isin, nse_symbol in rows:
+            ids[isin or nse_symbol] = sid
+
+        next_id = max(ids.values()) + 1 if ids else 1
+        new_rows = []
+        for key, col in ([(i, 'isin') for i in sorted(set(isins))] +
+                         [(s, 'nse_symbol') for s in sorted(set(nse_symbols))]):
+            if not key or key in ids:
+                continue
+            ids[key] = next_id
+            new_rows.append({'security_id': next_id, 'isin': None,
+                             'nse_symbol': None, col: key})
+            next_id += 1
+        bulk_insert(tbl, new_rows, conn=conn)
+    return ids
+
+
+def assign_scrips_security_ids(metadata):
+    """Assigns security IDs to the securities in `all_scrips_info` that don't
+    have one yet. Returns a dictionary like `assign_security_ids`."""
+
+    scrips = create_or_get_all_scrips_table(metadata=metadata)
+    result = execute_one(select_expr([scrips.c.security_isin]),
+                         engine=metadata.bind)
+    isins = [r[0] for r in result.fetchall()]
+    result.close()
+    return assign_security_ids(metadata, isins=isins)
+
+
+def _load_security_ids(metadata):
+    """Returns a dictionary of ISIN or NSE symbol -> security ID."""
+    if not _has_table(metadata, 'security_ids'):
+        return {}
+    tbl = create_or_get_security_ids(metadata=metadata)
+    result = execute_one(select_expr([tbl.c.security_id, tbl.c.isin,
+                                      tbl.c.nse_symbol]),
+                         engine=metadata.bind)
+    ids = dict((isin or nse_symbol, sid)
+               for sid, isin, nse_symbol in result.fetchall())
+    result.close()
+    return ids
+
+
+def load_resolver(metadata):
+    """Loads `all_scrips_info`, the name changes and the security IDs from
+    the DB and returns a `SymbolResolver`. Only reads the DB, tables that
+    don't exist are taken as empty and securities not assigned an ID yet
+    (see `assign_scrips_security_ids`) have the ID -1."""
+
+    rows = []
+    if _has_table(metadata, 'all_scrips_info'):
+        scrips = create_or_get_all_scrips_table(metadata=metadata)
+        result = execute_one(select_expr([scrips.c.security_isin,
+                                          scrips.c.nse_symbol,
+                                          scrips.c.bse_id,
+                                          scrips.c.nse_traded]),
+                             engine=metadata.bind)
+        rows = result.fetchall()
+        result.close()
+
+    ids = _load_security_ids(metadata)
+    isins = set(r[0] for r in rows)
+
+    securities = [Security(ids.get(isin, -1), isin, nse_symbol, bse_id,
+                           nse_traded)
+                  for isin, nse_symbol, bse_id, nse_traded in rows]
+    # Securities known only by the NSE symbol
+    securities.extend(Security(sid, None, key, None, False)
+                      for key, sid in ids.items() if key not in isins)
+
+    resolver = SymbolResolver(securities, _load_name_changes(metadata))
+    module_logger.info("Loaded %d securities.", len(resolver))
+    return resolver
+
+
+def _resolver_key(metadata):
+    return str(metadata.bind.url)
+
+
+def get_resolver(metadata):
+    """Returns the `SymbolResolver` for the DB, loading it the first time."""
+    key = _resolver_key(metadata)
+    resolver = _RESOLVERS.get(key)
+    if resolver is None:
+        resolver = load_resolver(metadata)
+        _RESOLVERS[key] = resolver
+    return resolver
+
+
+def invalidate(metadata):
+    """Drops the `SymbolResolver` for the DB (eg. after `all_scrips_info` or
+    the name changes are updated) so that it's loaded again when required."""
+    _RESOLVERS.pop(_resolver_key(metadata), None)
+
+
+def main(args):
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Looks up securities by "
+                                     "NSE symbol, ISIN or BSE ID.")
+
+    parser.add_argument("keys",
+                        help="NSE symbols, ISINs or BSE IDs.",
+                        nargs='+')
+
+    # --on option
+    parser.add_argument("--on",
+                        help="Date (DD-MM-YYYY) as of which NSE symbols are "
+                        "looked up. Default is today.")
+
+    # --dbpath option
+    parser.add_argument("--dbpath",
+                        help="Database URL to be used.",
+                        dest="dbpath")
+
+    args = parser.parse_args(args)
+
+    try:
+        db_meta = get_metadata(args.dbpath)
+    except Exception as e:
+        print("Not a valid DB URL: {} (Exception: {})".format(
+            args.dbpath, e))
+        return -1
+
+    from datetime import datetime as dt
+    try:
+        on = dt.date(dt.strptime(args.on, '%d-%m-%Y')) if args.on else None
+    except ValueError:
+        print(parser.format_usage())
+        return -1
+
+    resolver = get_resolver(db_meta)
+    for key in args.keys:
+        sec = resolver.by_nse_symbol(key, on) or resolver.by_isin(key) or \
+            resolver.by_bse_id(key)
+        print("%s: %s" % (key, sec))
+
+    return 0
+
+if __name__ == '__main__':
+
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,9 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+"""Makes the modules in the top level directory importable by the tests."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,40 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+from sqlalchemy import MetaData, Table, Column, Integer, String, Boolean
+from sqlalchemy import Sequence, func
+from sqlalchemy.dialects import postgresql
+
+import bulk_writer
+
+
+def _table(*columns, **kwargs):
+    return Table('Hist Data', MetaData(),
+                 Column('symbol', String(64)), Column('Close', Integer),
+                 *columns, **kwargs)
+
+
+def test_copy_statement_quotes_names():
+    tbl = _table(schema='market')
+    st = bulk_writer._copy_statement(postgresql.dialect(), tbl,
+                                     ['symbol', 'Close'])
+    assert st.startswith('COPY market."Hist Data" (symbol, "Close") FROM')
+
+
+def test_copy_defaults():
+    tbl = _table(Column('applied', Boolean, default=False),
+                 Column('source', String(8), default='NSE'),
+                 Column('updated', Integer, server_default='0'))
+    assert bulk_writer._copy_defaults(tbl, ['symbol', 'Close']) == \
+        {'applied': False, 'source': 'NSE'}
+    assert bulk_writer._copy_defaults(
+        tbl, ['symbol', 'Close', 'applied', 'source']) == {}
+
+
+def test_no_copy_for_other_defaults():
+    tbl = _table(Column('id', Integer, Sequence('hist_id_seq')))
+    assert bulk_writer._copy_defaults(tbl, ['symbol', 'Close']) is None
+    tbl = _table(Column('loaded', Integer, default=func.now()))
+    assert bulk_writer._copy_defaults(tbl, ['symbol', 'Close']) is None
+    tbl = _table(Column('loaded', Integer, default=lambda: 1))
+    assert bulk_writer._copy_defaults(tbl, ['symbol', 'Close']) is None
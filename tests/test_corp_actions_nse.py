@@ -0,0 +1,135 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+from datetime import date
+
+from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+from tickerplot.sql.sqlalchemy_wrapper import \
+    create_or_get_nse_corp_actions_hist_data
+from tickerplot.sql.sqlalchemy_wrapper import select_expr, execute_one
+
+import corp_actions_nse
+
+_HEADER = '"Symbol","Company","Industry","Series","Face Value(Rs.)",' \
+    '"Purpose","Ex-Date","Record Date","BC Start Date","BC End Date",' \
+    '"No Delivery Start Date","No Delivery End Date"'
+
+
+def _csv_line(purpose, record_date='10-Jul-2015', company='Infosys Limited'):
+    return '"INFY","%s","IT","EQ","5","%s","08-Jul-2015","%s","-","-",' \
+        '"-","-"' % (company, purpose, record_date)
+
+
+def _actions(lines):
+    return corp_actions_nse._process_ca_text('\n'.join([_HEADER] + lines))
+
+
+def _dividends(lines):
+    actions = _actions(lines)
+    rows = [a._asdict() for a in actions]
+    for row in rows:
+        row['symbol'] = row.pop('sym')
+    return [(r['symbol'], r['ex_date'], r['delta'])
+            for r in corp_actions_nse._merge_corp_actions(rows)
+            if r['action'] == 'D']
+
+
+def test_repeated_dividend_is_not_added_up():
+    # Same dividend in the per symbol CSV and the period CSV (with a
+    # different company name), and again with it's purpose revised.
+    lines = [_csv_line('Final Dividend - Rs 14.25 Per Share'),
+             _csv_line('Final Dividend - Rs 14.25 Per Share',
+                       company='Infosys Ltd'),
+             _csv_line('Final Dividend - Rs 14.25 Per Share '
+                       '(Purpose Revised)', record_date='11-Jul-2015')]
+    assert _dividends(lines) == [('INFY', date(2015, 7, 8), 14.25)]
+
+
+def test_same_amount_dividends_are_added_up():
+    lines = [_csv_line('Interim Dividend - Rs 5 Per Share'),
+             _csv_line('Special Dividend - Rs 5 Per Share')]
+    assert _dividends(lines) == [('INFY', date(2015, 7, 8), 10.0)]
+
+
+def test_different_dividends_are_added_up():
+    lines = [_csv_line('Final Dividend - Rs 14.25 Per Share'),
+             _csv_line('Special Dividend - Rs 10 Per Share'),
+             _csv_line('Special Dividend - Rs 10 Per Share',
+                       company='Infosys Ltd')]
+    assert _dividends(lines) == [('INFY', date(2015, 7, 8), 24.25)]
+
+
+def _saved_dividends(db_meta):
+    tbl = create_or_get_nse_corp_actions_hist_data(metadata=db_meta)
+    result = execute_one(select_expr([tbl.c.symbol, tbl.c.ex_date,
+                                      tbl.c.delta]).
+                         where(tbl.c.action == 'D'), engine=db_meta.bind)
+    rows = [tuple(r) for r in result.fetchall()]
+    result.close()
+    return rows
+
+
+def test_saved_dividends_are_merged(tmp_path):
+    db_meta = get_metadata('sqlite:///%s' % tmp_path.joinpath('test.db'))
+    interim = _csv_line('Interim Dividend - Rs 5 Per Share')
+    special = _csv_line('Special Dividend - Rs 5 Per Share')
+    ex_date = date(2015, 7, 8)
+
+    corp_actions_nse.save_corp_actions(_actions([interim, special]), db_meta)
+    assert _saved_dividends(db_meta) == [('INFY', ex_date, 10.0)]
+
+    # A later download having only one of them, or both again.
+    corp_actions_nse.save_corp_actions(_actions([special]), db_meta)
+    assert _saved_dividends(db_meta) == [('INFY', ex_date, 10.0)]
+    corp_actions_nse.save_corp_actions(_actions([special, interim]), db_meta)
+    assert _saved_dividends(db_meta) == [('INFY', ex_date, 10.0)]
+
+    final = _csv_line('Final Dividend - Rs 2.5 Per Share')
+    corp_actions_nse.save_corp_actions(_actions([final]), db_meta)
+    assert _saved_dividends(db_meta) == [('INFY', ex_date, 12.5)]
+
+
+def test_dividends_saved_without_purposes(tmp_path):
+    db_meta = get_metadata('sqlite:///%s' % tmp_path.joinpath('test.db'))
+    ex_date = date(2015, 7, 8)
+    tbl = create_or_get_nse_corp_actions_hist_data(metadata=db_meta)
+    with db_meta.bind.begin() as conn:
+        conn.execute(tbl.insert(), [{'symbol': 'INFY', 'ex_date': ex_date,
+                                     'action': 'D', 'ratio': 1.0,
+                                     'delta': 10.0}])
+
+    interim = _csv_line('Interim Dividend - Rs 5 Per Share')
+    corp_actions_nse.save_corp_actions(_actions([interim]), db_meta)
+    assert _saved_dividends(db_meta) == [('INFY', ex_date, 10.0)]
+    corp_actions_nse.save_corp_actions(_actions([interim]), db_meta)
+    assert _saved_dividends(db_meta) == [('INFY', ex_date, 10.0)]
+
+
+def test_bulk_download_fetches_symbols_once(tmp_path, monkeypatch):
+    db_meta = get_metadata('sqlite:///%s' % tmp_path.joinpath('test.db'))
+    fetched = []
+
+    def get_corp_action_csv(sym_name=None, time_period=None):
+        fetched.append(sym_name)
+        return []
+
+    monkeypatch.setattr(corp_actions_nse, 'get_bulk_corp_actions',
+                        lambda time_periods: [])
+    monkeypatch.setattr(corp_actions_nse, 'get_corp_action_csv',
+                        get_corp_action_csv)
+    monkeypatch.setattr(corp_actions_nse, '_SYMBOL_ENDPOINT',
+                        corp_actions_nse.Endpoint(rate=100, concurrency=1))
+
+    assert corp_actions_nse.bulk_download(db_meta, ['INFY', 'TCS']) == \
+        ['INFY', 'TCS']
+    assert corp_actions_nse.bulk_download(db_meta, ['INFY', 'TCS', 'WIPRO']) \
+        == ['WIPRO']
+    assert corp_actions_nse.bulk_download(db_meta, ['INFY', 'WIPRO']) == []
+    assert sorted(fetched) == ['INFY', 'TCS', 'WIPRO']
+    assert corp_actions_nse.symbols_fetched(db_meta) == \
+        set(['INFY', 'TCS', 'WIPRO'])
+
+
+def test_bulk_needs_all(monkeypatch):
+    monkeypatch.setattr('sys.argv', ['corp_actions_nse.py', '--bulk'])
+    assert corp_actions_nse.main([]) == -1
@@ -0,0 +1,44 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+import os
+import glob
+
+import numpy as np
+
+import get_indices_nse
+
+_PAGES_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'misc', 'index_pages')
+
+
+def _pages():
+    return sorted(glob.glob(os.path.join(_PAGES_DIR, '*.html')))
+
+
+def test_parser_matches_bs4_on_saved_pages():
+    pages = _pages()
+    assert pages
+    assert get_indices_nse.check_parser(pages) == []
+
+
+def test_parser_strips_thousands_separators():
+    path = os.path.join(_PAGES_DIR, 'nifty_50_jan_2020.html')
+    with open(path) as f:
+        rows = get_indices_nse._table_data_rows(
+            get_indices_nse.table_rows(f.read()))
+    data = get_indices_nse.parse_index_rows(rows)
+    assert str(data.dates[0]) == '2020-01-01'
+    assert np.allclose(data.ohlc[0], [12202.15, 12222.20, 12165.30, 12182.50])
+
+
+def test_bs4_errors_are_mismatches(tmp_path):
+    path = os.path.join(_PAGES_DIR, 'nifty_50_jan_2020.html')
+    with open(path) as f:
+        text = f.read()
+    # A row with no data, skipped by parse_index_rows, but not by bs4.
+    bad_row = '<tr>\n<td class="date">09-Jan-2020</td>\n' + \
+        '<td class="number">-</td>\n' * 6 + '</tr>\n<tr><td colspan="7"><a'
+    bad = tmp_path.joinpath('bad_row.html')
+    bad.write_text(text.replace('<tr><td colspan="7"><a', bad_row, 1))
+    assert get_indices_nse.check_parser([str(bad)]) == [str(bad)]
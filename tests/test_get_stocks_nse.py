@@ -0,0 +1,100 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+import time
+import threading
+from datetime import date
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+from tickerplot.sql.sqlalchemy_wrapper import \
+    create_or_get_nse_bhav_deliv_download_info, \
+    create_or_get_nse_equities_hist_data
+
+import benchmarks
+import get_stocks_nse
+import sqlite_profile
+
+_SYMBOLS = 20
+
+# Days served by the local server, a day not served gives 404.
+_DAYS = [date(2019, 12, 30), date(2019, 12, 31)]
+_MISSING_DAY = date(2020, 1, 1)
+
+
+class _FixtureHandler(BaseHTTPRequestHandler):
+    files = {}
+    hosts = []
+
+    def do_GET(self):
+        self.hosts.append(self.headers.get('Host'))
+        content = self.files.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def nse_server(monkeypatch):
+    files = {}
+    for n, d2 in enumerate(_DAYS):
+        bhav_url, deliv_url = get_stocks_nse._bhavcopy_urls(d2)
+        bhav, deliv = benchmarks.synthetic_bhavcopy(_SYMBOLS, seed=n)
+        files[bhav_url[len(get_stocks_nse._NSE_BASE_URL):]] = bhav
+        files[deliv_url[len(get_stocks_nse._NSE_BASE_URL):]] = deliv
+    _FixtureHandler.files = files
+    _FixtureHandler.hosts = []
+
+    server = HTTPServer(('127.0.0.1', 0), _FixtureHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    host = '127.0.0.1:%d' % server.server_port
+    monkeypatch.setattr(get_stocks_nse, '_NSE_BASE_URL', 'http://' + host)
+    yield host
+    server.shutdown()
+    server.server_close()
+
+
+def test_backfill_from_local_server(nse_server, tmp_path, monkeypatch):
+    db_meta = get_metadata('sqlite:///%s' % tmp_path.joinpath('test.db'))
+    # Grouped commits of the writer
+    sqlite_profile.enable(db_meta)
+    monkeypatch.setattr(get_stocks_nse, '_DB_METADATA', db_meta)
+
+    # Three days (six requests) at 4 requests per second with a burst of 4.
+    then = time.time()
+    saved = get_stocks_nse.backfill(_DAYS + [_MISSING_DAY], workers=2,
+                                    rate=4.0)
+    assert time.time() - then >= 0.4
+    assert saved == len(_DAYS)
+    assert set(_FixtureHandler.hosts) == set([nse_server])
+
+    hist_data = create_or_get_nse_equities_hist_data(metadata=db_meta)
+    rows = db_meta.bind.execute(hist_data.select()).fetchall()
+    assert len(rows) == _SYMBOLS * len(_DAYS)
+    assert all(r.delivery is not None for r in rows)
+
+    info = create_or_get_nse_bhav_deliv_download_info(metadata=db_meta)
+    status = dict((r.download_date, r.error_type)
+                  for r in db_meta.bind.execute(info.select()).fetchall())
+    assert status == {_DAYS[0]: None, _DAYS[1]: None,
+                      _MISSING_DAY: 'NOT_FOUND'}
+
+    # Days downloaded are not downloaded again.
+    requests = len(_FixtureHandler.hosts)
+    assert get_stocks_nse.backfill(_DAYS, workers=2, rate=4.0) == 0
+    assert len(_FixtureHandler.hosts) == requests
@@ -0,0 +1,75 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+from datetime import date
+
+from sqlalchemy import inspect
+
+from tickerplot.sql.sqlalchemy_wrapper import create_or_get_all_scrips_table
+from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+
+import symbol_resolver
+from symbol_resolver import Security, SymbolResolver
+
+# A -> B -> C, and X -> Y after which a new security was listed as X and
+# renamed to Z later.
+_NAME_CHANGES = [('A', 'B', date(2015, 1, 1)),
+                 ('B', 'C', date(2018, 1, 1)),
+                 ('X', 'Y', date(2016, 1, 1)),
+                 ('X', 'Z', date(2019, 1, 1))]
+
+
+def _resolver():
+    securities = [Security(1, 'INE000000001', 'C', None, True),
+                  Security(2, 'INE000000002', 'Y', None, True),
+                  Security(3, 'INE000000003', 'Z', None, True)]
+    return SymbolResolver(securities, _NAME_CHANGES)
+
+
+def test_current_symbol_follows_chain():
+    resolver = _resolver()
+    assert resolver.current_symbol('A', date(2014, 6, 1)) == 'C'
+    assert resolver.current_symbol('B', date(2016, 6, 1)) == 'C'
+    assert resolver.current_symbol('C', date(2019, 6, 1)) == 'C'
+    assert resolver.current_symbol('A') == 'A'
+
+
+def test_current_symbol_of_reused_symbol():
+    resolver = _resolver()
+    assert resolver.current_symbol('X', date(2015, 6, 1)) == 'Y'
+    assert resolver.current_symbol('X', date(2017, 6, 1)) == 'Z'
+    assert resolver.security_id('X', date(2015, 6, 1)) == 2
+    assert resolver.security_id('X', date(2017, 6, 1)) == 3
+
+
+def test_symbol_on_follows_chain():
+    resolver = _resolver()
+    assert resolver.symbol_on('C', date(2014, 6, 1)) == 'A'
+    assert resolver.symbol_on('C', date(2016, 6, 1)) == 'B'
+    assert resolver.symbol_on('C', date(2019, 6, 1)) == 'C'
+    assert resolver.symbol_on('Y', date(2015, 6, 1)) == 'X'
+    assert resolver.symbol_on('Z', date(2017, 6, 1)) == 'X'
+
+
+def test_security_ids_for_dates():
+    resolver = _resolver()
+    ids = resolver.security_ids_for(['A', 'X', 'Q'], on=date(2014, 6, 1))
+    assert ids.tolist() == [1, 2, -1]
+
+
+def test_load_resolver_is_read_only(tmp_path):
+    metadata = get_metadata('sqlite:///%s' % tmp_path.joinpath('test.db'))
+    scrips = create_or_get_all_scrips_table(metadata=metadata)
+    metadata.bind.execute(scrips.insert(), [
+        {'security_isin': 'INE000000001', 'company_name': 'C Ltd',
+         'nse_symbol': 'C', 'nse_traded': True}])
+
+    resolver = symbol_resolver.load_resolver(metadata)
+    assert resolver.traded_nse_symbols() == ['C']
+    assert resolver.security_id('C') is None
+    assert set(inspect(metadata.bind).get_table_names()) == \
+        set(['all_scrips_info'])
+
+    symbol_resolver.assign_scrips_security_ids(metadata)
+    resolver = symbol_resolver.load_resolver(metadata)
+    assert resolver.security_id('C') == 1
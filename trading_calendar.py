@@ -0,0 +1,225 @@
+#
+# Refer to LICENSE file and README file for licensing information.
+#
+#pylint: disable-msg=broad-except
+"""
+Trading calendar for NSE. Used to plan the days for which we should try to
+download data, so that we don't make requests for days on which there cannot
+be any data (weekends and exchange holidays).
+
+A day is a trading day if -
+ - It's marked as a trading day in the `nse_trading_calendar` table (used for
+   special sessions eg. Budget day or Muhurat trading on a weekend.)
+ - Or it's a weekday that is not marked as a holiday in the
+   `nse_trading_calendar` table and for which we have not already seen a
+   'NOT_FOUND' while downloading the bhavcopy (older than a week.)
+"""
+
+import os
+from datetime import datetime as dt
+from datetime import timedelta as td
+
+from sqlalchemy import Table, Column, Date, Boolean, String
+
+from tickerplot.sql.sqlalchemy_wrapper import \
+    create_or_get_nse_bhav_deliv_download_info
+from tickerplot.sql.sqlalchemy_wrapper import execute_one
+from tickerplot.sql.sqlalchemy_wrapper import and_expr, select_expr
+from tickerplot.sql.sqlalchemy_wrapper import get_metadata
+
+from bulk_writer import bulk_insert
+
+from tickerplot.utils.logger import get_logger
+module_logger = get_logger(os.path.basename(__file__))
+
+_DATE_FMT = '%d-%m-%Y'
+
+# NOT_FOUND for a day older than these many days is treated as a holiday,
+# recent days may simply not be published yet.
+NOT_FOUND_SETTLE_DAYS = 7
+
+_SATURDAY = 5
+
+
+def create_or_get_nse_trading_calendar(metadata=None):
+    """Creates (if required) and returns the `nse_trading_calendar` table.
+    Only the exceptions to weekday rules are stored in this table."""
+    table_name = 'nse_trading_calendar'
+    if table_name in metadata.tables:
+        return metadata.tables[table_name]
+
+    tbl = Table(table_name, metadata,
+                Column('cal_date', Date, primary_key=True),
+                Column('is_trading', Boolean, nullable=False),
+                Column('description', String(64)))
+    tbl.create(bind=metadata.bind, checkfirst=True)
+    return tbl
+
+
+def _load_calendar_overrides(from_date, to_date, metadata):
+    """Returns a dictionary of date -> is_trading for days in the range."""
+    tbl = create_or_get_nse_trading_calendar(metadata=metadata)
+    sel_st = select_expr([tbl.c.cal_date, tbl.c.is_trading]).\
+        where(and_expr(tbl.c.cal_date >= from_date,
+                       tbl.c.cal_date <= to_date))
+
+    result = execute_one(sel_st, engine=metadata.bind)
+    overrides = dict((row[0], bool(row[1])) for row in result.fetchall())
+    result.close()
+    return overrides
+
+
+def _load_learned_holidays(from_date, to_date, metadata, today=None):
+    """Returns a set of days in the range for which bhavcopy was 'NOT_FOUND'
+    and which are old enough for it not to show up later."""
+    today = today or dt.date(dt.today())
+    settled = min(to_date, today - td(days=NOT_FOUND_SETTLE_DAYS + 1))
+    if settled < from_date:
+        return set()
+
+    tbl = create_or_get_nse_bhav_deliv_download_info(metadata=metadata)
+    sel_st = select_expr([tbl.c.download_date]).\
+        where(and_expr(tbl.c.download_date >= from_date,
+                       tbl.c.download_date <= settled,
+                       tbl.c.error_type == 'NOT_FOUND'))
+
+    result = execute_one(sel_st, engine=metadata.bind)
+    holidays = set(row[0] for row in result.fetchall())
+    result.close()
+    return holidays
+
+
+def get_trading_days(from_date, to_date, metadata=None, today=None):
+    """Returns a sorted list of `datetime.date` that are expected to be
+    trading days between `from_date` and `to_date` (both inclusive)."""
+
+    if from_date > to_date:
+        return []
+
+    overrides = {}
+    learned = set()
+    if metadata is not None:
+        overrides = _load_calendar_overrides(from_date, to_date, metadata)
+        learned = _load_learned_holidays(from_date, to_date, metadata,
+                                         today=today)
+
+    days = []
+    d = from_date
+    while d <= to_date:
+        is_trading = overrides.get(d)
+        if is_trading is None:
+            is_trading = d.weekday() < _SATURDAY and d not in learned
+        if is_trading:
+            days.append(d)
+        d += td(days=1)
+
+    module_logger.info("%d trading days out of %d days between %s and %s",
+                       len(days), (to_date - from_date).days + 1,
+                       from_date, to_date)
+    return days
+
+
+def save_calendar_days(days, is_trading, metadata, description=None):
+    """Marks each of the `days` as a holiday (`is_trading` False) or a
+    special trading session (`is_trading` True). A day given more than once
+    is saved once."""
+
+    tbl = create_or_get_nse_trading_calendar(metadata=metadata)
+
+    days = sorted(set(days))
+    rows = [{'cal_date': d, 'is_trading': is_trading,
+             'description': description} for d in days]
+
+    with metadata.bind.begin() as conn:
+        conn.execute(tbl.delete().where(tbl.c.cal_date.in_(days)))
+        bulk_insert(tbl, rows, conn=conn)
+
+
+def main(args):
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    # --holiday option
+    parser.add_argument("--holiday",
+                        help="Mark a date (DD-MM-YYYY) as an exchange holiday.",
+                        dest="holidays",
+                        action="append",
+                        default=[])
+
+    # --session option
+    parser.add_argument("--session",
+                        help="Mark a date (DD-MM-YYYY) as a special trading "
+                        "session.",
+                        dest="sessions",
+                        action="append",
+                        default=[])
+
+    # --description option
+    parser.add_argument("--description",
+                        help="Description for the dates added.",
+                        dest="description")
+
+    # --list option
+    parser.add_argument("--list",
+                        help="List trading days between --from and --to.",
+                        dest="list_days",
+                        action="store_true")
+
+    # --from option
+    parser.add_argument("--from",
+                        help="From Date in DD-MM-YYYY format.",
+                        dest='fromdate')
+
+    # --to option
+    parser.add_argument("--to",
+                        help="To Date in DD-MM-YYYY format. Default is Today.",
+                        dest='todate',
+                        default="today")
+
+    # --dbpath option
+    parser.add_argument("--dbpath",
+                        help="Database URL to be used.",
+                        dest="dbpath")
+
+    args = parser.parse_args()
+
+    try:
+        db_meta = get_metadata(args.dbpath)
+    except Exception as e:
+        print("Not a valid DB URL: {} (Exception: {})".format(
+            args.dbpath, e))
+        return -1
+
+    try:
+        holidays = [dt.date(dt.strptime(x, _DATE_FMT)) for x in args.holidays]
+        sessions = [dt.date(dt.strptime(x, _DATE_FMT)) for x in args.sessions]
+    except ValueError:
+        print(parser.format_usage())
+        return -1
+
+    if holidays:
+        save_calendar_days(holidays, False, db_meta, args.description)
+    if sessions:
+        save_calendar_days(sessions, True, db_meta, args.description)
+
+    if args.list_days:
+        try:
+            from_date = dt.date(dt.strptime(args.fromdate, _DATE_FMT))
+            if args.todate.lower() == 'today':
+                to_date = dt.date(dt.today())
+            else:
+                to_date = dt.date(dt.strptime(args.todate, _DATE_FMT))
+        except (TypeError, ValueError):
+            print(parser.format_usage())
+            return -1
+
+        for d in get_trading_days(from_date, to_date, metadata=db_meta):
+            print(d.strftime(_DATE_FMT))
+
+    return 0
+
+if __name__ == '__main__':
+
+    import sys
+    sys.exit(main(sys.argv[1:]))